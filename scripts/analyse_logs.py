@@ -4,6 +4,7 @@ from __future__ import print_function
 from builtins import range
 from datetime import datetime
 import glob
+import json
 import os
 import numpy as np
 import matplotlib.pyplot as plt
@@ -14,12 +15,31 @@ def get_time_range(file):
     end=datetime.strptime(lines[-2][:19], '%Y-%m-%d %H:%M:%S')
     return (end-start).total_seconds()
 
+def read_instrumentation(file):
+    # one JSON record per subprocess or Python stage, written by pipeline_logging
+    records=[]
+    for l in open(file).readlines():
+        if l.strip():
+            records.append(json.loads(l))
+    return records
+
 os.chdir('logs')
-g=glob.glob('*')
-times=[]
-for f in g:
-    dt=get_time_range(f)
-    times.append(dt)
+if os.path.isfile('instrumentation.jsonl'):
+    # measured resource usage: classify the subprocess records by
+    # stage name. Python stage records overlap with the subprocesses
+    # they run, so are listed but not added to the totals
+    records=read_instrumentation('instrumentation.jsonl')
+    print('%-50s %-10s %9s %9s %8s %9s %9s %5s' % ('Stage','Type','Wall(s)','CPU(s)','RSS(GB)','Read(GB)','Write(GB)','Procs'))
+    for r in records:
+        print('%-50s %-10s %9.0f %9.0f %8.2f %9.2f %9.2f %5i' % (r['stage'][:50],r['type'],r['wall'],r['cpu_user']+r['cpu_system'],r['maxrss_kb']/1048576.0,r['read_bytes']/1073741824.0,r['write_bytes']/1073741824.0,r['children']))
+    g=[r['stage'] for r in records if r['type']=='subprocess']
+    times=[r['wall'] for r in records if r['type']=='subprocess']
+else:
+    g=glob.glob('*')
+    times=[]
+    for f in g:
+        dt=get_time_range(f)
+        times.append(dt)
 
 labels=['Miscellaneous','Dynspec','Clipcal','Shift','Wide-field KillMS','KillMS phase 60sb','KillMS amp/phase 60sb', 'KillMS amp/phase full', 'KillMS amp/phase full 2', 'Wide-field DDF dirin', 'Predict wide-field', 'DDF dirin', 'DDF phase 60sb', 'DDF amp-phase 60sb', 'DDF band images','DDF full NS', 'DDF full', 'DDF full low QU','DDF full vlow QU','DDF full V','DDF full low', 'DDF bootstrap', 'DDF bootstrap single-band','KillMS DIS0','KillMS DDS0','KillMS DIS1','KillMS DDS1','KillMS DIS2','KillMS DDS2','KillMS DDS3','DDF full DI','DDF predict']
 fragments=['***','dynspec','ClipCal','shift','wide_killms_p1','killms_p1','killms_ap1','killms_f_ap1','killms_f_ap2','wide_image_dirin', 'wide_image_phase1_predict', 'image_dirin','image_phase1','image_ampphase1','NS_Band','image_full_ampphase_di_m.NS','image_full_ampphase_di', 'image_full_low_IQU', 'image_full_vlow_IQU', 'image_full_high_stokesV','image_full_low','image_bootstrap','image_low','_DIS0','_DDS0','_DIS1','_DDS1','_DIS2','_DDS2','_DDS3','image_full_ampphase_di','DDF-Predict']
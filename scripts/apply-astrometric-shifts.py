@@ -8,7 +8,7 @@ import scipy.ndimage as nd
 import numpy as np
 from astropy.table import Table
 from astropy.io import fits
-import pyregion
+from facet_labels import get_facet_labels
 
 # Use scipy.ndimage.shift
 # First get pixels for each facet with a bit of padding around the edge. Then apply the shift for that particular facet.
@@ -27,6 +27,8 @@ ds9region = 'image_full_ampphase_di_m.NS.tessel.reg'
 infilename = 'image_full_ampphase_di_m.NS.app.restored.fits'
 finaloutname = 'image_full_ampphase_di_m.NS_newshift.app.restored.fits'
 polylist = convert_regionfile_to_poly(ds9region)
+hduflat = flatten(fits.open(infilename))
+labels = get_facet_labels(ds9region,hduflat.header,hduflat.data.shape)
 finalout = fits.open(infilename)
 finalout[0].data[0,0] = finalout[0].data[0,0]*0.0
 averagefilename = 'image_full_ampphase_di_m.NS_average.app.restored.fits'
@@ -38,14 +40,13 @@ template=fits.open(infilename) # will be 4D
 
 for direction,ds9region in enumerate(polylist):
     print(direction,ds9region)
-    r = pyregion.parse(ds9region)
 
     # Mask so that hduflat.data only contains a particular facet.
     hdu=fits.open(infilename)
     hduflat = flatten(hdu) # depending on MakeMask version may be 2D or 4D
     template=fits.open(infilename) # will be 4D
     outfilename = 'facet_%s.fits'%direction
-    manualmask = r.get_mask(hdu=hduflat)
+    manualmask = labels==direction
 
     # Extende the manual mask a bit
     manualmask = nd.gaussian_filter(manualmask.astype(float),sigma=3)
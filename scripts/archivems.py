@@ -3,7 +3,13 @@ from __future__ import print_function
 # LOFAR software must be on path and dysco on LD_LIBRARY_PATH
 
 import os
+import shutil
+import hashlib
 import argparse
+import subprocess
+from multiprocessing import Pool
+from getcpus import getcpus
+import numpy as np
 import casacore.tables as pt
 from casacore.tables.tableutil import makearrcoldesc, maketabdesc
 
@@ -30,7 +36,7 @@ def make_imaging_weight_column(ms):
                   'SPEC': {'DEFAULTTILESHAPE': [4, 32, 128]}}    
 
     if 'IMAGING_WEIGHT' in cnames:
-        six.print_("Column IMAGING_WEIGHT not added; it already exists")
+        print("Column IMAGING_WEIGHT not added; it already exists")
     else:
         # Add IMAGING_WEIGHT which is 1-dim and has type float.
         # It needs a shape, otherwise the CASA imager complains.
@@ -56,56 +62,196 @@ def make_imaging_weight_column(ms):
     return
 
 
-parser = argparse.ArgumentParser(description='Compress and copy column of a list of ms files for archiving')
-parser.add_argument('-m','--mslist', help='DR2 mslist file, default=big-mslist.txt', default='big-mslist.txt', type=str)
-parser.add_argument('-c','--column', help='Column that is copied from the MS and compressed, default=DATA_DI_CORRECTED', default='DATA_DI_CORRECTED', type=str)
-parser.add_argument('--inmsdir', help='Forces the ouput MS to be in the same directory as the mslist', action='store_true')
-parser.add_argument('--skipimweights', help='Do not copy over IMAGING_WEIGHT column', action='store_true')
-parser.add_argument('--preserve', help='Preserve existing files', action='store_true')
-args = vars(parser.parse_args())
+def column_checksum(t,colname,chunkrows=100000):
+    # sha1 of the values of a column, read chunkrows rows at a time
+    h=hashlib.sha1()
+    nrows=t.nrows()
+    for startrow in range(0,nrows,chunkrows):
+        h.update(np.ascontiguousarray(t.getcol(colname,startrow=startrow,nrow=min(chunkrows,nrows-startrow))).tobytes())
+    return h.hexdigest()
 
-dirname = os.path.dirname(args['mslist'])
-msfiles = [l.rstrip() for l in open(args['mslist']).readlines()]
+def copy_column(tin,tout,colname,chunkrows=100000):
+    # copy a column chunkrows rows at a time, returning the sha1 of
+    # what was written
+    h=hashlib.sha1()
+    nrows=tin.nrows()
+    for startrow in range(0,nrows,chunkrows):
+        nrow=min(chunkrows,nrows-startrow)
+        d=tin.getcol(colname,startrow=startrow,nrow=nrow)
+        tout.putcol(colname,d,startrow=startrow,nrow=nrow)
+        h.update(np.ascontiguousarray(d).tobytes())
+    return h.hexdigest()
 
-for ms in msfiles:
-    
-    if dirname !='': # user gave a mslist that is not in the current directory
-      msin = dirname + '/' + ms # add the full path to the input file
-    else:
-      msin = ms  
-  
-    if args['inmsdir']:
-      msout = dirname + '/' + ms + '.archive'
-    else:
-      msout = ms + '.archive' # write ms in current working directory
+def check_flags(tin,tout,chunkrows=100000):
+    # DP3 may flag more data (e.g. NaNs), but everything flagged in the
+    # input must still be flagged in the archive
+    for startrow in range(0,tin.nrows(),chunkrows):
+        nrow=min(chunkrows,tin.nrows()-startrow)
+        fin=tin.getcol('FLAG',startrow=startrow,nrow=nrow)
+        fout=tout.getcol('FLAG',startrow=startrow,nrow=nrow)
+        if not np.all(fout | ~fin):
+            return False
+    return True
 
-    if not args['preserve']:
-        cmd  = 'rm -r '+msout+'; '
-    else:
-        cmd = ''
-    cmd += 'DP3 msin=' + msin + ' msin.datacolumn=' + args['column'] + ' '
+def count_unflagged(t,chunkrows=100000):
+    n=0
+    for startrow in range(0,t.nrows(),chunkrows):
+        n+=np.sum(~t.getcol('FLAG',startrow=startrow,nrow=min(chunkrows,t.nrows()-startrow)))
+    return n
+
+def verify_archive(msin,msout,columns,checksums,chunkrows=100000):
+    # check that the archive has the columns, that it keeps the input
+    # flags and that the columns copied across are identical to the
+    # input. The row-by-row checks need the rows to line up, so if DP3
+    # has changed the number of rows only the total number of
+    # unflagged visibilities is compared. Returns True if the full
+    # checks were done and False if only the partial one was
+    tin=pt.table(msin, ack=False)
+    tout=pt.table(msout, ack=False)
+    try:
+        for colname in ['FLAG']+columns:
+            if colname not in tout.colnames():
+                raise RuntimeError('Column %s missing from %s' % (colname,msout))
+        if tin.nrows()!=tout.nrows():
+            print('Warning: %s has %i rows but %s has %i, only comparing flag totals' % (msin,tin.nrows(),msout,tout.nrows()))
+            nin=count_unflagged(tin,chunkrows)
+            nout=count_unflagged(tout,chunkrows)
+            if nout>nin:
+                raise RuntimeError('%s has %i unflagged visibilities but %s has %i' % (msout,nout,msin,nin))
+            return False
+        if not check_flags(tin,tout,chunkrows):
+            raise RuntimeError('%s has data flagged that is not flagged in %s' % (msin,msout))
+        for colname in columns:
+            if colname in checksums:
+                inchecksum=checksums[colname]
+            else:
+                inchecksum=column_checksum(tin,colname,chunkrows)
+            if column_checksum(tout,colname,chunkrows)!=inchecksum:
+                raise RuntimeError('Column %s of %s does not match %s' % (colname,msout,msin))
+        return True
+    finally:
+        tin.close()
+        tout.close()
+
+def archive_ms(job):
+    """
+    Compress one MS with DP3/dysco, copy IMAGING_WEIGHT across and
+    verify the result. job is (msin,msout,options) where options is
+    the dict of command-line arguments plus the number of threads
+    this job may use. Returns msout, or raises RuntimeError: an
+    archive that DP3 failed to make is removed, and one that fails
+    verification is moved aside to msout.failed for inspection, so
+    that it is never mistaken for a finished archive
+    """
+    msin,msout,args=job
+    threads=args['threads']
+    chunkrows=args['chunkrows']
+    if os.path.isdir(msout):
+        if not args['overwrite']:
+            print('Skipping',msout,'as it already exists')
+            return msout
+        print('Removing existing',msout)
+        shutil.rmtree(msout)
+
+    cmd  = 'DP3 msin=' + msin + ' msin.datacolumn=' + args['column'] + ' '
     cmd += 'msout.storagemanager=dysco msout=' + msout  + ' steps=[] '
-    cmd += 'msin.weightcolumn=WEIGHT_SPECTRUM '
-
-    if not os.path.isdir(msout):
-      print(cmd)  
-      result=os.system(cmd)
-      if result!=0:
-          os.system('rm -r '+msout)
-          raise RuntimeError('DP3 call failed')
-      
-      if not args['skipimweights']:
-        tin = pt.table(msin, ack=False)
-        if 'IMAGING_WEIGHT' in tin.colnames():
-           make_imaging_weight_column(msout)
-           tout = pt.table(msout, readonly=False, ack=False)
-           imw = tin.getcol('IMAGING_WEIGHT')
-           tout.putcol('IMAGING_WEIGHT', imw)
-           tout.close()
+    cmd += 'msin.weightcolumn=WEIGHT_SPECTRUM numthreads=%i' % threads
+    env=dict(os.environ)
+    env['OMP_NUM_THREADS']=str(threads)
+    print(cmd)
+    result=subprocess.call(cmd,shell=True,env=env)
+    try:
+        if result!=0:
+            raise RuntimeError('DP3 call failed for '+msin)
+
+        checksums={}
+        if not args['skipimweights']:
+            tin = pt.table(msin, ack=False)
+            if 'IMAGING_WEIGHT' in tin.colnames():
+                make_imaging_weight_column(msout)
+                tout = pt.table(msout, readonly=False, ack=False)
+                checksums['IMAGING_WEIGHT']=copy_column(tin,tout,'IMAGING_WEIGHT',chunkrows)
+                tout.close()
+            else:
+                print('Warning: IMAGING_WEIGHT does not exist in input ms', msin)
+            tin.close()
+    except Exception:
+        if os.path.isdir(msout):
+            shutil.rmtree(msout)
+        raise
+
+    if not args['noverify']:
+        try:
+            full=verify_archive(msin,msout,sorted(checksums),checksums,chunkrows)
+        except RuntimeError as e:
+            failed=msout+'.failed'
+            if os.path.isdir(failed):
+                shutil.rmtree(failed)
+            os.rename(msout,failed)
+            raise RuntimeError('Verification of %s failed, archive moved to %s: %s' % (msout,failed,e))
+        if full:
+            print('Verified',msout)
         else:
-           print('Warning: IMAGING_WEIGHT does not exist in input ms', ms)
-      
-        tin.close()
+            print('Partially verified',msout,'(row counts differ)')
+    return msout
+
+def run_archive(msfiles,dirname,args):
+    # archive the MSs with at most args['jobs'] at once, each given an
+    # equal share of args['ncpu'] threads
+    jobs=[]
+    for ms in msfiles:
+        if dirname !='': # user gave a mslist that is not in the current directory
+            msin = dirname + '/' + ms # add the full path to the input file
+        else:
+            msin = ms
+
+        if args['inmsdir']:
+            msout = dirname + '/' + ms + '.archive'
+        else:
+            msout = ms + '.archive' # write ms in current working directory
+        jobs.append((msin,msout,args))
+
+    njobs=max(1,min(args['jobs'],len(jobs),args['ncpu']))
+    args['threads']=max(1,args['ncpu']//njobs)
+    print('Archiving',len(jobs),'MSs with',njobs,'jobs of',args['threads'],'threads')
+    failed=[]
+    if njobs==1:
+        for job in jobs:
+            try:
+                archive_ms(job)
+            except RuntimeError as e:
+                print('Archiving failed:',e)
+                failed.append(job[0])
     else:
-        print('Skipping',msout,'as it already exists')
-        
+        pool=Pool(njobs)
+        try:
+            results=[(job[0],pool.apply_async(archive_ms,(job,))) for job in jobs]
+            for msin,r in results:
+                try:
+                    r.get()
+                except RuntimeError as e:
+                    print('Archiving failed:',e)
+                    failed.append(msin)
+        finally:
+            pool.close()
+            pool.join()
+    if failed:
+        raise RuntimeError('Failed to archive '+', '.join(failed))
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Compress and copy column of a list of ms files for archiving')
+    parser.add_argument('-m','--mslist', help='DR2 mslist file, default=big-mslist.txt', default='big-mslist.txt', type=str)
+    parser.add_argument('-c','--column', help='Column that is copied from the MS and compressed, default=DATA_DI_CORRECTED', default='DATA_DI_CORRECTED', type=str)
+    parser.add_argument('--inmsdir', help='Forces the ouput MS to be in the same directory as the mslist', action='store_true')
+    parser.add_argument('--skipimweights', help='Do not copy over IMAGING_WEIGHT column', action='store_true')
+    parser.add_argument('--preserve', help='Preserve existing files (the default, kept for compatibility)', action='store_true')
+    parser.add_argument('--overwrite', help='Remake archives that already exist', action='store_true')
+    parser.add_argument('-j','--jobs', help='Number of MSs to archive at once, default=4', default=4, type=int)
+    parser.add_argument('--ncpu', help='Total number of threads to divide between the jobs, default=all available cores', default=getcpus(), type=int)
+    parser.add_argument('--chunkrows', help='Number of rows to copy and verify at a time, default=100000', default=100000, type=int)
+    parser.add_argument('--noverify', help='Do not verify the archived MSs', action='store_true')
+    args = vars(parser.parse_args())
+
+    dirname = os.path.dirname(args['mslist'])
+    msfiles = [l.rstrip() for l in open(args['mslist']).readlines()]
+    run_archive(msfiles,dirname,args)
@@ -20,6 +20,7 @@ import pyrap.tables as pt
 import numpy as np
 from scipy.interpolate import InterpolatedUnivariateSpline
 from pipeline import ddf_image,make_external_mask
+from ms_stream import stream_columns
 import shutil
 from astropy.io import fits
 
@@ -29,6 +30,34 @@ def logfilename(s):
     else:
         return None
 
+def scale_ms(args):
+    # Write SCALED_DATA, and colname_SCALED if colname exists, to an
+    # MS, streaming the data a chunk of rows at a time so that memory
+    # use does not depend on the size of the MS
+    ms,factor,incol,colname,chunksize=args
+    # in this version we need to scale both the original data and the data in colname
+    def scale(d):
+        d*=factor
+        return d
+    t=pt.table(ms,readonly=False,ack=False)
+    try:
+        desc=t.getcoldesc(incol)
+        desc['name']='SCALED_DATA'
+        t.addcols(desc)
+        stream_columns(t,[incol],scale,outcol='SCALED_DATA',chunksize=chunksize)
+        try:
+            desc=t.getcoldesc(colname)
+        except RuntimeError:
+            desc=None
+        if desc is not None:
+            newname=colname+'_SCALED'
+            desc['name']=newname
+            t.addcols(desc)
+            stream_columns(t,[colname],scale,outcol=newname,chunksize=chunksize)
+    finally:
+        t.close()
+    print('Scaled',ms,'by',factor)
+
 def run_bootstrap(o):
 
     # guess colname. This is necesssary because skip_di means there is
@@ -218,6 +247,12 @@ def run_bootstrap(o):
             bigmslist=[s.strip() for s in open(o['full_mslist']).readlines()]
             obigmslist = [ms for ms in bigmslist if obsid in ms]
             
+            if o['do_wide']:
+                warn('Using DATA_SUB column in bootstrap')
+                incol='DATA_SUB'
+            else:
+                incol=o['colname']
+            jobs=[]
             for ms in obigmslist:
                 t = pt.table(ms)
                 try:
@@ -228,40 +263,24 @@ def run_bootstrap(o):
                 if dummy is not None:
                     warn('Table '+ms+' has already been corrected, skipping')
                 else:
-                    # in this version we need to scale both the original data and the data in colname
                     t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
                     frq=t[0]['REF_FREQUENCY']
-                    factor=spl(frq)
-                    print(frq,factor)
-                    t=pt.table(ms,readonly=False)
-                    if o['do_wide']:
-                        warn('Using DATA_SUB column in bootstrap')
-                        desc=t.getcoldesc('DATA_SUB')
-                    else:
-                        desc=t.getcoldesc(o['colname'])
-                    desc['name']='SCALED_DATA'
-                    t.addcols(desc)
-                    if o['do_wide']:
-                        warn('Using DATA_SUB column in bootstrap')
-                        d=t.getcol('DATA_SUB')
-                    else:
-                        d=t.getcol(o['colname'])
-                    d*=factor
-                    t.putcol('SCALED_DATA',d)
-                    try:
-                        dummy=t.getcoldesc(colname)
-                    except RuntimeError:
-                        dummy=None
-                    if dummy is not None:
-                        desc=t.getcoldesc(colname)
-                        newname=colname+'_SCALED'
-                        desc['name']=newname
-                        t.addcols(desc)
-                        d=t.getcol(colname)
-                        d*=factor
-                        t.putcol(newname,d)
-
                     t.close()
+                    factor=float(spl(frq))
+                    print(frq,factor)
+                    jobs.append((ms,factor,incol,colname,o['ms_chunk_rows']))
+            njobs=max(1,min(o['ms_jobs'],len(jobs)))
+            if njobs==1:
+                for job in jobs:
+                    scale_ms(job)
+            else:
+                from multiprocessing import Pool
+                pool=Pool(njobs)
+                try:
+                    pool.map(scale_ms,jobs,chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
     if os.path.isfile('image_bootstrap.app.mean.fits'):
         warn('Mean bootstrap image exists, not creating it')
     else:
@@ -5,6 +5,7 @@ import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 from scipy.stats._continuous_distns import_distn_names
 from astropy.table import Table
+from facet_labels import get_facet_labels
 
 ## ANOTHER SCRIPT TO FIND ENTIRE FILEDS THAT ARE BAD.
 
@@ -57,6 +58,8 @@ cleanmask[0].data[np.where(cleanmask[0].data==0)] = 1
 cleanmask[0].data[np.where(cleanmask[0].data==2)] = 0
 
 polylist = convert_regionfile_to_poly(ds9region)
+hduflat = flatten(fits.open(infilename))
+labels = get_facet_labels(ds9region,hduflat.header,hduflat.data.shape) # all the images below share this grid
 allastrooffsets = Table.read('pslocal-facet_offsets.fits')
 debug = False
 
@@ -74,14 +77,12 @@ facetids = []
 
 for direction,ds9region in enumerate(polylist):
 
-    r = pyregion.parse(ds9region)
-
     # Mask so that hduflat.data only contains a particular facet.
     hdu=fits.open(infilename)
     hduflat = flatten(hdu) # depending on MakeMask version may be 2D or 4D
     template=fits.open(infilename) # will be 4D
     outfilename = 'facet_%s.fits'%direction
-    manualmask = r.get_mask(hdu=hduflat)
+    manualmask = labels==direction
     facetsizes[direction] = np.sum(manualmask.astype(int))*abs(hdu[0].header['CDELT1']**2.0)
     manualmask_clean = cleanmask[0].data[0,0,:,:].astype(int) + manualmask.astype(int) - 1
     manualmask_clean[np.where(manualmask_clean == -1)] = 0
@@ -310,11 +311,10 @@ hdu[0].data[0,0] = fpb
 hduflat = flatten(hdu) # depending on MakeMask version may be 2D or 4D
 for direction,ds9region in enumerate(polylist):
     #print(direction,ds9region)
-    r = pyregion.parse(ds9region)
     if direction in missingfacets:
         continue
     # Mask so that hduflat.data only contains a particular facet.
-    manualmask = r.get_mask(hdu=hduflat)
+    manualmask = labels==direction
     try:
         fraczero = 1.0-len(np.where(hduflat.data[manualmask]==0.0)[0])/len(hduflat.data[manualmask])
     except ZeroDivisionError:
@@ -327,9 +327,8 @@ hdu=fits.open(infilename)
 hduflat = flatten(hdu) # depending on MakeMask version may be 2D or 4D
 for direction,ds9region in enumerate(polylist):
     print(direction,ds9region)
-    r = pyregion.parse(ds9region)
     # Mask so that hduflat.data only contains a particular facet.
-    manualmask = r.get_mask(hdu=hduflat)
+    manualmask = labels==direction
     if direction in allbad:
         hduflat.data[manualmask] = np.nan
 hdu[0].data[0,0]= hduflat.data
@@ -2,11 +2,15 @@
 # Make MS lists, checking for heavily flagged data
 
 from __future__ import print_function
+from __future__ import division
 import os
 import glob
 import pyrap.tables as pt
 import numpy as np
 from auxcodes import warn
+from getcpus import getcpus
+from ms_metadata import ms_metadata
+from multiprocessing import Pool
 from surveys_db import use_database,update_status
 
 def check_flagged(ms):
@@ -14,25 +18,67 @@ def check_flagged(ms):
     tc = t.getcol('FLAG').flatten()
     return float(np.sum(tc))/len(tc)
 
-def check_flags_and_shape(ms):
-    t = pt.table(ms, readonly=True)
-    flags = t.getcol('FLAG')
-    channels=flags.shape[1]
-    tc = flags.flatten()
-    return channels,float(np.sum(tc))/len(tc)
+def check_flags_and_shape(ms,threshold=0.8,chunksize=100000):
+    """
+    Return (channels,fraction) for the FLAG column of ms, reading it
+    chunksize rows at a time. The scan stops as soon as it is certain
+    which side of threshold the flagged fraction is on, in which case
+    the fraction returned is the bound that settled it: the lower bound
+    if it is at or over threshold, the upper bound if it is below
+    """
+    t = pt.table(ms, readonly=True, ack=False)
+    try:
+        nrows=t.nrows()
+        channels=None
+        flagged=0
+        for startrow in range(0,nrows,chunksize):
+            flags=t.getcol('FLAG',startrow=startrow,nrow=min(chunksize,nrows-startrow))
+            if channels is None:
+                channels=flags.shape[1]
+                total=float(nrows*flags.shape[1]*flags.shape[2])
+                if total==0:
+                    break
+            flagged+=np.count_nonzero(flags)
+            unread=(nrows-startrow-len(flags))*flags.shape[1]*flags.shape[2]
+            if flagged/total>=threshold:
+                return channels,flagged/total
+            if (flagged+unread)/total<threshold:
+                return channels,(flagged+unread)/total
+    finally:
+        t.close()
+    if channels is None or total==0:
+        # no data at all, so nothing usable
+        return channels,1.0
+    return channels,flagged/total
+
+def scan_ms(ms):
+    chans,ff=check_flags_and_shape(ms)
+    t0,t1=get_timerange(ms)
+    return chans,ff,t0,t1
 
 def get_timerange(ms):
-    t = pt.table(ms +'/OBSERVATION', readonly=True, ack=False)
-    return t.getcell('TIME_RANGE',0)
+    return ms_metadata(ms)['time_range']
 
-def make_list(workdir='.',force=False):
+def make_list(workdir='.',force=False,njobs=None):
     g=sorted(glob.glob(workdir+'/*.ms'))
     full_mslist=[]
     start_times=[]
     chanlist=[]
-    for ms in g:
-        chans,ff=check_flags_and_shape(ms)
-        t0,t1=get_timerange(ms)
+    # scan several MSs at once; results come back in the sorted order.
+    # The scans are I/O bound, so a few jobs are enough by default
+    if njobs is None:
+        njobs=min(8,getcpus())
+    njobs=max(1,min(njobs,len(g)))
+    if njobs==1:
+        results=[scan_ms(ms) for ms in g]
+    else:
+        pool=Pool(njobs)
+        try:
+            results=pool.map(scan_ms,g,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    for ms,(chans,ff,t0,t1) in zip(g,results):
         print(ms,chans,ff)
         if ff<0.8 and (len(chanlist)==0 or chans in chanlist):
             full_mslist.append(os.path.basename(ms))
@@ -9,9 +9,9 @@ from __future__ import division
 from builtins import zip
 from builtins import range
 from pipeline_version import version
-from reproject import reproject_exact
-from reproj_test import reproject_interp_chunk_2d
+from reproj_test import reproject_interp_chunk_2d, reproject_exact_chunk_2d, output_bounds
 from auxcodes import die, get_rms, flatten, convert_regionfile_to_poly, get_rms_map3
+from facet_labels import get_facet_labels,make_facet_labels
 from astropy.io import fits
 from astropy.table import Table
 from astropy.wcs import WCS
@@ -19,35 +19,35 @@ import numpy as np
 import argparse
 import pickle
 import os.path
+import tempfile
+import hashlib
 import glob
 import pyregion
 import scipy.ndimage as nd
 from copy import deepcopy
 import multiprocessing as mp
-from queue import Empty
 from convolve import do_convolve
-from time import sleep
-
-def reproj_inner(q,reproj,hdu,header,shift,direction,ds9region,guard=20):
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+from getcpus import getcpus
+
+# Per-facet reprojection runs in a bounded pool of forked worker
+# processes. The job description, including the input image and label
+# maps, is a module global set before the pool is forked, so nothing
+# large is pickled. Each worker writes its facet straight into an
+# output array in shared memory: every output pixel belongs to at most
+# one facet, so the workers never write to the same pixels
+_facet_job=None
+
+def reproj_inner(direction,guard=20):
+    reproj,hdu,header,shift,labels,outlabels,inslices,outslices,out=_facet_job
     print('Direction',direction,'starting')
-    r = pyregion.parse(ds9region)
-    manualmask = r.get_mask(hdu=hdu)
-    # Find bounding box
-    yv = np.any(manualmask, axis=1)
-    xv = np.any(manualmask, axis=0)
-    xmin, xmax = np.where(xv)[0][[0, -1]]
-    ymin, ymax = np.where(yv)[0][[0, -1]]
+    ys,xs=inslices[direction]
     # Add guard
-    xmin-=guard
-    if xmin<0: xmin=0
-    ymin-=guard
-    if ymin<0: ymin=0
-    xmax+=guard
-    if xmax>hdu.data.shape[1]:
-        xmax=hdu.data.shape[1]
-    ymax+=guard
-    if ymax>hdu.data.shape[0]:
-        ymax=hdu.data.shape[0]
+    ymin=max(ys.start-guard,0)
+    ymax=min(ys.stop+guard,hdu.data.shape[0])
+    xmin=max(xs.start-guard,0)
+    xmax=min(xs.stop+guard,hdu.data.shape[1])
     print('Bounding box is',xmin,xmax,ymin,ymax)
     newdata=hdu.data[ymin:ymax,xmin:xmax]
     newheader=deepcopy(hdu.header)
@@ -57,42 +57,94 @@ def reproj_inner(q,reproj,hdu,header,shift,direction,ds9region,guard=20):
     #newheader['CRPIX2']-=ymin
     #newheader['CRVAL1']-=shift['RA_offset']/3600.0
     #newheader['CRVAL2']-=shift['DEC_offset']/3600.0
-    newheader['CRPIX1']-=xmin+shift['RA_offset']/cellsize
-    newheader['CRPIX2']-=ymin-shift['DEC_offset']/cellsize
+    newheader['CRPIX1']-=xmin+shift[direction]['RA_offset']/cellsize
+    newheader['CRPIX2']-=ymin-shift[direction]['DEC_offset']/cellsize
     shhdu=fits.PrimaryHDU(data=newdata,header=newheader)
-    rpm,_=reproj(shhdu,header,hdu_in=0,parallel=False)
-    rphdu=fits.PrimaryHDU(header=header,data=rpm)
-    newmask = r.get_mask(hdu=rphdu)
-    rpm[~newmask]=0
-    print('Direction',direction,'returning result to queue')
-    q.put(rpm)
-
-
-def do_reproj_mp(reproj,hdu,header,shift=None,polylist=None,badfacet=None):
-    # Wrapper around reproj which handles per-facet reprojection if required
+    # only reproject onto the part of the output covered by this facet
+    oys,oxs=outslices[direction]
+    rpm,_=reproj(shhdu,sub_header(header,(oys.start,oys.stop,oxs.start,oxs.stop)),hdu_in=0,parallel=False,workers=1) # already one process per facet
+    newmask = outlabels[oys,oxs]==direction
+    out[oys,oxs][newmask]=rpm[newmask]
+    print('Direction',direction,'done')
+    return direction
+
+def facet_workers(ncpu,memory,jobs,inslices,outslices,guard=20,shared=0,blocks=(1000,1000)):
+    # number of worker processes to use: at most ncpu (default all
+    # available) and, if a memory budget in bytes is given, few enough
+    # that the largest facet jobs fit in what is left of it after the
+    # shared output image of shared bytes. blocks is the tile size
+    # the reprojection works in
+    if ncpu is None:
+        ncpu=getcpus()
+    n=max(1,min(ncpu,len(jobs)))
+    if memory:
+        need=0
+        for d in jobs:
+            ys,xs=inslices[d]
+            oys,oxs=outslices[d]
+            inpix=(ys.stop-ys.start+2*guard)*(xs.stop-xs.start+2*guard)
+            outpix=(oys.stop-oys.start)*(oxs.stop-oxs.start)
+            tilepix=min(outpix,blocks[0]*blocks[1])
+            # what a worker allocates for one facet (see reproj_inner
+            # and reproj_test.reproject_tiled), in bytes:
+            # - the input cutout, which interpolation works on as a
+            #   float64 copy: inpix*8
+            # - the reprojected facet and its footprint, at most
+            #   float64 each: outpix*16
+            # - the facet mask and the masked copy of the facet that
+            #   goes into the shared output: outpix*(1+8)
+            # - the working arrays for one tile (pixel, sky and input
+            #   pixel coordinates on both axes, the tile and its
+            #   footprint), all float64: tilepix*8*8
+            need=max(need,inpix*8+outpix*(16+1+8)+tilepix*8*8)
+        n=max(1,min(n,int(max(0,memory-shared)//max(1,need))))
+    return n
+
+def do_reproj_mp(reproj,hdu,header,shift=None,polylist=None,badfacet=None,regfile=None,ncpu=None,memory=None):
+    # Wrapper around reproj which handles per-facet reprojection if
+    # required. ncpu limits the number of worker processes and memory
+    # is an optional budget for them in bytes
+    global _facet_job
     if shift is None:
         return reproj(hdu,header,hdu_in=0,parallel=False)
     else:
-        rpm=None
-        q=mp.Queue()
-        for direction,ds9region in enumerate(polylist):
+        # facet label images on the input and output grids, made once
+        # and inherited by the child processes. Only the input-grid
+        # labels are cached (next to the region file); the output grid
+        # is specific to this mosaic, so its labels are not kept
+        labels=get_facet_labels(regfile,hdu.header,hdu.data.shape)
+        outlabels=make_facet_labels(regfile,header,(header['NAXIS2'],header['NAXIS1']))
+        inslices=nd.find_objects(np.asarray(labels)+1,max_label=len(polylist))
+        outslices=nd.find_objects(np.asarray(outlabels)+1,max_label=len(polylist))
+        jobs=[]
+        for direction in range(len(polylist)):
             if badfacet and direction in badfacet: continue
-            p=mp.Process(target=reproj_inner,args=(q,reproj,hdu,header,shift[direction],direction,ds9region))
-            p.start()
-        while True:
-            n=len(mp.active_children())
-            print('In main loop,',n,'active children')
-            if n==0: break
+            if inslices[direction] is None or outslices[direction] is None:
+                print('Direction',direction,'does not overlap the image, skipping')
+                continue
+            jobs.append(direction)
+        shape=(header['NAXIS2'],header['NAXIS1'])
+        # float32 is the precision of the images and the mosaic
+        shm=SharedMemory(create=True,size=int(np.prod(shape))*4)
+        try:
+            out=np.ndarray(shape,dtype=np.float32,buffer=shm.buf)
+            out[:]=0
+            _facet_job=(reproj,hdu,header,shift,labels,outlabels,inslices,outslices,out)
+            nworkers=facet_workers(ncpu,memory,jobs,inslices,outslices,shared=shm.size,blocks=reproj.keywords.get('blocks',(1000,1000)))
+            print('Reprojecting',len(jobs),'facets with',nworkers,'processes')
+            pool=mp.get_context('fork').Pool(nworkers)
             try:
-                result=q.get(block=False)
-            except Empty:
-                print('Tick...')
-                sleep(1)
-            else:
-                if rpm is None:
-                    rpm=result
-                else:
-                    rpm+=result
+                for direction in pool.imap_unordered(reproj_inner,jobs):
+                    print('Direction',direction,'added to image')
+            finally:
+                pool.terminate()
+                pool.join()
+            rpm=np.array(out)
+        finally:
+            _facet_job=None
+            del(out)
+            shm.close()
+            shm.unlink()
         return rpm,None  # footprint is not used
 
 def do_reproj(reproj,hdu,header,shift=None,polylist=None,debug=True):
@@ -140,6 +192,163 @@ def do_reproj(reproj,hdu,header,shift=None,polylist=None,debug=True):
                 rphdu.writeto('direction-%i.fits' % direction, overwrite=True)
         return rpm,None  # footprint is not used so safe to return none
 
+def scratch_array(scratch,shape,dtype):
+    # a zeroed memory-mapped array backed by an unlinked file in the
+    # directory scratch, so the space is freed when it is deleted
+    fd,filename=tempfile.mkstemp(prefix='mosaic-',suffix='.dat',dir=scratch)
+    os.close(fd)
+    try:
+        a=np.memmap(filename,mode='w+',shape=shape,dtype=dtype)
+    finally:
+        os.unlink(filename)
+    return a
+
+def sub_header(header,bounds):
+    # header for the part of the mosaic given by bounds=(ymin,ymax,xmin,xmax)
+    ymin,ymax,xmin,xmax=bounds
+    h=header.copy()
+    h['CRPIX1']-=xmin
+    h['CRPIX2']-=ymin
+    h['NAXIS1']=xmax-xmin
+    h['NAXIS2']=ymax-ymin
+    return h
+
+def mosaic_position(header,h):
+    # (y,x) position in the mosaic of the first pixel of an image
+    # with header h, which must be on the same grid
+    return int(round(header['CRPIX2']-h['CRPIX2'])),int(round(header['CRPIX1']-h['CRPIX1']))
+
+def weighted_contribution(r,w,scale,blocks):
+    # return the weighted image r*w and the weights, applying a flux
+    # scale factor if given, working in blocks of rows
+    iw=np.empty(r.shape,dtype=np.float32)
+    wout=np.empty(w.shape,dtype=np.float32)
+    for b0 in range(0,r.shape[0],blocks[0]):
+        b1=min(b0+blocks[0],r.shape[0])
+        rb=r[b0:b1]
+        wb=w[b0:b1]
+        if scale is not None:
+            rb=rb*scale
+            wb=wb/scale**2.0
+        iw[b0:b1]=rb*wb
+        wout[b0:b1]=wb
+    return iw,wout
+
+def add_contribution(isum,wsum,mask,pos,blocks,iw,w,cmask):
+    # add a pointing's weighted image, weights and coverage mask to
+    # the mosaic accumulators at position pos=(y,x), in blocks of rows
+    y0,x0=pos
+    ny,nx=iw.shape
+    for b0 in range(0,ny,blocks[0]):
+        b1=min(b0+blocks[0],ny)
+        isum[y0+b0:y0+b1,x0:x0+nx]+=iw[b0:b1]
+        wsum[y0+b0:y0+b1,x0:x0+nx]+=w[b0:b1]
+        mask[y0+b0:y0+b1,x0:x0+nx]|=cmask[b0:b1]
+
+def file_fingerprint(f):
+    # cheap stand-in for a checksum: size and modification time, plus
+    # the primary header of a FITS file, so that rewriting any input
+    # changes it without the file contents having to be read
+    st=os.stat(f)
+    fp='%i %i' % (st.st_size,st.st_mtime_ns)
+    if f.endswith('.fits'):
+        fp+=' '+fits.getheader(f).tostring()
+    return fp
+
+def contribution_key(files,subheader,imheader,params):
+    # hash identifying a pointing's contribution to a mosaic: the
+    # fingerprints of its input files, the beam, the part of the mosaic
+    # it covers and the parameters that affect the weighting. Only the
+    # geometry of the mosaic header is used: other cards, such as the
+    # HISTORY records of input checksums, change when any field is
+    # reprocessed and would invalidate every saved contribution
+    h=hashlib.sha1()
+    for f in files:
+        h.update((os.path.basename(f)+' '+file_fingerprint(f)+'\n').encode())
+    for k in ('BMAJ','BMIN','BPA'):
+        h.update(repr(imheader.get(k)).encode())
+    h.update(('%i %i ' % (subheader['NAXIS1'],subheader['NAXIS2'])).encode())
+    h.update(WCS(subheader).to_header_string().encode())
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+def load_contribution(filename,key):
+    # saved (weighted image, weights, coverage mask), or None if there
+    # is no saved contribution with this key
+    if not os.path.isfile(filename):
+        return None
+    with fits.open(filename,memmap=False) as hdul:
+        if hdul[0].header.get('MOSKEY')!=key:
+            print('Saved contribution',filename,'is out of date')
+            return None
+        return hdul[0].data,hdul['WEIGHT'].data,hdul['MASK'].data.astype(bool)
+
+def save_contribution(filename,key,subheader,iw,w,cmask):
+    h=subheader.copy()
+    h['MOSKEY']=key
+    hdul=fits.HDUList([fits.PrimaryHDU(header=h,data=iw),
+                       fits.ImageHDU(header=subheader,data=w,name='WEIGHT'),
+                       fits.ImageHDU(header=subheader,data=cmask.astype(np.uint8),name='MASK')])
+    # write under a temporary name so that an interrupted run never
+    # leaves a valid-looking contribution
+    hdul.writeto(filename+'.tmp',overwrite=True)
+    os.rename(filename+'.tmp',filename)
+
+def beam_weight(appdata,intdata,threshold,noise=None):
+    # 1/sigma**2 weights from the apparent and intrinsic images
+    with np.errstate(divide='ignore',invalid='ignore'):
+        w=np.divide(appdata,intdata)
+        w[w<threshold]=0
+    # at this point this is the beam factor: we want 1/sigma**2.0, so divide by noise and square
+    if noise is not None:
+        w/=noise
+    return w**2.0
+
+def astromap_blank(data,wcs,amdata,awcs,bth,boxsize=21):
+    # Blank (set to NaN) the region of data around every astrometry map
+    # pixel whose value exceeds bth. A NaN astromap pixel takes the
+    # value of the one above it. Each pixel blanks a boxsize square
+    # (astromap pix size, with margin) starting at its position in
+    # data. Returns the number of astromap pixels over threshold
+    value=np.array(amdata,dtype=float)
+    nanfix=np.isnan(value[:-1])
+    value[:-1][nanfix]=amdata[1:][nanfix]
+    with np.errstate(invalid='ignore'):
+        y,x=np.nonzero(value>bth)
+    count=len(y)
+    if count==0:
+        return 0
+    ra,dec=awcs.wcs_pix2world(x,y,0)
+    rx,ry=wcs.wcs_world2pix(ra,dec,0)
+    good=np.isfinite(rx) & np.isfinite(ry)
+    rx=np.trunc(rx[good]).astype(int)
+    ry=np.trunc(ry[good]).astype(int)
+    # mark the box corners on a grid padded by boxsize at the low
+    # edges, so that boxes starting off the image are clipped, and then
+    # grow each corner into its box with shifted ORs
+    dmaxy,dmaxx=data.shape
+    good=(rx>-boxsize) & (ry>-boxsize) & (rx<dmaxx) & (ry<dmaxy)
+    corners=np.zeros((dmaxy+boxsize,dmaxx+boxsize),dtype=bool)
+    corners[ry[good]+boxsize,rx[good]+boxsize]=True
+    rows=np.zeros_like(corners)
+    for d in range(boxsize):
+        rows[d:]|=corners[:corners.shape[0]-d]
+    del corners
+    mask=np.zeros_like(rows)
+    for d in range(boxsize):
+        mask[:,d:]|=rows[:,:rows.shape[1]-d]
+    del rows
+    data[mask[boxsize:,boxsize:]]=np.nan
+    return count
+
+def open_image(filename,stokesV=False):
+    # memory-mapped image, flattened to 2D: pixels are only read from
+    # disk when used, and changes to them are not written back
+    hdu=fits.open(filename,memmap=True)
+    if stokesV:
+        hdu[0].data[0][0] = hdu[0].data[0][1]
+    return flatten(hdu)
+
 def make_mosaic(args):
     if args.find_noise and args.read_noise:
         raise RuntimeError('Cannot both find noise and read it')
@@ -165,10 +374,15 @@ def make_mosaic(args):
     if band is not None:
         rootname=('band%i-' % band) + rootname
                 
+    memory=float(args.reproj_memory)*1024**3 if args.reproj_memory else None
+    if args.reproj_block:
+        blocks=(int(args.reproj_block),int(args.reproj_block))
+    else:
+        blocks=(1000,1000)
     if args.exact:
-        reproj=reproject_exact # may not work
+        reproj=partial(reproject_exact_chunk_2d,blocks=blocks,workers=args.ncpu,tmpdir=args.scratch_dir)
     else:
-        reproj=reproject_interp_chunk_2d
+        reproj=partial(reproject_interp_chunk_2d,blocks=blocks,workers=args.ncpu,tmpdir=args.scratch_dir)
 
     if args.do_vlow:
         intname='image_full_vlow_nocut_m.int.restored.fits'
@@ -209,9 +423,12 @@ def make_mosaic(args):
         pass
 
     threshold=float(args.beamcut)
-    hdus=[]
-    app=[]
-    astromaps=[]
+    # only the headers are kept here: each pointing's images are opened
+    # when the main loop gets to it and dropped when it is done
+    headers=[]
+    intfiles=[]
+    appfiles=[]
+    astromapfiles=[]
     wcs=[]
     print('Reading files...')
     noise=[]
@@ -219,7 +436,9 @@ def make_mosaic(args):
     name=[]
     shifts=[]
     polylists=[]
+    regfiles=[]
     badfacets=[]
+    inputfiles=[]
     if args.directories is None:
         raise RuntimeError("At least one directory name must be supplied")
     for d in args.directories:
@@ -232,7 +451,10 @@ def make_mosaic(args):
                 do_convolve(d+'/'+orig_appname,float(args.convolve),d+'/'+appname)
             else:
                 raise RuntimeError('Expected file',infile,'does not exist')
-        hdu=fits.open(infile)
+        hdu=fits.open(infile,memmap=True)
+        files=[infile]
+        inputfiles.append(files)
+        intfiles.append(infile)
 
         if args.convolve:
             if hdu[0].header['BMAJ']*3600.0!=float(args.convolve):
@@ -249,26 +471,25 @@ def make_mosaic(args):
                 noise.append(get_rms(hdu,boxsize=1500))
             else:
                 noise.append(get_rms(hdu))
-        hdus.append(flatten(hdu))
+        headers.append(flatten(hdu).header)
+        hdu.close()
+        del(hdu)
 
         imagefilename=d+'/'+appname
-        print('Reading image file',imagefilename)
-        if args.do_stokesV:
-                tmp = fits.open(imagefilename)
-                tmp[0].data[0][0] = tmp[0].data[0][1]
-                app.append(flatten(tmp))
-        else:
-                app.append(flatten(fits.open(imagefilename)))
+        files.append(imagefilename)
+        appfiles.append(imagefilename)
 
         if bth:
-            astromaps.append(flatten(fits.open(d+'/astromap.fits')))
+            astromapfiles.append(d+'/astromap.fits')
+            files.append(d+'/astromap.fits')
 
         if args.read_noise:
             noisename=d+'/'+appname.replace('.fits','_facetnoise.fits')
             if not os.path.isfile(noisename):
                 g=glob.glob(d+'/*.tessel.reg')
                 get_rms_map3(d+'/'+appname,g[0],noisename,database=False)
-            noisefiles.append(flatten(fits.open(noisename)))
+            noisefiles.append(noisename)
+            files.append(noisename)
         if args.apply_shift or args.facet_only:
             print('Reading the tessel file')
             g=glob.glob(d+'/*.tessel.reg')
@@ -276,10 +497,13 @@ def make_mosaic(args):
                 raise RuntimeError('apply_shift specified but no tessel file present in '+d)
             else:
                 polylists.append(convert_regionfile_to_poly(g[0]))
+                regfiles.append(g[0])
+                files.append(g[0])
             
             if args.apply_shift:
                 print('Reading the shift file and tessel file')
                 t=Table.read(d+'/pslocal-facet_offsets.fits')
+                files.append(d+'/pslocal-facet_offsets.fits')
                 bad=(t['RA_peak']/t['RA_peak_error']<2) | (t['DEC_peak']/t['DEC_peak_error']<2)
                 print('Found',np.sum(bad),'bad fits')
                 if np.all(bad):
@@ -300,6 +524,7 @@ def make_mosaic(args):
         else:
             shifts.append(None)
             polylists.append(None)
+            regfiles.append(None)
 
         if args.use_badfacet:
             badfacetfile=d+'/Badfacets.txt'
@@ -307,6 +532,7 @@ def make_mosaic(args):
                 print('Reading the bad facet file')
                 lines=open(badfacetfile).readlines()
                 bflist=eval(','.join(lines[1].rstrip().split(',')[1:]))
+                files.append(badfacetfile)
                 badfacets.append(bflist)
                 print('Adding',len(bflist),'bad facets')
             else:
@@ -321,19 +547,6 @@ def make_mosaic(args):
             print(t,n)
 
 
-    print('Computing noise/beam factors...')
-    for i in range(len(app)):
-        np.seterr(divide='ignore')
-        app[i].data=np.divide(app[i].data,hdus[i].data)
-        app[i].data[app[i].data<threshold]=0
- # at this point this is the beam factor: we want 1/sigma**2.0, so divide by noise and square
-        if args.noise is not None:
-            app[i].data/=args.noise[i]
-        elif noisefiles:
-            app[i].data/=noisefiles[i].data
-
-        app[i].data=app[i].data**2.0
-
 
     '''
     if args.shift:
@@ -354,45 +567,11 @@ def make_mosaic(args):
                 hdu.header['CRVAL2']-=ddecs[i]/3600.0
     '''
 
-    for i in range(len(app)):
-        wcs.append(WCS(hdus[i].header))
+    for h in headers:
+        wcs.append(WCS(h))
 
-    # astromap blanking
     if bth:
         print('Blanking using astrometry quality maps with threshold',bth,'arcsec')
-        for i in range(len(app)):
-            outname=rootname+'astroblank-'+name[i]+'.fits'
-            if args.load and os.path.isfile(outname):
-                print('Loading previously blanked image')
-                hdu=fits.open(outname)
-                hdus[i].data=hdu[0].data
-            else:
-                print('Blanking image',i)
-                dmaxy,dmaxx=hdus[i].data.shape
-                count=0
-                am=astromaps[i]
-                awcs=WCS(am.header)
-                maxy,maxx=am.data.shape
-                for y in range(maxy):
-                    for x in range(maxx):
-                        value=am.data[y,x]
-                        if np.isnan(value):
-                            if y<maxy-1:
-                                value=am.data[y+1,x]
-                        if value>bth:
-                            ra,dec=[float(f) for f in awcs.wcs_pix2world(x,y,0)]
-                            rx,ry=[int(p) for p in wcs[i].wcs_world2pix(ra,dec,0)]
-                            rxp=rx+21 # astromap pix size, with margin
-                            ryp=ry+21
-                            if rx<0: rx=0
-                            if ry<0: ry=0
-                            if rxp>dmaxx: rxp=dmaxx
-                            if ryp>dmaxy: ryp=dmaxy
-                            hdus[i].data[ry:ryp,rx:rxp]=np.nan
-                            count+=1
-                print('... blanked',count*900.0/3600,'square arcmin')
-                if args.save: hdus[i].writeto(outname,overwrite=True)
-            app[i].data[np.isnan(hdus[i].data)]=np.nan
 
     # If the header is directly passed in, use it
     try:
@@ -431,16 +610,15 @@ def make_mosaic(args):
             xmax=0
             ymin=0
             ymax=0
-            for a,w in zip(app,wcs):
-                ys,xs=np.where(a.data)
-                axmin=xs.min()
-                aymin=ys.min()
-                axmax=xs.max()
-                aymax=ys.max()
-                del(xs)
-                del(ys)
-                print('non-zero',axmin,aymin,axmax,aymax)
-                for x,y in ((axmin,aymin),(axmax,aymin),(axmin,aymax),(axmax,aymax)):
+            for h,w in zip(headers,wcs):
+                # the footprint comes from the image corners and edge
+                # midpoints, so no pixel data needs to be read
+                aymax,axmax=h['NAXIS2']-1,h['NAXIS1']-1
+                axmid=axmax/2.0
+                aymid=aymax/2.0
+                print('image extent',0,0,axmax,aymax)
+                for x,y in ((0,0),(axmax,0),(0,aymax),(axmax,aymax),
+                            (axmid,0),(axmid,aymax),(0,aymid),(axmax,aymid)):
                     ra,dec=[float(f) for f in w.wcs_pix2world(x,y,0)]
                     #print ra,dec
                     nx,ny=[float (f) for f in rwcs.wcs_world2pix(ra,dec,0)]
@@ -470,53 +648,114 @@ def make_mosaic(args):
     # ----------------------------------------
     # mosaic main loop
     # ----------------------------------------
-    isum=np.zeros([ysize,xsize],dtype=np.float32)
-    wsum=np.zeros_like(isum)
-    mask=np.zeros_like(isum,dtype=np.bool)
+    # the accumulators are memory maps of scratch files, so only the
+    # parts of the mosaic being worked on need to be in memory
+    scratch=args.scratch_dir if args.scratch_dir else '.'
+    isum=scratch_array(scratch,(ysize,xsize),np.float32)
+    wsum=scratch_array(scratch,(ysize,xsize),np.float32)
+    mask=scratch_array(scratch,(ysize,xsize),bool)
+    owcs=WCS(header)
+    blocks=reproj.keywords['blocks']
 
     print('now making the mosaic')
-    for i in range(len(hdus)):
+    if args.incremental and args.load:
+        print('Incremental mode: saved reproject/weight images will not be loaded')
+    for i in range(len(headers)):
         print('image',i,'(',name[i],')')
+        bounds=output_bounds(wcs[i],(headers[i]['NAXIS2'],headers[i]['NAXIS1']),owcs,(ysize,xsize))
+        if bounds is None:
+            print('Image does not overlap the mosaic, skipping')
+            continue
+        subheader=sub_header(header,bounds)
+        load=args.load and not args.incremental
+        scale=args.scale[i] if args.scale is not None else None
+        if args.incremental:
+            params=(threshold,scale,args.noise[i] if args.noise is not None else None,bth,
+                    bool(args.exact),bool(args.apply_shift),bool(args.facet_only),bool(args.do_stokesV))
+            key=contribution_key(inputfiles[i],subheader,headers[i],params)
+            contribname=rootname+'contrib-'+name[i]+'.fits'
+            contrib=load_contribution(contribname,key)
+            if contrib is not None:
+                print('Using saved contribution',contribname)
+                add_contribution(isum,wsum,mask,(bounds[0],bounds[2]),blocks,*contrib)
+                continue
+        print('Reading image files',intfiles[i],appfiles[i])
+        hdu_i=open_image(intfiles[i],args.do_stokesV)
+        app_i=open_image(appfiles[i],args.do_stokesV)
+        if bth:
+            outname=rootname+'astroblank-'+name[i]+'.fits'
+            if args.load and os.path.isfile(outname):
+                print('Loading previously blanked image')
+                hdu=fits.open(outname)
+                hdu_i.data=hdu[0].data
+            else:
+                print('Blanking image',i)
+                am=open_image(astromapfiles[i])
+                count=astromap_blank(hdu_i.data,wcs[i],am.data,WCS(am.header),bth)
+                del(am)
+                print('... blanked',count*900.0/3600,'square arcmin')
+                if args.save: hdu_i.writeto(outname,overwrite=True)
+            app_i.data[np.isnan(hdu_i.data)]=np.nan
         outname=rootname+'reproject-'+name[i]+'.fits'
-        if args.load and os.path.exists(outname):
+        if load and os.path.exists(outname):
             print('loading...')
             hdu=fits.open(outname)
             r=hdu[0].data
+            rpos=mosaic_position(header,hdu[0].header)
         else:
             print('reprojecting...')
-            r, footprint = do_reproj_mp(reproj, hdus[i], header, shift=shifts[i],polylist=polylists[i],badfacet=badfacets[i])
+            r, footprint = do_reproj_mp(reproj, hdu_i, subheader, shift=shifts[i],polylist=polylists[i],badfacet=badfacets[i],regfile=regfiles[i],ncpu=args.ncpu,memory=memory)
             r[np.isnan(r)]=0
-            hdu = fits.PrimaryHDU(header=header,data=r)
+            rpos=bounds[0],bounds[2]
+            hdu = fits.PrimaryHDU(header=subheader,data=r)
             if args.save: hdu.writeto(outname,overwrite=True)
         print('weights',i,'(',name[i],')')
         outname=rootname+'weight-'+name[i]+'.fits'
-        if args.load and os.path.exists(outname):
+        if load and os.path.exists(outname):
             print('loading...')
             hdu=fits.open(outname)
             w=hdu[0].data
-            mask|=(w>0)
+            wpos=mosaic_position(header,hdu[0].header)
+            wmask=w>0
         else:
+            print('Computing noise/beam factors...')
+            if args.noise is not None:
+                wdata=beam_weight(app_i.data,hdu_i.data,threshold,noise=args.noise[i])
+            elif noisefiles:
+                wdata=beam_weight(app_i.data,hdu_i.data,threshold,noise=open_image(noisefiles[i]).data)
+            else:
+                wdata=beam_weight(app_i.data,hdu_i.data,threshold)
             print('reprojecting...')
-            w, footprint = do_reproj_mp(reproj, app[i], header, shift=shifts[i],polylist=polylists[i],badfacet=badfacets[i])
-            mask|=~np.isnan(w)
+            w, footprint = do_reproj_mp(reproj, fits.PrimaryHDU(header=app_i.header,data=wdata), subheader, shift=shifts[i],polylist=polylists[i],badfacet=badfacets[i],regfile=regfiles[i],ncpu=args.ncpu,memory=memory)
+            del(wdata)
+            wmask=~np.isnan(w)
             w[np.isnan(w)]=0
-            hdu = fits.PrimaryHDU(header=header,data=w)
+            wpos=bounds[0],bounds[2]
+            hdu = fits.PrimaryHDU(header=subheader,data=w)
             if args.save: hdu.writeto(outname,overwrite=True)
+        if rpos!=wpos or r.shape!=w.shape:
+            raise RuntimeError('Reprojected image and weights for '+name[i]+' cover different regions: remove the saved files and rerun')
+        if scale is not None:
+            print('Applying scale %s to %s'%(scale,name[i]))
+        del(hdu_i,app_i)
+        iw,w=weighted_contribution(r,w,scale,blocks)
+        del(r)
+        if args.incremental:
+            print('Saving contribution',contribname)
+            save_contribution(contribname,key,subheader,iw,w,wmask)
         print('add to mosaic...')
-        if args.scale is not None:
-            print('Applying scale %s to %s'%(args.scale[i],name[i]))
-            r = r*args.scale[i]
-            w /= args.scale[i]**2.0
-        isum+=r*w
-        wsum+=w
+        add_contribution(isum,wsum,mask,rpos,blocks,iw,w,wmask)
+        del(iw,w,wmask)
 
     if not(args.no_write):
-        isum/=wsum
-        # mask now contains True where a non-nan region was present in either map
-        isum[~mask]=np.nan
+        for b0 in range(0,ysize,blocks[0]):
+            b1=min(b0+blocks[0],ysize)
+            isum[b0:b1]/=wsum[b0:b1]
+            # mask now contains True where a non-nan region was present in either map
+            isum[b0:b1][~mask[b0:b1]]=np.nan
         for ch in ('BMAJ', 'BMIN', 'BPA'):
             try:
-                header[ch]=hdus[0].header[ch]
+                header[ch]=headers[0][ch]
             # Exception for Stokes V images which don't have a BMAJ
             except KeyError:
                 print('No entry in header for %s and not creating one'%ch)
@@ -545,6 +784,11 @@ if __name__=='__main__':
     parser.add_argument('--convolve', default=None, help='Resolution in arcsec to convolve to')
     parser.add_argument('--band', dest='band', default=None, help='Band number to mosaic, leave unset for full-bw image')
     parser.add_argument('--exact', dest='exact', action='store_true', help='Do exact reprojection (slow)')
+    parser.add_argument('--ncpu', dest='ncpu', type=int, default=None, help='Number of processes to use for reprojection, default uses all available cores')
+    parser.add_argument('--reproj_memory', dest='reproj_memory', type=float, default=None, help='Memory budget in GB for per-facet reprojection processes, default unlimited')
+    parser.add_argument('--reproj_block', dest='reproj_block', type=int, default=1000, help='Size in pixels of the tiles that images are reprojected in')
+    parser.add_argument('--scratch_dir', dest='scratch_dir', default=None, help='Directory for the temporary files holding the mosaic while it is built, default is the current directory')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='Save each image\'s contribution to the mosaic and reuse it in later runs if its inputs have not changed')
     parser.add_argument('--save', dest='save', action='store_true', help='Save intermediate images')
     parser.add_argument('--load', dest='load', action='store_true', help='Load existing intermediate images')
     parser.add_argument('--noise', dest='noise', type=float, nargs='+', help='UNSCALED Central noise level for weighting: must match numbers of maps')
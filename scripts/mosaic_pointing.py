@@ -208,7 +208,9 @@ if __name__=='__main__':
         print('Resolutions are different:',different)
         print('Some beams are non-circular:',non_circ)
 
-    mos_args=dotdict({'save':True, 'load':True,'exact':False})
+    # each pointing's contribution is saved and only recomputed if its
+    # inputs change, so rebuilding after one field is reprocessed is cheap
+    mos_args=dotdict({'save':False, 'load':False,'exact':False,'incremental':True})
     if args.apply_shift:
         if np.abs(field_dict['gal_b'])<=10:
             mos_args.facet_only=True
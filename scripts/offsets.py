@@ -28,6 +28,9 @@ from scipy.optimize import curve_fit
 import sys
 from scipy.special import gammaln
 from facet_offsets import RegPoly
+from crossmatch_utils import SkyTree,ball_pairs
+from scipy.spatial import cKDTree
+from getcpus import getcpus
 from astropy.io import fits
 from astropy.wcs import WCS
 from find_compact import *
@@ -42,6 +45,89 @@ import sys
 def model(x,norm,sigma,offset,bl,radius=60):
     return bl*np.sqrt(radius**2.0-x**2.0)/radius+norm*np.exp(-(x-offset)**2.0/(2*sigma**2.0))
 
+# Histogram fitting. These are module-level functions rather than
+# methods so that the independent fits for each facet and axis can be
+# farmed out to a process pool; each fit gets its own random seed, so
+# the results do not depend on the number of processes or the order in
+# which the fits finish
+
+def lnprior_walkers(X):
+    # X is (nwalkers,4): gaussian norm, sigma, offset; baseline norm
+    X=np.atleast_2d(X)
+    good=(X[:,0]>=0) & (X[:,3]>=0) & (X[:,1]>=0)
+    good&=(X[:,1]<=5) & (np.abs(X[:,2])<=5)
+    return np.where(good,0.0,-np.inf)
+
+def lnlike_walkers(X,bcenter,h,lnfact=None):
+    # Log-likelihood of the histogram h for every walker in X
+    # (nwalkers,4) in one call. lnfact is gammaln(h+1), which is
+    # constant for a given histogram
+    X=np.atleast_2d(X)
+    if lnfact is None:
+        lnfact=gammaln(h+1)
+    good=(X[:,0]>=0) & (X[:,3]>=0) & (X[:,1]>=0)
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        mv=model(bcenter[None,:],X[:,0:1],X[:,1:2],X[:,2:3],X[:,3:4])
+        # Eq A3 of 3C305 paper; mv is mu, h is n
+        lv=np.sum(h*np.log(mv)-mv-lnfact,axis=1)
+    lv[~good]=-np.inf
+    lv[np.isnan(lv)]=-np.inf
+    return lv
+
+def lnpost_walkers(X,bcenter,h,lnfact):
+    X=np.atleast_2d(X)
+    lp=lnprior_walkers(X)
+    ok=np.isfinite(lp)
+    if np.any(ok):
+        lp[ok]+=lnlike_walkers(X[ok],bcenter,h,lnfact)
+    return lp
+
+def fit_chi2(bcenter,h,seed=None):
+    height=np.median(h)
+    norm=np.max(h)-height
+    peak=bcenter[np.argmax(h)]
+    popt,pcov=curve_fit(model,bcenter,h,[norm,0.5,peak,height],1.0+np.sqrt(h+0.75))
+    return popt,np.sqrt(np.diagonal(pcov)),None
+
+def fit_emcee(bcenter,h,seed=None,nwalkers=24,nsteps=1000,burn=200):
+    import emcee
+    rng=np.random.RandomState(seed)
+    height=np.median(h)
+    norm=np.max(h)-height
+    peak=bcenter[np.argmax(h)]
+    if np.abs(peak)>3.0:
+        peak=0.0
+    ndim=4
+    parms=np.array([norm,0.5,peak,height])+rng.normal(0,1,size=(nwalkers,ndim))*np.array([0.5,0.05,0.1,2.0])
+    for i in (0,1,3):
+        parms[:,i]=np.abs(parms[:,i])
+    lnfact=gammaln(h+1)
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnpost_walkers, args=(bcenter,h,lnfact), vectorize=True)
+    sampler.random_state=rng.get_state()
+
+    sampler.run_mcmc(parms,nsteps)
+    chain=sampler.chain
+    # find initial errors
+    samples=chain[:, burn:, :].reshape((-1, ndim))
+    prange=np.percentile(samples,(10,90),axis=0)
+    # now use only the walkers that didn't get lost
+    wparms=np.mean(chain[:,burn:,:],axis=1)
+    wanted=np.all(wparms>prange[0],axis=1) & np.all(wparms<prange[1],axis=1)
+    chain=chain[wanted, :, :]
+    samplest=chain[:, burn:, :].reshape((-1, ndim)).transpose()
+
+    means=np.mean(samplest,axis=1)
+    errors=np.percentile(samplest,(16,84),axis=1)-means
+    err=(errors[1]-errors[0])/2.0
+    return means,err,chain
+
+fit_methods={'mcmc':fit_emcee,'chi2':fit_chi2}
+
+def fit_histogram(args):
+    # Pool worker: args is (fitmethod,bcenter,h,seed)
+    fitmethod,bcenter,h,seed=args
+    return fit_methods[fitmethod](bcenter,h,seed=seed)
+
 class Offsets(object):
     def __init__(self,prefix,n=45,cellsize=1.5,imroot=None,fitmethod='mcmc',pos=None,offset_type='pixel'):
         # If offset_type='radec' we use the old method. If 'pixel' we
@@ -94,6 +180,9 @@ class Offsets(object):
         self.ddecl=[]
         self.nsources=[]
         self.lofar_table=tf
+        tree=SkyTree(ot['ra'],ot['dec'])
+        ora=np.asarray(ot['ra'],dtype=float)
+        odec=np.asarray(ot['dec'],dtype=float)
         for f in range(self.n):
             t=tf[tf['Facet']==f]
             self.nsources.append(len(t))
@@ -102,31 +191,15 @@ class Offsets(object):
                 self.dral.append(None)
                 self.ddecl.append(None)
                 continue
-            minra=np.min(t['RA'])
-            maxra=np.max(t['RA'])
-            mindec=np.min(t['DEC'])
-            maxdec=np.max(t['DEC'])
-            otf=ot[(ot['ra']>=(minra-sep/60.0)) & (ot['ra']<=(maxra+sep/60.0)) &
-                   (ot['dec']>=(mindec-sep/60.0)) & (ot['dec']<=(maxdec+sep/60.0))]
-            print('Facet %2i has %4i LOFAR sources and %6i comparison sources' % (f,len(t),len(otf)))
-
-            dral=[]
-            ddecl=[]
-
-            for r in t:
-                ra=r['RA']
-                dec=r['DEC']
-                dra=3600.0*(ra-otf['ra'])*np.cos(dec*np.pi/180.0)
-                ddec=3600.0*(dec-otf['dec'])
-                d2d=np.sqrt(dra**2.0+ddec**2.0)
+            # all pairs of LOFAR and comparison sources within sep
+            ti,oi,_=tree.within(t['RA'],t['DEC'],sep*60.0)
+            print('Facet %2i has %4i LOFAR sources and %6i comparison sources' % (f,len(t),len(np.unique(oi))))
 
-                d2dmask = d2d<sep*60.0
-
-                dral+=list(dra[d2dmask])
-                ddecl+=list(ddec[d2dmask])
-
-            self.dral.append((np.array(dral)).flatten())
-            self.ddecl.append((np.array(ddecl)).flatten())
+            ra=np.asarray(t['RA'],dtype=float)[ti]
+            dec=np.asarray(t['DEC'],dtype=float)[ti]
+            # wrap the RA difference, since pairs can straddle RA=0
+            self.dral.append(3600.0*((ra-ora[oi]+180.0)%360.0-180.0)*np.cos(dec*np.pi/180.0))
+            self.ddecl.append(3600.0*(dec-odec[oi]))
 
     def find_offsets_pixel(self,tf,ot,sep=1.0):
         # as find_offset_radec but we convert to pixels (the output
@@ -147,6 +220,9 @@ class Offsets(object):
         w2=self.W.wcs_world2pix(op,0)
         ot['x']=w2[:,0]*self.cellsize
         ot['y']=w2[:,1]*self.cellsize
+        tree=cKDTree(np.array([ot['x'],ot['y']]).T)
+        ox=np.asarray(ot['x'],dtype=float)
+        oy=np.asarray(ot['y'],dtype=float)
         for f in range(self.n):
             t=tf[tf['Facet']==f]
             self.nsources.append(len(t))
@@ -155,31 +231,17 @@ class Offsets(object):
                 self.dral.append(None)
                 self.ddecl.append(None)
                 continue
-            minx=np.min(t['x'])
-            maxx=np.max(t['x'])
-            miny=np.min(t['y'])
-            maxy=np.max(t['y'])
-            otf=ot[(ot['x']>=(minx-sep*60)) & (ot['x']<=(maxx+sep*60)) &
-                   (ot['y']>=(miny-sep*60)) & (ot['y']<=(maxy+sep*60))]
-            print('Facet %2i has %4i LOFAR sources and %6i comparison sources' % (f,len(t),len(otf)))
-
-            dral=[]
-            ddecl=[]
-
-            for r in t:
-                x=r['x']
-                y=r['y']
-                dx=-(x-otf['x']) # for same sense as RA/Dec
-                dy=y-otf['y']
-                d2d=np.sqrt(dx**2.0+dy**2.0)
-
-                d2dmask = d2d<sep*60.0
-
-                dral+=list(dx[d2dmask])
-                ddecl+=list(dy[d2dmask])
-
-            self.dral.append((np.array(dral)).flatten())
-            self.ddecl.append((np.array(ddecl)).flatten())
+            # all pairs of LOFAR and comparison sources within sep
+            x=np.asarray(t['x'],dtype=float)
+            y=np.asarray(t['y'],dtype=float)
+            ti,oi=ball_pairs(tree,np.array([x,y]).T,sep*60.0)
+            dx=-(x[ti]-ox[oi]) # for same sense as RA/Dec
+            dy=y[ti]-oy[oi]
+            d2dmask=np.sqrt(dx**2.0+dy**2.0)<sep*60.0
+            print('Facet %2i has %4i LOFAR sources and %6i comparison sources' % (f,len(t),len(np.unique(oi))))
+
+            self.dral.append(dx[d2dmask])
+            self.ddecl.append(dy[d2dmask])
 
     def save_offsets(self):
         for i in range(self.n):
@@ -194,80 +256,28 @@ class Offsets(object):
             self.ddecl.append(np.load(self.prefix+'/ddec-'+str(i)+'.npy'))
             
     def fit_chi2(self,h):
-        height=np.median(h)
-        norm=np.max(h)-height
-        peak=self.bcenter[np.argmax(h)]
-        popt,pcov=curve_fit(model,self.bcenter,h,[norm,0.5,peak,height],1.0+np.sqrt(h+0.75))
-        return popt,np.sqrt(np.diagonal(pcov))
+        return fit_chi2(self.bcenter,h)[:2]
 
     def lnlike(self,X,h):
-        if X[0]<0 or X[3]<0 or X[1]<0:
-            return -np.inf
-        mv=model(self.bcenter,*X)
-        # Eq A3 of 3C305 paper; mv is mu, h is n
-        lv=h*np.log(mv)-mv-gammaln(h+1)
-        return np.sum(lv)
+        return lnlike_walkers(X,self.bcenter,h)[0]
 
     def lnpost(self,parms,h):
         return self.lnprior(parms)+self.lnlike(parms,h)
 
     def lnprior(self,X):
-        # gaussian norm, sigma, offset; baseline norm
-        if X[0]<0 or X[3]<0 or X[1]<0:
-            return -np.inf
-        if X[1]>5:
-            return -np.inf
-        if np.abs(X[2])>5:
-            return -np.inf
-        #return -np.log(X[0])-np.log(X[3])
-        return 0
-
-    def fit_emcee(self,h):
-        import emcee
-        height=np.median(h)
-        norm=np.max(h)-height
-        peak=self.bcenter[np.argmax(h)]
-        if np.abs(peak)>3.0:
-            peak=0.0
-        nwalkers=24
-        ndim=4
-        parms=[]
-        for i in range(nwalkers):
-            parms.append([norm+np.random.normal(0,0.5),0.5+np.random.normal(0,0.05),peak+np.random.normal(0,0.1),height+np.random.normal(0,2.0)])
-        parms=np.array(parms)
-        for i in (0,1,3):
-            parms[:,i]=np.abs(parms[:,i])
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, self.lnpost, args=(h,))
-        
-        sampler.run_mcmc(parms,1000)
-        chain=sampler.chain
-        # find initial errors
-        samples=chain[:, 200:, :].reshape((-1, ndim))
-        samplest=samples.transpose()
-        prange=np.percentile(samplest,(10,90),axis=1)
-        wanted=[]
-        for k in range(nwalkers):
-            wparms=np.mean(chain[k,200:,:],axis=0)
-            if np.all(wparms>prange[0]) and np.all(wparms<prange[1]):
-                wanted.append(k)
-        
-        # now use only the walkers that didn't get lost
-        chain=chain[wanted, :, :]
-        samples=chain[:, 200:, :].reshape((-1, ndim))
-        samplest=samples.transpose()
+        return lnprior_walkers(X)[0]
 
+    def fit_emcee(self,h,seed=None):
+        means,err,chain=fit_emcee(self.bcenter,h,seed=seed)
         self.chains.append(chain)
-        means=np.mean(samplest,axis=1)
-        errors=np.percentile(samplest,(16,84),axis=1)-means
-        err=(errors[1]-errors[0])/2.0
         return means,err
 
-    def fit_offsets(self,minv=-40,maxv=40,nbins=150):
-        if self.fitmethod=='mcmc':
-            fitfn=self.fit_emcee
-        elif self.fitmethod=='chi2':
-            fitfn=self.fit_chi2
-        else:
+    def fit_offsets(self,minv=-40,maxv=40,nbins=150,ncpu=1,seed=0):
+        # Fit the RA and Dec offset histograms of every facet. The
+        # fits are independent, so they are run in a pool of up to
+        # ncpu processes (None means all available). Fit number k
+        # (facets in order, RA then Dec) uses random seed seed+k
+        if self.fitmethod not in fit_methods:
             raise NotImplementedError('Fit method '+self.fitmethod)
         self.bins=np.linspace(minv,maxv,nbins+1)
         self.bcenter=0.5*(self.bins[:-1]+self.bins[1:])
@@ -277,30 +287,50 @@ class Offsets(object):
         self.dece=[]
         self.rah=[]
         self.dech=[]
+        jobs=[]
         for i in range(self.n):
-            print('Facet',i)
             if self.dral[i] is None:
-                print('Not fitting, no data')
-                self.rar.append([0,0,0,0])
-                self.rae.append([100,100,100,100])
-                self.decr.append([0,0,0,0])
-                self.dece.append([100,100,100,100])
                 self.rah.append(None)
                 self.dech.append(None)
-                pass
             else:
                 h,_=np.histogram(self.dral[i],self.bins)
                 self.rah.append(h)
-                p,perr=fitfn(h)
-                print('RA Offset is ',p[2],'+/-',perr[2])
-                self.rar.append(p)
-                self.rae.append(perr)
+                jobs.append((self.fitmethod,self.bcenter,h,seed+len(jobs)))
                 h,_=np.histogram(self.ddecl[i],self.bins)
                 self.dech.append(h)
-                p,perr=fitfn(h)
-                self.decr.append(p)
-                self.dece.append(perr)
-                print('DEC Offset is ',p[2],'+/-',perr[2])
+                jobs.append((self.fitmethod,self.bcenter,h,seed+len(jobs)))
+
+        if ncpu is None:
+            ncpu=getcpus()
+        ncpu=max(1,min(ncpu,len(jobs)))
+        if ncpu==1:
+            results=[fit_histogram(j) for j in jobs]
+        else:
+            from multiprocessing import Pool
+            pool=Pool(ncpu)
+            try:
+                results=pool.map(fit_histogram,jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        results=iter(results)
+        for i in range(self.n):
+            print('Facet',i)
+            if self.dral[i] is None:
+                print('Not fitting, no data')
+                self.rar.append([0,0,0,0])
+                self.rae.append([100,100,100,100])
+                self.decr.append([0,0,0,0])
+                self.dece.append([100,100,100,100])
+            else:
+                for pl,el,axis in ((self.rar,self.rae,'RA'),(self.decr,self.dece,'DEC')):
+                    p,perr,chain=next(results)
+                    if chain is not None:
+                        self.chains.append(chain)
+                    print(axis,'Offset is ',p[2],'+/-',perr[2])
+                    pl.append(p)
+                    el.append(perr)
                 
         self.rar=np.array(self.rar)
         self.rae=np.array(self.rae)
@@ -441,19 +471,16 @@ class Offsets(object):
         hdus[0].header['CRPIX2']/=factor
         w=WCS(hdus[0].header)
         rmap=np.ones((1,1,yd,xd))*np.nan
-        # this would be faster with use of e.g. PIL
+        errors=np.array([np.sqrt(self.rae[direction,2]**2.0+self.dece[direction,2]**2.0) for direction in self.pli])
+        xv=np.arange(xd)
         for y in range(yd):
             print('.', end=' ')
             sys.stdout.flush()
-            xv=np.arange(xd)
             yv=y*np.ones_like(xv)
             ra,dec,_,_=w.wcs_pix2world(xv,yv,0,0,0)
             dra,ddec=self.r.coordconv(ra,dec)[1]
-            for i,x in enumerate(xv):
-                number=self.r.which_poly(dra[i],ddec[i],convert=False)
-                if number is not None:
-                    direction=self.pli[number]
-                    rmap[0,0,y,x]=np.sqrt(self.rae[direction,2]**2.0+self.dece[direction,2]**2.0)
+            number=self.r.which_polys(dra,ddec)
+            rmap[0,0,y,number>=0]=errors[number[number>=0]]
         print()
         hdus[0].data=rmap
         hdus.writeto(outname,overwrite=True)
@@ -579,7 +606,7 @@ def do_offsets(o,image_root='image_full_ampphase_di_m.NS'):
     report('Finding offsets')
     oo.find_offsets(lofar_l,data)
     report('Fitting offsets')
-    oo.fit_offsets()
+    oo.fit_offsets(ncpu=o.get('NCPU_DDF',1),seed=o.get('seed',0))
     report('Making plots and saving output')
     oo.plot_fits(method+'-fits.pdf')
     oo.plot_chains(method+'-chains.pdf')
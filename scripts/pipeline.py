@@ -31,10 +31,17 @@ if "PYTHONPATH_FIRST" in list(os.environ.keys()) and int(os.environ["PYTHONPATH_
     sys.path = os.environ["PYTHONPATH"].split(":") + sys.path
 import os.path
 from auxcodes import report,run,warn,die,Catcher,dotdict,separator,MSList
+from stages import Stage,run_stages
+from manifest import get_manifest
+from parse_parset import parse_parset
+from pipeline_logging import instrument,set_instrument_file
+from ms_stream import stream_columns,snr_statistics
+from ms_metadata import ms_metadata
 from parset import option_list
 from options import options,print_options
 from shutil import rmtree,move
 import glob
+import re
 import pyrap.tables as pt
 from redo_dppp_di import redo_dppp_di
 from modify_mask import modify_mask
@@ -45,6 +52,9 @@ from pipeline_version import version
 __version__=version()
 import datetime
 import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor,as_completed
+from getcpus import split_cpus
 
 try:
     from killMS.Other import MyPickle
@@ -81,6 +91,32 @@ def logfilename(s,options=None):
     else:
         return None
 
+def solsfile(ms,sols,options):
+    # name of the killMS solutions file sols for an MS
+    SolsDir=options["SolsDir"]
+    if SolsDir is None or SolsDir=="":
+        return ms+'/killMS.'+sols+'.sols.npz'
+    else:
+        MSName=os.path.abspath(ms).split("/")[-1]
+        return os.path.abspath(SolsDir)+"/"+MSName+'/killMS.'+sols+'.sols.npz'
+
+# options that change how a step runs but not what it produces, left
+# out of the command line recorded in the restart manifest
+volatile_options=re.compile(r' --(Parallel-NCPU|NCPU|Cache-Dirty|Cache-PSF|Cache-Dir|Cache-DirWisdomFFTW|DDFCacheDir|Log-Boring|DoBar)[= ]\S+')
+
+def step_done(step,command,inputs,outputs,options):
+    # decide whether a restart can skip a step. Without a restart
+    # manifest this is just whether the outputs exist
+    if not options['restart']:
+        return False
+    if options['restart_manifest'] is None:
+        return all(os.path.isfile(f) for f in outputs)
+    return get_manifest(options['restart_manifest']).check(step,volatile_options.sub('',command),inputs,outputs)
+
+def step_finished(step,command,inputs,outputs,options):
+    if options['restart_manifest'] is not None and not options['dryrun']:
+        get_manifest(options['restart_manifest']).record(step,volatile_options.sub('',command),inputs,outputs)
+
 def get_solutions_timerange(sols):
     print('Reading %s'%sols)
     S=np.load(sols)
@@ -98,6 +134,7 @@ def find_cache_dir(options):
         cache_dir='.'
     return cache_dir
 
+@instrument
 def check_imaging_weight(mslist_name):
 
     # returns a boolean that says whether it did something
@@ -107,17 +144,12 @@ def check_imaging_weight(mslist_name):
     mslist=[s.strip() for s in open(mslist_name).readlines()]
     for ms in mslist:
         try:
-            t = pt.table(ms)
+            columns=ms_metadata(ms)['columns']
         except RuntimeError:
             print('Failed to open table',ms,'-- table may be missing or corrupt')
             error=True
         else:
-            try:
-                dummy=t.getcoldesc('IMAGING_WEIGHT')
-            except RuntimeError:
-                dummy=None
-            t.close()
-            if dummy is not None:
+            if 'IMAGING_WEIGHT' in columns:
                 warn('Table '+ms+' already has imaging weights')
             else:
                 pt.addImagingColumns(ms)
@@ -126,36 +158,6 @@ def check_imaging_weight(mslist_name):
         raise RuntimeError('One or more tables failed to open')
     return result
 
-def parse_parset(parsets,use_headings=False):
-    keywords={}
-    for parset in parsets:
-        if os.path.isfile(parset):
-            break
-    else:
-        parset=None
-    if parset is not None:
-        with open(parset) as infile:
-            lines=infile.readlines()
-        prefix=''
-        for l in lines:
-            bits=l.split()
-            if use_headings and l[0]=='[':
-                prefix=bits[0][1:-1]+'-'
-            if len(bits)>0 and l[0]!='#' and l[0]!='_' and not(l[0].isspace()) and l[0]!='[':
-                if len(bits)>2:
-                    content=bits[2]
-                    if content[0]=='#':
-                        content=''
-                else:
-                    content=None
-                keywords[prefix+bits[0]]=content
-
-        return keywords
-    
-    else:
-        warn('Cannot find parset, some features may not work')
-        return {}
-
 def ddf_shift(imagename,shiftfile,catcher=None,options=None,dicomodel=None,verbose=False):
     if catcher: catcher.check()
     if options is None:
@@ -266,8 +268,7 @@ def ddf_image(imagename,mslist,cleanmask=None,cleanmode='HMP',ddsols=None,applys
         freqs=[]
         mss=[l.rstrip() for l in open(mslist).readlines()]
         for ms in mss:
-            t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
-            freq=t[0]['REF_FREQUENCY']
+            freq=ms_metadata(ms)['ref_frequency']
             if freq not in freqs:
                 freqs.append(freq)
         channels=len(freqs)
@@ -336,7 +337,18 @@ def ddf_image(imagename,mslist,cleanmask=None,cleanmode='HMP',ddsols=None,applys
         
     if phasecenter is not None:
         runcommand += " --Image-PhaseCenterRADEC=[%s,%s]"%(phasecenter[0],phasecenter[1])
-    if options['restart'] and os.path.isfile(fname):
+
+    inputs=[mslist]
+    for f in (cleanmask,clusterfile):
+        if f is not None:
+            inputs.append(f)
+    if use_dicomodel:
+        inputs.append(dicomodel_base+'.DicoModel')
+    if ddsols is not None and applysols is not None:
+        mss=[l.strip() for l in open(mslist).readlines()]
+        for sols in ddsols.strip('[]').split(','):
+            inputs+=[solsfile(ms,sols,options) for ms in mss]
+    if step_done('DDF-'+imagename,runcommand,inputs,[fname],options):
         warn('File '+fname+' already exists, skipping DDF step')
         if verbose:
             print('would have run',runcommand)
@@ -347,9 +359,11 @@ def ddf_image(imagename,mslist,cleanmask=None,cleanmode='HMP',ddsols=None,applys
 
         # Ugly way to see if predict has been already done
         if PredictSettings is not None:
-            fname=os.system("touch %s"%fname)
+            os.system("touch %s"%fname)
+        step_finished('DDF-'+imagename,runcommand,inputs,[fname],options)
     return imagename
         
+@instrument
 def make_external_mask(fname,templatename,use_tgss=True,options=None,extended_use=None,clobber=False,cellsize='cellsize'):
     # cellsize specifies which option value to get this from
     if options is None:
@@ -464,100 +478,139 @@ def killms_data(imagename,mslist,outsols,clusterfile=None,colname='CORRECTED_DAT
     else:
         keywords={}
     
-    # run killms individually on each MS -- allows restart if it failed in the middle
-    filenames=[l.strip() for l in open(mslist,'r').readlines()]
-    for f in filenames:
-        if catcher: catcher.check()
+    def killms_command(f,ncpu):
+        # everything except the DI solution intervals, which may depend on the data
+        runcommand = "kMS.py --MSName %s --SolverType %s --PolMode %s --BaseImageName %s --NIterKF %i --CovQ %f --LambdaKF=%f --NCPU %i --OutSolsName %s --InCol %s"%(f,SolverType,PolMode,imagename,niterkf, CovQ, options['LambdaKF'], ncpu, outsols,colname)
 
-        SolsDir=options["SolsDir"]
-        fname=f
-        if SolsDir is None or SolsDir=="":
-            solname =fname+'/killMS.'+outsols+'.sols.npz'
+        # check for option to stop pdb call and use it if present
+
+        if 'DebugPdb' in keywords:
+            runcommand+=' --DebugPdb=0'
+
+        if robust is None:
+            runcommand+=' --Weighting Natural'
         else:
-            MSName=os.path.abspath(f).split("/")[-1]
-            solname =os.path.abspath(SolsDir)+"/"+MSName+'/killMS.'+outsols+'.sols.npz'
-        checkname=solname
+            runcommand+=' --Weighting Briggs --Robust=%f' % robust
+        if UpdateWeights is not None:
+            runcommand+=' --UpdateWeights=%f' %UpdateWeights
+        if uvrange is not None:
+            if wtuv is not None:
+                runcommand+=' --WTUV=%f --WeightUVMinMax=%f,%f' % (wtuv, uvrange[0], uvrange[1])
+            else:
+                runcommand+=' --UVMinMax=%f,%f' % (uvrange[0], uvrange[1])
+        if options['nobar']:
+            runcommand+=' --DoBar=0'
 
+        runcommand+=' --SolsDir=%s'%options["SolsDir"]
 
+        if PreApplySols:
+            runcommand+=' --PreApplySols=[%s]'%PreApplySols
 
-        #checkname=f+'/killMS.'+outsols+'.sols.npz'
-        if o['restart'] and os.path.isfile(checkname):
+        if DISettings is None:
+            if NChanSols is None:
+                NChanSols_=1 # reproduce old behaviour
+            else:
+                NChanSols_=NChanSols
+            runcommand+=' --NChanSols %i' % NChanSols_
+            runcommand+=' --BeamMode LOFAR'
+            if 'PhasedArrayMode' in keywords: # incompatible change
+                runcommand+=' --PhasedArrayMode=A'
+            else:
+                runcommand+=' --LOFARBeamMode=A'
+            runcommand+=' --DDFCacheDir='+cache_dir
+            if 'BeamAt' in keywords:
+                runcommand+=' --BeamAt=%s'%options['beam_at']
+
+            if clusterfile is not None:
+                runcommand+=' --NodesFile '+clusterfile
+            if dicomodel is not None:
+                runcommand+=' --DicoModel '+dicomodel
+            if EvolutionSolFile is not None:
+                runcommand+=' --EvolutionSolFile '+EvolutionSolFile
+            if dt is not None:
+                runcommand+=' --dt %f' % dt
+        else:
+            runcommand+=" --SolverType %s --PolMode %s --SkyModelCol %s --OutCol %s --ApplyToDir 0"%DISettings
+        return runcommand
 
+    # Clip anyway - on IMAGING_WEIGHT by default
+    if DISettings is not None:
+        ClipCol=DISettings[-1]
+    else:
+        ClipCol=colname
+    rootfilename=outsols.split('/')[-1]
+    inputs=[f for f in (dicomodel,clusterfile) if f is not None]
+
+    # run killms individually on each MS -- allows restart if it failed in the middle
+    filenames=[l.strip() for l in open(mslist,'r').readlines()]
+    todo=[]
+    for f in filenames:
+        checkname=solsfile(f,outsols,options)
+        #checkname=f+'/killMS.'+outsols+'.sols.npz'
+        f_=f.replace("/","_")
+        step='KillMS-'+f_+'_'+rootfilename
+        # the manifest sees the requested DI intervals, not the ones worked out from the data
+        key=killms_command(f,options['NCPU_killms'])
+        if DISettings is not None:
+            key+=' --dt %s --NChanSols %s'%(dt,NChanSols)
+        key+=' ; ClipCal.py --MSName %s --ColName %s'%(f,ClipCol)
+        if step_done(step,key,inputs,[checkname],options):
             warn('Solutions file '+checkname+' already exists, not running killMS step')
-            
         else:
-            runcommand = "kMS.py --MSName %s --SolverType %s --PolMode %s --BaseImageName %s --NIterKF %i --CovQ %f --LambdaKF=%f --NCPU %i --OutSolsName %s --InCol %s"%(f,SolverType,PolMode,imagename,niterkf, CovQ, o['LambdaKF'], o['NCPU_killms'], outsols,colname)
+            todo.append((f,step,key,checkname))
+
+    DI_dt=dt
+    DI_NChanSols=NChanSols
+    if DISettings is not None and len(todo)>0 and (dt is None or NChanSols is None):
+        # solution intervals are worked out from the first MS to be
+        # run and then used for all of them
+        _,_,ModelColName,_=DISettings
+        _,dt_give,_,n_df_give=give_dt_dnu(todo[0][0],
+                                DataCol=colname,
+                                ModelCol=ModelColName,
+                                T=10.,
+                                sample=options['dt_dnu_sample'],
+                                chunksize=options['ms_chunk_rows'])
+        if DI_dt is None:
+            DI_dt=dt_give
+        if DI_NChanSols is None:
+            DI_NChanSols=n_df_give
+
+    # several MSs can be calibrated at once, sharing NCPU_killms
+    njobs,ncpu=split_cpus(min(options['killms_jobs'],max(1,len(todo))),options['NCPU_killms'])
+    quiet=options['quiet'] or njobs>1
+
+    def killms_ms(job):
+        f,step,key,checkname=job
+        if catcher: catcher.check()
 
-            # check for option to stop pdb call and use it if present
-            
-            if 'DebugPdb' in keywords:
-                runcommand+=' --DebugPdb=0'
-                
-            if robust is None:
-                runcommand+=' --Weighting Natural'
-            else:
-                runcommand+=' --Weighting Briggs --Robust=%f' % robust
-            if UpdateWeights is not None:
-                runcommand+=' --UpdateWeights=%f' %UpdateWeights               
-            if uvrange is not None:
-                if wtuv is not None:
-                    runcommand+=' --WTUV=%f --WeightUVMinMax=%f,%f' % (wtuv, uvrange[0], uvrange[1])
-                else:
-                    runcommand+=' --UVMinMax=%f,%f' % (uvrange[0], uvrange[1])
-            if o['nobar']:
-                runcommand+=' --DoBar=0'
+        runcommand=killms_command(f,ncpu)
+        if DISettings is not None:
+            runcommand+=" --dt %f --NChanSols %i"%(DI_dt+1e-4,DI_NChanSols)
+        f_=f.replace("/","_")
+        run(runcommand,dryrun=options['dryrun'],log=logfilename('KillMS-'+f_+'_'+rootfilename+'.log',options=options),quiet=quiet)
 
-            runcommand+=' --SolsDir=%s'%options["SolsDir"]
-            
-            if PreApplySols:
-                runcommand+=' --PreApplySols=[%s]'%PreApplySols
-                
-            if DISettings is None:
-                if NChanSols is None:
-                    NChanSols=1 # reproduce old behaviour
-                runcommand+=' --NChanSols %i' % NChanSols
-                runcommand+=' --BeamMode LOFAR'
-                if 'PhasedArrayMode' in keywords: # incompatible change
-                    runcommand+=' --PhasedArrayMode=A'
-                else:
-                    runcommand+=' --LOFARBeamMode=A'
-                runcommand+=' --DDFCacheDir='+cache_dir
-                if 'BeamAt' in keywords:
-                    runcommand+=' --BeamAt=%s'%options['beam_at']
-
-                if clusterfile is not None:
-                    runcommand+=' --NodesFile '+clusterfile
-                if dicomodel is not None:
-                    runcommand+=' --DicoModel '+dicomodel
-                if EvolutionSolFile is not None:
-                    runcommand+=' --EvolutionSolFile '+EvolutionSolFile
-                if dt is not None:
-                    runcommand+=' --dt %f' % dt
-            else:
-                runcommand+=" --SolverType %s --PolMode %s --SkyModelCol %s --OutCol %s --ApplyToDir 0"%DISettings
-                _,_,ModelColName,_=DISettings
-                _,dt_give,_,n_df_give=give_dt_dnu(f,
-                                        DataCol=colname,
-                                        ModelCol=ModelColName,
-                                        T=10.)
-                if dt is None:
-                    dt=dt_give
-                if NChanSols is None:
-                    NChanSols=n_df_give
-                runcommand+=" --dt %f --NChanSols %i"%(dt+1e-4,NChanSols)
-                
-                
-            rootfilename=outsols.split('/')[-1]
-            f_=f.replace("/","_")
-            run(runcommand,dryrun=o['dryrun'],log=logfilename('KillMS-'+f_+'_'+rootfilename+'.log'),quiet=o['quiet'])
+        runcommand="ClipCal.py --MSName %s --ColName %s"%(f,ClipCol)
+        run(runcommand,dryrun=options['dryrun'],log=logfilename('ClipCal-'+f_+'_'+rootfilename+'.log',options=options),quiet=quiet)
+        step_finished(step,key,inputs,[checkname],options)
 
-            # Clip anyway - on IMAGING_WEIGHT by default
-            if DISettings is not None:
-                ClipCol=DISettings[-1]
-            else:
-                ClipCol=colname
-            runcommand="ClipCal.py --MSName %s --ColName %s"%(f,ClipCol)
-            run(runcommand,dryrun=o['dryrun'],log=logfilename('ClipCal-'+f_+'_'+rootfilename+'.log'),quiet=o['quiet'])
+    if njobs==1:
+        for job in todo:
+            killms_ms(job)
+    else:
+        report('Running killMS on %i MSs, %i at a time with %i CPUs each' % (len(todo),njobs,ncpu))
+        pool=ThreadPoolExecutor(max_workers=njobs)
+        futures=[pool.submit(killms_ms,job) for job in todo]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            # don't start any more MSs, let the running ones finish
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=True)
 
     if MergeSmooth:
         outsols=smooth_solutions(mslist,outsols,catcher=None,dryrun=o['dryrun'],InterpToMSListFreqs=InterpToMSListFreqs,
@@ -728,7 +781,10 @@ def full_clearcache(o,extras=None):
         for mslist in extras:
             clearcache(mslist,o)
 
-def subtract_data(mslist,col1,col2):
+@instrument
+def subtract_data(mslist,col1,col2,options=None):
+    if options is None:
+        options=o # attempt to get global if it exists
     filenames=[l.strip() for l in open(mslist,'r').readlines()]
     for f in filenames:
         print('Subtracting',f)
@@ -736,25 +792,20 @@ def subtract_data(mslist,col1,col2):
         desc=t.getcoldesc(col1)
         desc['name']='SUBTRACTED_DATA'
         t.addcols(desc)
-        d1=t.getcol(col1)
-        d2=t.getcol(col2)
-        t.putcol('SUBTRACTED_DATA',d1-d2)
+        stream_columns(t,[col1,col2],lambda d1,d2: d1-d2,outcol='SUBTRACTED_DATA',chunksize=options['ms_chunk_rows'])
         t.close()
 
-def give_dt_dnu(msname,DataCol="DATA",ModelCol="DI_PREDICT",T=10.):
+@instrument
+def give_dt_dnu(msname,DataCol="DATA",ModelCol="DI_PREDICT",T=10.,sample=1.0,chunksize=1000000):
+    # ModelCol is not needed for the statistics but is kept for
+    # compatibility. sample is the fraction of rows to read
+    t=pt.table(msname+'/SPECTRAL_WINDOW',ack=False)
+    nch=len(t.getcol('CHAN_FREQ')[0])
+    t.close()
     t=pt.table(msname,ack=False)
-    d=t.getcol(DataCol)
     dt_bin_sec=t.getcol("INTERVAL",0,1,1)[0]
-    _,nch,_=d.shape
-    f=t.getcol("FLAG")
-    p=t.getcol(ModelCol)
+    M,S,err=snr_statistics(t,DataCol,chunksize=chunksize,sample=sample)
     t.close()
-    fp=f[:,:,np.array([1,2])]
-    dp=d[:,:,np.array([1,2])]
-    dps=dp[fp==0]
-    da=np.abs(d[:,:,0][f[:,:,0]==0])
-    S=np.std(dps)
-    M=np.mean(da)
     nb=T**2/(M/S)**2
 
     # find the size of the channel step  
@@ -777,6 +828,8 @@ def give_dt_dnu(msname,DataCol="DATA",ModelCol="DI_PREDICT",T=10.):
 
     SNR=np.sqrt(nt_step*nch_step)*M/S
     warn('Using (dt,df)=(%i,%i) for self-cal run of %s with (<|model|>,std)=(%.2f,%.2f) giving SNR=%.2f'%(nt_step,nch_step,msname,M,S,SNR))
+    if err is not None:
+        warn('Approximate 95%% confidence interval on SNR is %.2f -- %.2f'%(SNR-1.96*np.sqrt(nt_step*nch_step)*err,SNR+1.96*np.sqrt(nt_step*nch_step)*err))
     
     return nt_step, nt_step*dt_bin_sec/60.0, nch_step, nch/nch_step
     
@@ -819,7 +872,9 @@ def cubical_data(mslist,
         n_dt,_,n_df,_=give_dt_dnu(ThisMSName,
                                 DataCol=DataColName,
                                 ModelCol=ModelColName,
-                                T=10.)
+                                T=10.,
+                                sample=options['dt_dnu_sample'],
+                                chunksize=options['ms_chunk_rows'])
 
         n_DT=10*n_dt
 
@@ -876,24 +931,25 @@ def ingest_dynspec(obsid='*'):
         
     
 
-def subtract_vis(mslist=None,colname_a="CORRECTED_DATA",colname_b="DATA_SUB",out_colname="DATA_SUB"):
+@instrument
+def subtract_vis(mslist=None,colname_a="CORRECTED_DATA",colname_b="DATA_SUB",out_colname="DATA_SUB",options=None):
     from pyrap.tables import table
+    if options is None:
+        options=o # attempt to get global if it exists
     f=open(mslist)
     mslist=f.readlines()
     mslist=[msname.replace("\n","") for msname in mslist]
     for msname in mslist:
         report('Subtracting: %s = %s - %s'%(out_colname,colname_a,colname_b))
         t=table(msname,readonly=False)
-        d=t.getcol(colname_a)
-        p=t.getcol(colname_b)
-        d-=p
         if out_colname not in t.colnames():
             report('Adding column %s in %s'%(out_colname,msname))
             desc=t.getcoldesc(colname_a)
             desc["name"]=out_colname
             desc['comment']=desc['comment'].replace(" ","_")
             t.addcols(desc)
-        t.putcol(out_colname,d)
+        # out_colname may be colname_b: each block is read before it is overwritten
+        stream_columns(t,[colname_a,colname_b],lambda d,p: d-p,outcol=out_colname,chunksize=options['ms_chunk_rows'])
         t.close()
     
 
@@ -987,7 +1043,7 @@ def subtractOuterSquare(o):
     if o['restart'] and os.path.isfile(FileHasSubtracted):
         warn('File %s already exists, skipping subtract vis step'%FileHasSubtracted)
     else:
-        subtract_vis(mslist=o['full_mslist'],colname_a=colname,colname_b="DATA_SUB",out_colname="DATA_SUB")
+        subtract_vis(mslist=o['full_mslist'],colname_a=colname,colname_b="DATA_SUB",out_colname="DATA_SUB",options=o)
         os.system("touch %s"%FileHasSubtracted)
 
 
@@ -1005,6 +1061,96 @@ def subtractOuterSquare(o):
             reuse_psf=True,dirty_from_resid=False,use_dicomodel=False,
             catcher=catcher)
 
+def make_polcubes(colname,CurrentDDkMSSolName,low_uvrange,low_imsize,ddf_kw,options=None,catcher=None,cthreads=None,flist=None):
+    # returns the list of compression threads started and the files
+    # they compress. If cthreads and flist are given they are appended
+    # to as the threads start, so that the caller can join them even if
+    # this function fails part way through
+    from do_polcubes import do_polcubes
+    if options is None:
+        options=o # attempt to get global if it exists
+    separator('Stokes Q and U cubes')
+    if cthreads is None:
+        cthreads=[]
+    if flist is None:
+        flist=[]
+
+    # low and vlow cubes share the stokes-mslist files and so their
+    # DDF caches, so these must be run one after the other
+    if options['split_polcubes']:
+        cubefiles=['image_full_low_StokesQ.cube.dirty.fits','image_full_low_StokesQ.cube.dirty.corr.fits','image_full_low_StokesU.cube.dirty.fits','image_full_low_StokesU.cube.dirty.corr.fits']
+    else:
+        cubefiles=['image_full_low_QU.cube.dirty.fits','image_full_low_QU.cube.dirty.corr.fits']
+    if options['restart'] and os.path.isfile(cubefiles[0]+'.fz') and os.path.isfile(cubefiles[1]+'.fz'):
+        warn('Compressed low QU cube product exists, not making new images')
+    else:
+        do_polcubes(colname,CurrentDDkMSSolName,low_uvrange,'image_full_low',ddf_kw,beamsize=options['low_psf_arcsec'],imsize=low_imsize,cellsize=options['low_cell'],robust=options['low_robust'],options=options,catcher=catcher)
+        if options['compress_polcubes']:
+            for cubefile in cubefiles:
+                if options['restart'] and os.path.isfile(cubefile+'.fz'):
+                    warn('Compressed cube file '+cubefile+'.fz already exists, not starting compression thread')
+                else:
+                    report('Starting compression thread for '+cubefile)
+                    thread = threading.Thread(target=compress_fits, args=(cubefile,options['fpack_q']))
+                    thread.start()
+                    cthreads.append(thread)
+                    flist.append(cubefile)
+    if options['split_polcubes']:
+        cubefiles=['image_full_vlow_StokesQ.cube.dirty.fits','image_full_vlow_StokesQ.cube.dirty.corr.fits','image_full_vlow_StokesU.cube.dirty.fits','image_full_vlow_StokesU.cube.dirty.corr.fits']
+    else:
+        cubefiles=['image_full_vlow_QU.cube.dirty.fits','image_full_vlow_QU.cube.dirty.corr.fits']
+    if options['restart'] and os.path.isfile(cubefiles[0]+'.fz') and os.path.isfile(cubefiles[1]+'.fz'):
+        warn('Compressed vlow QU cube product exists, not making new images')
+    else:
+        vlow_uvrange=[options['image_uvmin'],1.6]
+        do_polcubes(colname,CurrentDDkMSSolName,vlow_uvrange,'image_full_vlow',ddf_kw,beamsize=options['vlow_psf_arcsec'],imsize=options['vlow_imsize'],cellsize=options['vlow_cell'],robust=options['vlow_robust'],options=options,catcher=catcher)
+        if options['compress_polcubes']:
+            for cubefile in cubefiles:
+                if options['restart'] and os.path.isfile(cubefile+'.fz'):
+                    warn('Compressed cube file '+cubefile+'.fz already exists, not starting compression thread')
+                else:
+                    report('Starting compression thread for '+cubefile)
+                    thread = threading.Thread(target=compress_fits, args=(cubefile,options['fpack_q']))
+                    thread.start()
+                    cthreads.append(thread)
+                    flist.append(cubefile)
+    return cthreads,flist
+
+def stokesv_image(obsid,colname,CurrentDDkMSSolName,uvrange,ddf_kw,options=None,catcher=None):
+    if options is None:
+        options=o # attempt to get global if it exists
+    separator('Stokes V image for %s'%obsid)
+    return ddf_image('image_full_high_stokesV_%s'%obsid,'mslist-%s.txt'%obsid,
+                     cleanmode='SSD',ddsols=CurrentDDkMSSolName,
+                     applysols=options['apply_sols'][6],stokes='IV',
+                     AllowNegativeInitHMP=True,
+                     majorcycles=0,robust=options['final_robust'],
+                     colname=colname,use_dicomodel=False,
+                     uvrange=uvrange,cellsize=options['cellsize'],
+                     peakfactor=0.001,
+                     smooth=True,automask=True,automask_threshold=5,normalization=options['normalize'][2],
+                     options=options,catcher=catcher,**ddf_kw)
+
+def make_dynspec(obsid,colname,CurrentDDkMSSolName,options=None):
+    if options is None:
+        options=o # attempt to get global if it exists
+    separator('Dynamic spectra for %s'%obsid)
+    LastImage="image_full_ampphase_di_m.NS.int.restored.fits"
+    LastImageV="image_full_high_stokesV_%s.dirty.corr.fits"%obsid
+    warn('Running ms2dynspec for obsid %s' % obsid)
+    umslist='mslist-%s.txt' % obsid
+    g=glob.glob('DynSpec*'+obsid+'*')
+    if len(g)>0:
+        warn('DynSpecs results directory %s already exists, skipping DynSpecs' % g[0])
+    else:
+        DicoFacetName="%s.DicoFacet"%LastImage.split(".int.restored.fits")[0]
+        runcommand="ms2dynspec.py --ms %s --data %s --model DD_PREDICT --sols %s --rad 2. --imageI %s --imageV %s --LogBoring %i --SolsDir %s --BeamModel LOFAR --BeamNBand 1 --DicoFacet %s  --noff 100 --nMinOffPerFacet 5 --CutGainsMinMax 0.1,1.5 --SplitNonContiguous 1 --SavePDF 1 --FitsCatalog ${DDF_PIPELINE_CATALOGS}/dyn_spec_catalogue_addedexo_addvlotss.fits"%(umslist,colname,CurrentDDkMSSolName,LastImage,LastImageV,options['nobar'],options["SolsDir"],DicoFacetName)
+
+        if options['bright_threshold'] is not None and os.path.isfile('brightlist.csv'):
+            runcommand+=' --srclist brightlist.csv'
+        run(runcommand,dryrun=options['dryrun'],log=logfilename('ms2dynspec-%s.log'%obsid,options=options),quiet=options['quiet'])
+        if use_database():
+            ingest_dynspec(obsid)
 
 def main(o=None):
     if o is None and MyPickle is not None:
@@ -1109,6 +1255,9 @@ def main(o=None):
                 
     if o['logging'] is not None and not os.path.isdir(o['logging']):
         os.mkdir(o['logging'])
+    if o['logging'] is not None:
+        # per-step resource usage, summarised by analyse_logs.py
+        set_instrument_file(o['logging']+'/instrumentation.jsonl')
        
     # Check imaging weights -- needed before DDF
     new=check_imaging_weight(o['mslist'])
@@ -1828,66 +1977,8 @@ def main(o=None):
     else:
         facet_offset_file=None
             
-    spectral_mslist=None
-    if o['spectral_restored']:
-        import do_spectral_restored
-        separator('Spectral restored images')
-        spectral_mslist=do_spectral_restored.do_spectral_restored(colname,
-                                                  CurrentMaskName,
-                                                  CurrentBaseDicoModelName,
-                                                  CurrentDDkMSSolName,
-                                                  uvrange,
-                                                  ddf_kw,
-                                                  facet_offset_file,
-                                                  options=o,
-                                                  catcher=catcher)
-
-    if o['polcubes']:
-        from do_polcubes import do_polcubes
-        separator('Stokes Q and U cubes')
-        cthreads=[]
-        flist=[]
-
-        if o['split_polcubes']:
-            cubefiles=['image_full_low_StokesQ.cube.dirty.fits','image_full_low_StokesQ.cube.dirty.corr.fits','image_full_low_StokesU.cube.dirty.fits','image_full_low_StokesU.cube.dirty.corr.fits']
-        else:
-            cubefiles=['image_full_low_QU.cube.dirty.fits','image_full_low_QU.cube.dirty.corr.fits']
-        if o['restart'] and os.path.isfile(cubefiles[0]+'.fz') and os.path.isfile(cubefiles[1]+'.fz'):
-            warn('Compressed low QU cube product exists, not making new images')
-        else:
-            do_polcubes(colname,CurrentDDkMSSolName,low_uvrange,'image_full_low',ddf_kw,beamsize=o['low_psf_arcsec'],imsize=low_imsize,cellsize=o['low_cell'],robust=o['low_robust'],options=o,catcher=catcher)
-            if o['compress_polcubes']:
-                for cubefile in cubefiles:
-                    if o['restart'] and os.path.isfile(cubefile+'.fz'):
-                        warn('Compressed cube file '+cubefile+'.fz already exists, not starting compression thread')
-                    else:
-                        report('Starting compression thread for '+cubefile)
-                        thread = threading.Thread(target=compress_fits, args=(cubefile,o['fpack_q']))
-                        thread.start()
-                        cthreads.append(thread)
-                        flist.append(cubefile)
-        if o['split_polcubes']:
-            cubefiles=['image_full_vlow_StokesQ.cube.dirty.fits','image_full_vlow_StokesQ.cube.dirty.corr.fits','image_full_vlow_StokesU.cube.dirty.fits','image_full_vlow_StokesU.cube.dirty.corr.fits']
-        else:
-            cubefiles=['image_full_vlow_QU.cube.dirty.fits','image_full_vlow_QU.cube.dirty.corr.fits']
-        if o['restart'] and os.path.isfile(cubefiles[0]+'.fz') and os.path.isfile(cubefiles[1]+'.fz'):
-            warn('Compressed vlow QU cube product exists, not making new images')
-        else:
-            vlow_uvrange=[o['image_uvmin'],1.6]
-            do_polcubes(colname,CurrentDDkMSSolName,vlow_uvrange,'image_full_vlow',ddf_kw,beamsize=o['vlow_psf_arcsec'],imsize=o['vlow_imsize'],cellsize=o['vlow_cell'],robust=o['vlow_robust'],options=o,catcher=catcher)
-            if o['compress_polcubes']:
-                for cubefile in cubefiles:
-                    if o['restart'] and os.path.isfile(cubefile+'.fz'):
-                        warn('Compressed cube file '+cubefile+'.fz already exists, not starting compression thread')
-                    else:
-                        report('Starting compression thread for '+cubefile)
-                        thread = threading.Thread(target=compress_fits, args=(cubefile,o['fpack_q']))
-                        thread.start()
-                        cthreads.append(thread)
-                        flist.append(cubefile)
-        
     m=MSList(o['full_mslist'])
-    uobsid = set(m.obsids)
+    uobsid = sorted(set(m.obsids))
     
     for obsid in uobsid:
         umslist='mslist-%s.txt' % obsid
@@ -1896,60 +1987,83 @@ def main(o=None):
             for ms,ob in zip(m.mss,m.obsids):
                 if ob==obsid:
                     file.write(ms+'\n')
+
+    if o['do_dynspec'] and o['bright_threshold'] is not None and o['method'] is not None:
+        warn('Finding bright sources from offsets list')
+        from find_bright_offset_sources import find_bright
+        bright_exists=find_bright(cutoff=o['bright_threshold'])
+
+    # The remaining products do not depend on each other (apart from
+    # dynspec needing the Stokes V images) so they are run as a stage
+    # graph, sharing the DDF CPUs if max_parallel_stages is above 1
+    nstages=max(1,o['max_parallel_stages'])
+    so=dict(o)
+    so['NCPU_DDF']=max(1,o['NCPU_DDF']//nstages)
+    stage_cache_dirs=[]
+    def stage_options(name):
+        # stages running at once use the same MSs, so when there can be
+        # more than one they each get their own DDF cache directory
+        if nstages==1:
+            return so
+        sto=dict(so)
+        sto['cache_dir']=os.path.join(find_cache_dir(o),'stage-'+name)
+        if not os.path.isdir(sto['cache_dir']):
+            os.makedirs(sto['cache_dir'])
+        stage_cache_dirs.append(sto['cache_dir'])
+        return sto
+    cthreads=[]
+    flist=[]
+    stages=[]
+    if o['spectral_restored']:
+        import do_spectral_restored
+        stages.append(Stage('spectral',partial(do_spectral_restored.do_spectral_restored,colname,
+                                               CurrentMaskName,
+                                               CurrentBaseDicoModelName,
+                                               CurrentDDkMSSolName,
+                                               uvrange,
+                                               ddf_kw,
+                                               facet_offset_file,
+                                               options=stage_options('spectral'),
+                                               catcher=catcher),
+                            ncpu=so['NCPU_DDF']))
+    if o['polcubes']:
+        stages.append(Stage('polcubes',partial(make_polcubes,colname,CurrentDDkMSSolName,low_uvrange,low_imsize,ddf_kw,options=stage_options('polcubes'),catcher=catcher,cthreads=cthreads,flist=flist),
+                            ncpu=so['NCPU_DDF']))
     if o['stokesv']:
         for obsid in uobsid:
-            separator('Stokes V image for %s'%obsid)
-            ddf_image('image_full_high_stokesV_%s'%obsid,'mslist-%s.txt'%obsid,
-                  cleanmode='SSD',ddsols=CurrentDDkMSSolName,
-                  applysols=o['apply_sols'][6],stokes='IV',
-                  AllowNegativeInitHMP=True,
-                  majorcycles=0,robust=o['final_robust'],
-                  colname=colname,use_dicomodel=False,
-                  uvrange=uvrange,cellsize=o['cellsize'],
-                  peakfactor=0.001,
-                  smooth=True,automask=True,automask_threshold=5,normalization=o['normalize'][2],
-                  catcher=catcher,**ddf_kw)
+            stages.append(Stage('stokesv_'+obsid,partial(stokesv_image,obsid,colname,CurrentDDkMSSolName,uvrange,ddf_kw,options=stage_options('stokesv_'+obsid),catcher=catcher),
+                                outputs=['image_full_high_stokesV_%s.dirty.corr.fits'%obsid],
+                                ncpu=so['NCPU_DDF'],tag='stokesv'))
+    if o['do_dynspec']:
+        for obsid in uobsid:
+            stages.append(Stage('dynspec_'+obsid,partial(make_dynspec,obsid,colname,CurrentDDkMSSolName,options=stage_options('dynspec_'+obsid)),
+                                inputs=['image_full_high_stokesV_%s.dirty.corr.fits'%obsid],
+                                ncpu=so['NCPU_DDF'],tag='dynspec'))
 
-    if o['polcubes'] and o['compress_polcubes']:
-        # cthreads and flist exist
+    try:
+        exited=run_stages(stages,o['NCPU_DDF'],maxjobs=nstages,exitafter=o['exitafter'],catcher=catcher)
+    finally:
+        # compression threads are joined whether or not the stages succeeded
         for thread in cthreads:
             if thread.is_alive():
                 warn('Waiting for a compression thread to finish')
                 thread.join()
-        if o['delete_compressed']:
-            for f in flist:
-                if os.path.isfile(f+'.fz'):
-                    warn('Deleting compressed file %s' % f)
-                    os.remove(f)
-                else:
-                    die('compressed files do not exist, compression must have failed')
-
-    if o['do_dynspec']:
-        separator('Dynamic spectra')
 
-        if o['bright_threshold'] is not None and o['method'] is not None:
-            warn('Finding bright sources from offsets list')
-            from find_bright_offset_sources import find_bright
-            bright_exists=find_bright(cutoff=o['bright_threshold'])
-        LastImage="image_full_ampphase_di_m.NS.int.restored.fits"
-
-        for obsid in uobsid:
-            LastImageV="image_full_high_stokesV_%s.dirty.corr.fits"%obsid
-            warn('Running ms2dynspec for obsid %s' % obsid)
-            umslist='mslist-%s.txt' % obsid
-            g=glob.glob('DynSpec*'+obsid+'*')
-            if len(g)>0:
-                warn('DynSpecs results directory %s already exists, skipping DynSpecs' % g[0])
-            else:
-                DicoFacetName="%s.DicoFacet"%LastImage.split(".int.restored.fits")[0]
-                runcommand="ms2dynspec.py --ms %s --data %s --model DD_PREDICT --sols %s --rad 2. --imageI %s --imageV %s --LogBoring %i --SolsDir %s --BeamModel LOFAR --BeamNBand 1 --DicoFacet %s  --noff 100 --nMinOffPerFacet 5 --CutGainsMinMax 0.1,1.5 --SplitNonContiguous 1 --SavePDF 1 --FitsCatalog ${DDF_PIPELINE_CATALOGS}/dyn_spec_catalogue_addedexo_addvlotss.fits"%(umslist,colname,CurrentDDkMSSolName,LastImage,LastImageV,o['nobar'],o["SolsDir"],DicoFacetName)
-                
-                if o['bright_threshold'] is not None and os.path.isfile('brightlist.csv'):
-                    runcommand+=' --srclist brightlist.csv'
-                run(runcommand,dryrun=o['dryrun'],log=logfilename('ms2dynspec.log'),quiet=o['quiet'])
-                if use_database():
-                    ingest_dynspec(obsid)
+    spectral_mslist=None
+    for s in stages:
+        if s.name=='spectral' and s.done:
+            spectral_mslist=s.result
+        if s.name=='polcubes' and s.done and o['compress_polcubes']:
+            if o['delete_compressed']:
+                for f in flist:
+                    if os.path.isfile(f+'.fz'):
+                        warn('Deleting compressed file %s' % f)
+                        os.remove(f)
+                    else:
+                        die('compressed files do not exist, compression must have failed')
 
+    if exited:
+        stop(2)
 
     if o['compress_ms']:
         separator('Compressing MS for archive -- column '+colname)
@@ -1966,6 +2080,9 @@ def main(o=None):
         if o['polcubes']:
             extras+=glob.glob('stokes-mslist*.txt')
         full_clearcache(o,extras=extras)
+        for d in stage_cache_dirs:
+            if os.path.isdir(d):
+                rmtree(d)
     
     if use_database():
         update_status(None,'Complete',time='end_date',av=4)
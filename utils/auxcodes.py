@@ -8,16 +8,13 @@ from builtins import object
 import numpy as np
 import scipy
 import os
-from pipeline_logging import run_log
-from subprocess import call
+from pipeline_logging import run_log,run_call
 from astropy.io import fits
 from astropy.wcs import WCS
 import signal
 from facet_offsets import RegPoly
-import pyregion
 from surveys_db import use_database,update_status
 from termsize import get_terminal_size_linux
-import multiprocessing as mp
 
 # these are small routines used by more than one part of the pipeline
 
@@ -60,7 +57,7 @@ def run(s,proceed=False,dryrun=False,log=None,quiet=False,database=True):
     report('Running: '+s)
     if not dryrun:
         if log is None:
-            retval=call(s,shell=True)
+            retval=run_call(s)
         else:
             retval=run_log(s,log,quiet)
         if not(proceed) and retval!=0:
@@ -228,16 +225,16 @@ def convert_regionfile_to_poly(inregfile):
     return polystringlist
 
 def get_rms_map(infilename,ds9region,outfilename):
-
+    from facet_labels import get_facet_labels
     polylist = convert_regionfile_to_poly(ds9region)
     hdu=fits.open(infilename)
     hduflat = flatten(hdu)
     map=hdu[0].data
+    labels = get_facet_labels(ds9region,hduflat.header,hduflat.data.shape)
 
-    for direction,ds9region in enumerate(polylist):
-        print(direction,ds9region)
-        r = pyregion.parse(ds9region)
-        manualmask = r.get_mask(hdu=hduflat)
+    for direction,polystring in enumerate(polylist):
+        print(direction,polystring)
+        manualmask = labels==direction
         rmsval = get_rms_array(hdu[0].data[0][0][np.where(manualmask == True)])
         hdu[0].data[0][0][np.where(manualmask == True)] = rmsval
         print('RMS = %s for direction %i'%(rmsval,direction))
@@ -249,16 +246,17 @@ def get_rms_map2(infilename,ds9region,outfilename,**kwargs):
     run(runcommand,log=None,**kwargs)
 
     # Make a per-facet mean
+    from facet_labels import get_facet_labels
     noisefilename = '%s.noise.fits'%infilename
     polylist = convert_regionfile_to_poly(ds9region)
     template=fits.open(infilename) # will be 4D
     hdu=fits.open(noisefilename)
     hduflat = flatten(hdu) # depending on MakeMask version may be 2D or 4D
+    labels = get_facet_labels(ds9region,hduflat.header,hduflat.data.shape)
 
-    for direction,ds9region in enumerate(polylist):
-        print(direction,ds9region)
-        r = pyregion.parse(ds9region)
-        manualmask = r.get_mask(hdu=hduflat)
+    for direction,polystring in enumerate(polylist):
+        print(direction,polystring)
+        manualmask = labels==direction
         rmsval = np.mean(hduflat.data[manualmask])
         hduflat.data[manualmask] = rmsval
         print('RMS = %s for direction %i'%(rmsval,direction))
@@ -266,17 +264,9 @@ def get_rms_map2(infilename,ds9region,outfilename,**kwargs):
     template[0].data[0,0]=hduflat.data
     template.writeto(outfilename,overwrite=True)
 
-def calc_facet_noise(q,hdu,direction,ds9region):
-    print(direction,ds9region)
-    r = pyregion.parse(ds9region)
-    manualmask = r.get_mask(hdu=hdu)
-    rmsval = np.mean(hdu.data[manualmask])
-    facet=np.zeros_like(hdu.data)
-    facet[manualmask]=rmsval
-    q.put((direction,rmsval,facet))
-
-def get_rms_map3(infilename,ds9region,outfilename,**kwargs):
-    # multiproc version of the above
+def get_rms_map3(infilename,ds9region,outfilename,ncpu=None,**kwargs):
+    # multiproc version of the above: ncpu is the maximum number of
+    # worker processes, default all available cores
     # Run MakeMask for a per-pixel noise map
     noisefilename = '%s.noise.fits'%infilename
     if not os.path.isfile(noisefilename):
@@ -286,19 +276,16 @@ def get_rms_map3(infilename,ds9region,outfilename,**kwargs):
         warn('Noise file exists, not making it')
 
     # Make a per-facet mean
+    from facet_labels import get_facet_labels,facet_means
     polylist = convert_regionfile_to_poly(ds9region)
     template=fits.open(infilename) # will be 4D
     hdu=fits.open(noisefilename,memmap=False) # read before going multithreaded
     hduflat = flatten(hdu) # depending on MakeMask version may be 2D or 4D
-    result=np.zeros_like(hduflat.data)
-    q=mp.Queue()
-    for direction,ds9region in enumerate(polylist):
-        p=mp.Process(target=calc_facet_noise,args=(q,hduflat,direction,ds9region))
-        p.start()
-    while mp.active_children():
-        direction,rmsval,facet=q.get()
+    labels = get_facet_labels(ds9region,hduflat.header,hduflat.data.shape)
+    rmsvals = facet_means(hduflat.data,labels,len(polylist),ncpu=ncpu)
+    for direction,rmsval in enumerate(rmsvals):
         print('RMS = %s for direction %i'%(rmsval,direction))
-        result+=facet
+    result=np.where(labels>=0,rmsvals[np.maximum(labels,0)],0).astype(hduflat.data.dtype)
     template[0].data[0,0]=result
     template.writeto(outfilename,overwrite=True)
     
@@ -322,14 +309,12 @@ def sepn(r1,d1,r2,d2):
     return sepn
 
 def getpos(ms):
-    import pyrap.tables as pt
-    t = pt.table(ms+ '/OBSERVATION', readonly=True, ack=False)
-    name=t[0]['LOFAR_TARGET']
-
-    t = pt.table(ms+'/FIELD', readonly=True, ack=False)
-
-    direction = t[0]['PHASE_DIR']
-    ra, dec = direction[0]
+    from ms_metadata import ms_metadata
+    meta=ms_metadata(ms)
+    name=meta['target']
+    if not name:
+        raise RuntimeError('MS '+ms+' has no LOFAR_TARGET in its OBSERVATION table')
+    ra, dec = meta['phase_dir']
 
     if (ra<0):
         ra+=2*np.pi;
@@ -368,6 +353,7 @@ class MSList(object):
         mslist is the MS list filename
         """
         import pyrap.tables as pt
+        from ms_metadata import ms_metadata
         if mss is not None:
             self.mss=mss
             self.mslist=None
@@ -380,23 +366,21 @@ class MSList(object):
         self.hascorrected=[]
         self.dysco=[]
         for ms in self.mss:
-            t = pt.table(ms,readonly=True,ack=False)
-            colname='CORRECTED_DATA'
-            try:
-                dummy=t.getcoldesc(colname)
-            except RuntimeError:
-                dummy=None
-            self.hascorrected.append(not(dummy is None))
-            self.dysco.append('Dysco' in t.showstructure())
-            t.close()
-            t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=False, ack=False)
+            # metadata comes from the on-disk cache where possible
+            meta=ms_metadata(ms)
+            self.hascorrected.append('CORRECTED_DATA' in meta['columns'])
+            self.dysco.append(meta['dysco'])
             # Check freqs due to https://github.com/lofar-astron/DP3/issues/217
-            freqest1 = np.mean(t.getcol('CHAN_FREQ')[0])
-            freqest2 = t[0]['REF_FREQUENCY']
+            freqest1 = np.mean(meta['chan_freq'])
+            freqest2 = meta['ref_frequency']
             if abs(freqest1-freqest2) > 0.1E6:
                 self.freqs.append(freqest1)
                 report('For %s changing ref freq from %s to %s'%(ms,freqest2,freqest1))
+                t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=False, ack=False)
                 t.putcol('REF_FREQUENCY', freqest1)
+                t.close()
+                # the mtime the cache keys on may not have changed
+                ms_metadata(ms,refresh=True)
             else:
                 self.freqs.append(freqest2)
-            self.channels.append(t[0]['CHAN_FREQ'])
+            self.channels.append(np.array(meta['chan_freq']))
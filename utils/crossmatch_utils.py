@@ -6,6 +6,7 @@ from builtins import str
 from builtins import range
 from past.utils import old_div
 import numpy as np
+from scipy.spatial import cKDTree
 
 def bootstrap(data,function,iters):
     result=np.zeros(iters)
@@ -24,14 +25,71 @@ def filter_catalogue(t,c_ra,c_dec,radius):
     r=separation(c_ra,c_dec,t['RA'],t['DEC'])
     return t[r<radius]
 
-def select_isolated_sources(t,radius):
-    t['NN_dist']=np.nan
-    for r in t:
-        dist=3600.0*separation(r['RA'],r['DEC'],t['RA'],t['DEC'])
-        # dist=np.sqrt((np.cos(c_dec*np.pi/180.0)*(t['RA']-r['RA']))**2.0+(t['DEC']-r['DEC'])**2.0)*3600.0
-        dist.sort()
-        r['NN_dist']=dist[1]
+# KD-tree crossmatching. Positions are converted to unit vectors so
+# that the tree works for any part of the sky, including RA=0 and the
+# poles; the chord length between two vectors is converted to and
+# from the angular separation
+
+def radec_to_xyz(ra,dec):
+    # ra, dec in degrees, return an (N,3) array of unit vectors
+    ra=np.radians(np.asarray(ra,dtype=float))
+    dec=np.radians(np.asarray(dec,dtype=float))
+    return np.array([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)]).T
+
+def arcsec_to_chord(radius):
+    return 2.0*np.sin(np.radians(np.asarray(radius,dtype=float)/3600.0)/2.0)
+
+def chord_to_arcsec(chord):
+    return 3600.0*np.degrees(2.0*np.arcsin(np.clip(np.asarray(chord)/2.0,0,1)))
+
+def ball_pairs(tree,points,r):
+    # (qi,ti) for every pair of a query point and a point of the
+    # cKDTree tree that are within r of each other
+    idx=tree.query_ball_point(points,r)
+    counts=np.array([len(l) for l in idx],dtype=int)
+    qi=np.repeat(np.arange(len(points)),counts)
+    ti=np.concatenate([np.asarray(l,dtype=int) for l in idx]) if len(qi) else np.zeros(0,dtype=int)
+    return qi,ti
+
+class SkyTree(object):
+    ''' A KD-tree of sky positions for crossmatching '''
+    def __init__(self,ra,dec):
+        # ra, dec in degrees
+        self.xyz=radec_to_xyz(np.atleast_1d(ra),np.atleast_1d(dec))
+        self.n=len(self.xyz)
+        self.tree=cKDTree(self.xyz)
+
+    def nearest(self,ra,dec,k=1,radius=None):
+        ''' Return (dist,index) for the k nearest neighbours of each
+        position, with dist in arcsec. Where there are fewer than k
+        neighbours (within radius in arcsec, if given) dist is inf and
+        index is the length of the tree '''
+        ub=np.inf if radius is None else arcsec_to_chord(radius)
+        d,i=self.tree.query(radec_to_xyz(np.atleast_1d(ra),np.atleast_1d(dec)),k=k,distance_upper_bound=ub)
+        return np.where(np.isinf(d),np.inf,chord_to_arcsec(np.where(np.isinf(d),0,d))),i
 
+    def within(self,ra,dec,radius):
+        ''' Return (qi,ti,dist) for every pair of a query position and a
+        tree position within radius arcsec of each other: qi indexes the
+        query positions, ti the tree and dist is in arcsec '''
+        xyz=radec_to_xyz(np.atleast_1d(ra),np.atleast_1d(dec))
+        qi,ti=ball_pairs(self.tree,xyz,arcsec_to_chord(radius))
+        dist=chord_to_arcsec(np.sqrt(np.sum((xyz[qi]-self.xyz[ti])**2,axis=1)))
+        return qi,ti,dist
+
+    def count_within(self,ra,dec,radius):
+        ''' Return the number of tree positions within radius arcsec of each query position '''
+        return self.tree.query_ball_point(radec_to_xyz(np.atleast_1d(ra),np.atleast_1d(dec)),arcsec_to_chord(radius),return_length=True)
+
+def nearest_neighbour_distance(ra,dec):
+    # distance in arcsec from each position to the nearest other one
+    if len(ra)<2:
+        return np.full(len(ra),np.inf)
+    d,_=SkyTree(ra,dec).nearest(ra,dec,k=2)
+    return d[:,1]
+
+def select_isolated_sources(t,radius):
+    t['NN_dist']=nearest_neighbour_distance(t['RA'],t['DEC'])
     t=t[t['NN_dist']>radius]
     return t
 
@@ -53,24 +111,31 @@ def match_catalogues(t,tab,radius,label,group=None):
     maxdec=np.max(t['DEC']+rdeg)
     # pre-filter tab, which may be all-sky
     tab=tab[(tab['RA']>minra) & (tab['RA']<maxra) & (tab['DEC']>mindec) & (tab['DEC']<maxdec)]
-    matches=0
-    for r in t:
-        dist=3600.0*separation(r['RA'],r['DEC'],tab['RA'],tab['DEC'])
-        stab=tab[dist<radius]
-        df=dist[dist<radius]
-        if len(stab)==1:
-            # got a unique match
-            matches+=1
-            for i in range(len(oldv)):
-                if oldv[i] in stab.colnames:
-                    r[label+newv[i]]=stab[0][oldv[i]]
-
-            r[label+'_separation']=df[0]
-            r[label+'_dRA']=3600.0*np.cos(np.pi*r['DEC']/180.0)*(r['RA']-stab[0]['RA'])
-            r[label+'_dDEC']=3600.0*(r['DEC']-stab[0]['DEC'])
-
-            if group is not None:
-                r['g_count_'+str(group)]+=1
+    if len(t)==0 or len(tab)==0:
+        return 0
+    ti,tabi,dist=SkyTree(tab['RA'],tab['DEC']).within(t['RA'],t['DEC'],radius)
+    # keep only sources with a unique match
+    count=np.bincount(ti,minlength=len(t))
+    unique=count[ti]==1
+    ti=ti[unique]
+    tabi=tabi[unique]
+    dist=dist[unique]
+    matches=len(ti)
+    if matches==0:
+        return 0
+    for i in range(len(oldv)):
+        if oldv[i] in tab.colnames:
+            t[label+newv[i]][ti]=tab[oldv[i]][tabi]
+
+    ra=np.asarray(t['RA'][ti],dtype=float)
+    dec=np.asarray(t['DEC'][ti],dtype=float)
+    t[label+'_separation'][ti]=dist
+    # wrap the RA difference, since pairs can match across RA=0
+    t[label+'_dRA'][ti]=3600.0*np.cos(np.pi*dec/180.0)*((ra-np.asarray(tab['RA'][tabi],dtype=float)+180.0)%360.0-180.0)
+    t[label+'_dDEC'][ti]=3600.0*(dec-np.asarray(tab['DEC'][tabi],dtype=float))
+
+    if group is not None:
+        t['g_count_'+str(group)][ti]+=1
 
     return matches
                 
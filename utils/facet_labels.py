@@ -0,0 +1,178 @@
+from __future__ import print_function
+from __future__ import absolute_import
+# Rasterise a tessel region file into an integer image giving the
+# facet that each pixel belongs to, so that per-facet masks are just
+# labels==direction rather than one pyregion.get_mask call per facet
+# on the full image. The label images are cached on disk, keyed on
+# the region file contents and the image WCS and shape
+
+import os
+import hashlib
+import numpy as np
+from multiprocessing import get_context
+from astropy.wcs import WCS
+from facet_offsets import RegPoly
+from auxcodes import warn
+from getcpus import getcpus
+
+def fill_polygon(x,y,shape):
+    """
+    Return (ymin,xmin,mask) where mask is a boolean array, covering
+    the bounding box of the polygon with vertices x,y (pixel
+    co-ordinates, 0-based, clipped to an image of the given shape),
+    that is True for pixels whose centres are inside the polygon.
+    Uses the even-odd rule: a pixel is inside if an odd number of
+    edges cross its row to the left of it
+    """
+    ny,nx=shape
+    ymin=max(0,int(np.ceil(np.min(y))))
+    ymax=min(ny-1,int(np.floor(np.max(y))))
+    xmin=max(0,int(np.ceil(np.min(x))))
+    xmax=min(nx-1,int(np.floor(np.max(x))))
+    if ymax<ymin or xmax<xmin:
+        return ymin,xmin,np.zeros((0,0),dtype=bool)
+    x1=np.asarray(x,dtype=float)
+    y1=np.asarray(y,dtype=float)
+    x2=np.roll(x1,-1)
+    y2=np.roll(y1,-1)
+    rows=np.arange(ymin,ymax+1,dtype=float)[:,None]
+    # edges crossing each row, half-open in y so that vertices are counted once
+    cross=(y1[None,:]<=rows)!=(y2[None,:]<=rows)
+    ri,ei=np.nonzero(cross)
+    xc=x1[ei]+(rows[ri,0]-y1[ei])*(x2[ei]-x1[ei])/(y2[ei]-y1[ei])
+    # each crossing toggles the state of every pixel to the right of it
+    col=np.clip(np.floor(xc).astype(int)+1-xmin,0,xmax-xmin+1)
+    toggles=np.zeros((ymax-ymin+1,xmax-xmin+2),dtype=np.int32)
+    np.add.at(toggles,(ri,col),1)
+    mask=(np.cumsum(toggles,axis=1)[:,:-1]%2)==1
+    return ymin,xmin,mask
+
+def make_facet_labels(regfile,header,shape):
+    """
+    Make the label image for an image with the given header and
+    (ny,nx) shape. Pixels take the index of their direction in the
+    same order as convert_regionfile_to_poly, or -1 if they are in no
+    facet
+    """
+    w=WCS(header)
+    if w.naxis>2:
+        w=w.celestial
+    r=RegPoly(regfile,w.wcs.crval[0],w.wcs.crval[1])
+    directions=sorted(set(r.plab_int))
+    dtype=np.int16 if len(directions)<np.iinfo(np.int16).max else np.int32
+    labels=np.full(shape,-1,dtype=dtype)
+    for poly,plab in zip(r.oclist,r.plab_int):
+        a=np.array(poly)
+        x,y=w.wcs_world2pix(a[:,0],a[:,1],0)
+        if not(np.all(np.isfinite(x)) and np.all(np.isfinite(y))):
+            warn('Facet %i has vertices that cannot be converted to pixels, skipping' % plab)
+            continue
+        ymin,xmin,mask=fill_polygon(x,y,shape)
+        ny,nx=mask.shape
+        labels[ymin:ymin+ny,xmin:xmin+nx][mask]=directions.index(plab)
+    return labels
+
+def labels_key(regfile,header,shape):
+    w=WCS(header)
+    if w.naxis>2:
+        w=w.celestial
+    h=hashlib.sha1()
+    with open(regfile,'rb') as f:
+        h.update(f.read())
+    h.update(w.to_header_string().encode())
+    h.update(str(tuple(shape)).encode())
+    return h.hexdigest()
+
+def get_facet_labels(regfile,header,shape=None,cache_dir=None):
+    """
+    Return the label image for regfile on the pixel grid defined by
+    header, reading it from the disk cache if it has already been
+    made. shape defaults to the NAXIS keywords of the header;
+    cache_dir defaults to the directory of the region file. The
+    array returned from the cache is a read-only memory map
+    """
+    if shape is None:
+        shape=(header['NAXIS2'],header['NAXIS1'])
+    if cache_dir is None:
+        cache_dir=os.path.dirname(os.path.abspath(regfile))
+    key=labels_key(regfile,header,shape)
+    cachefile=os.path.join(cache_dir,'%s.labels-%s.npy' % (os.path.basename(regfile),key[:16]))
+    if os.path.isfile(cachefile):
+        try:
+            return np.load(cachefile,mmap_mode='r')
+        except (IOError,ValueError):
+            warn('Cannot read facet label cache %s, remaking it' % cachefile)
+    labels=make_facet_labels(regfile,header,shape)
+    tmpfile=cachefile+'.%i.tmp' % os.getpid()
+    try:
+        with open(tmpfile,'wb') as f:
+            np.save(f,labels)
+        os.rename(tmpfile,cachefile)
+    except (IOError,OSError):
+        warn('Cannot write facet label cache %s' % cachefile)
+        if os.path.isfile(tmpfile):
+            os.unlink(tmpfile)
+    return labels
+
+# Per-facet statistics. The image and label map are module globals
+# when the worker pool is forked, so the workers share them with the
+# parent without copying or attaching any shared memory; each worker
+# reduces blocks of rows to per-facet sums and counts, and only those
+# small vectors are sent back
+
+_shared={}
+
+def block_sums(data,labels,nfacets):
+    good=labels>=0
+    lab=labels[good]
+    sums=np.bincount(lab,weights=data[good],minlength=nfacets)
+    counts=np.bincount(lab,minlength=nfacets)
+    return sums,counts
+
+def _shared_block_sums(args):
+    r0,r1,nfacets=args
+    return block_sums(_shared['data'][r0:r1],_shared['labels'][r0:r1],nfacets)
+
+def facet_means(data,labels,nfacets=None,ncpu=None,rows=1000,min_pixels=2**24):
+    """
+    Return an array of the mean of data over the pixels with each label
+    from 0 to nfacets-1 (NaN for labels with no pixels). ncpu is the
+    maximum number of worker processes (default 4) and rows the number
+    of image rows each one handles at a time. Images with fewer than
+    min_pixels pixels are done in this process, since a pool would
+    cost more than it saves
+    """
+    labels=np.asarray(labels)
+    if nfacets is None:
+        nfacets=int(np.max(labels))+1
+    ny=data.shape[0]
+    blocks=[(r0,min(r0+rows,ny),nfacets) for r0 in range(0,ny,rows)]
+    if ncpu is None:
+        ncpu=min(4,getcpus())
+    if data.size<min_pixels:
+        ncpu=1
+    ncpu=max(1,min(ncpu,len(blocks)))
+    sums=np.zeros(nfacets)
+    counts=np.zeros(nfacets,dtype=np.int64)
+    if ncpu==1:
+        for r0,r1,_ in blocks:
+            s,c=block_sums(data[r0:r1],labels[r0:r1],nfacets)
+            sums+=s
+            counts+=c
+    else:
+        _shared['data']=data
+        _shared['labels']=labels
+        try:
+            pool=get_context('fork').Pool(ncpu)
+            try:
+                for s,c in pool.imap_unordered(_shared_block_sums,blocks):
+                    sums+=s
+                    counts+=c
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _shared.clear()
+    means=np.full(nfacets,np.nan)
+    np.divide(sums,counts,out=means,where=counts>0)
+    return means
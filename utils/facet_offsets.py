@@ -29,6 +29,23 @@ def point_inside_polygon(x,y,poly):
 
     return inside
 
+def points_inside_polygon(x,y,poly):
+    # vectorised version of point_inside_polygon: x and y are arrays
+    # and the result is a boolean array, using the same crossing rule
+    x=np.asarray(x,dtype=float)
+    y=np.asarray(y,dtype=float)
+    inside=np.zeros(x.shape,dtype=bool)
+    n=len(poly)
+    for i in range(n):
+        p1x,p1y=poly[i]
+        p2x,p2y=poly[(i+1) % n]
+        if p1y==p2y:
+            continue
+        crosses=(y>min(p1y,p2y)) & (y<=max(p1y,p2y))
+        xinters=(y-p1y)*(p2x-p1x)/(p2y-p1y)+p1x
+        inside^=crosses & (x<=xinters)
+    return inside
+
 class RegPoly(object):
     ''' Code for manipulating a region file as a list of polygons '''
     def coordconv(self,ra,dec):
@@ -136,6 +153,21 @@ class RegPoly(object):
                 return i
         return None
 
+    def which_polys(self,dra,ddec):
+        ''' Vectorised which_poly for arrays of offset co-ordinates:
+        return the index of the polygon containing each point, or -1 '''
+        dra=np.asarray(dra,dtype=float)
+        ddec=np.asarray(ddec,dtype=float)
+        result=np.full(dra.shape,-1,dtype=int)
+        for i,poly in enumerate(self.clist):
+            # points are assigned to the first polygon that contains them, as in which_poly
+            check=((result<0) & (dra>=self.bbox[i,0]) & (dra<=self.bbox[i,1]) & (ddec>=self.bbox[i,2]) & (ddec<=self.bbox[i,3]))
+            if not np.any(check):
+                continue
+            idx=np.nonzero(check)[0]
+            result[idx[points_inside_polygon(dra[idx],ddec[idx],poly)]]=i
+        return result
+
     def labels_to_integers(self):
         plab_int=[]
         for p in self.plab:
@@ -147,15 +179,9 @@ class RegPoly(object):
 
     def add_facet_labels(self,t):
         ''' Add integer labels to an astropy table t '''
-        facets=[]
         dra,ddec=self.coordconv(np.array(t['RA']),np.array(t['DEC']))[1] # strip units
-        
-        for i in range(len(t)):
-            poly=self.which_poly(dra[i],ddec[i],convert=False)
-            if poly is not None:
-                facets.append(self.plab_int[poly])
-            else:
-                facets.append(-1)
+        poly=self.which_polys(dra,ddec)
+        facets=np.where(poly>=0,np.array(self.plab_int)[np.maximum(poly,0)],-1)
         t['Facet']=facets
         return t
         
@@ -14,3 +14,11 @@ def getcpus():
         return int(slurmcpus)
     else:
         return get_physical_cpus()
+
+def split_cpus(njobs,ncpu=None):
+    # Divide ncpu (default: all available) between njobs concurrent
+    # jobs. Returns the number of jobs to run and the CPUs for each
+    if ncpu is None:
+        ncpu=getcpus()
+    njobs=max(1,min(njobs,ncpu))
+    return njobs,max(1,ncpu//njobs)
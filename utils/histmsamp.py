@@ -21,7 +21,67 @@ def sumdico(rootname):
 
     return np.sum(cmodel)
 
-def find_uvmin(listname,level,colname='CORRECTED_DATA',plot=False,tstep=30):
+def uv_amplitude_max(ms,colname,bins,tstep=30,chunksize=100000):
+    """
+    Return (hmax,counts) for one MS: the maximum Stokes I amplitude
+    (mean over channels) and the number of visibilities in each
+    np.digitize bin of uv distance (km), using every tstep'th unique
+    time of the rows whose first channel and correlation is not
+    flagged. The MS is read chunksize rows at a time. Returns None if
+    too much data is flagged
+    """
+    print('Doing',ms)
+    t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
+    freq = t[0]['REF_FREQUENCY']
+    channels = t[0]['NUM_CHAN']
+    lamb=old_div(3e8,freq)
+    print('Frequency is',freq,'Hz','wavelength is',lamb,'m')
+    t.close()
+    t=pt.table(ms, readonly=True, ack=False)
+    nrows=t.nrows()
+    # first pass: times of the unflagged rows, which are small
+    times=[]
+    for startrow in range(0,nrows,chunksize):
+        nrow=min(chunksize,nrows-startrow)
+        time=t.getcol('TIME',startrow=startrow,nrow=nrow)
+        flag=t.getcolslice('FLAG',[0,0],[0,0],startrow=startrow,nrow=nrow)[:,0,0]
+        times.append(time[~flag])
+    tuniq=np.unique(np.concatenate(times)) if times else np.zeros(0)
+    del(times)
+    print('There are',len(tuniq),'unique times')
+    if len(tuniq)<=tstep:
+        print('Too much data flagged, skipping')
+        t.close()
+        return None
+    tvals=tuniq[::tstep]
+    print('Using',len(tvals),'times')
+    # second pass: per-bin maximum and count
+    nb=len(bins)
+    hmax=np.full(nb,-np.inf)
+    counts=np.zeros(nb,dtype=np.int64)
+    for startrow in range(0,nrows,chunksize):
+        nrow=min(chunksize,nrows-startrow)
+        time=t.getcol('TIME',startrow=startrow,nrow=nrow)
+        flag=t.getcolslice('FLAG',[0,0],[0,0],startrow=startrow,nrow=nrow)[:,0,0]
+        use=~flag & np.isin(time,tvals)
+        if not np.any(use):
+            continue
+        uv=t.getcol('UVW',startrow=startrow,nrow=nrow)[use]/1000.0
+        data=t.getcolslice(colname,[0,0],[channels-1,3],[1,3],startrow=startrow,nrow=nrow)[use] # XX, YY
+        adata=np.mean(np.absolute(data[:,:,0]+data[:,:,1]),axis=1)
+        del(data)
+        bvals=np.digitize(np.sqrt(np.sum(uv**2.0,axis=1)),bins)
+        keep=bvals<nb
+        np.maximum.at(hmax,bvals[keep],adata[keep])
+        counts+=np.bincount(bvals[keep],minlength=nb)
+    t.close()
+    return hmax,counts
+
+def _uv_amplitude_max(args):
+    return uv_amplitude_max(*args)
+
+def find_uvmin(listname,level,colname='CORRECTED_DATA',plot=False,tstep=30,njobs=1,chunksize=100000):
+    # njobs MSs are read at once
 
     if plot:
         import matplotlib.pyplot as plt
@@ -32,54 +92,31 @@ def find_uvmin(listname,level,colname='CORRECTED_DATA',plot=False,tstep=30):
     maxuv=5
     bins=np.linspace(0,5,100)
 
-    bvl=[]
-    avl=[]
-    for ms in mss:
-        print('Doing',ms)
-        t = pt.table(ms+'/SPECTRAL_WINDOW', readonly=True, ack=False)
-        freq = t[0]['REF_FREQUENCY']
-        channels = t[0]['NUM_CHAN']
-        chlist=t[0]['CHAN_FREQ']
-        lamb=old_div(3e8,freq)
-        max=100000
-        print('Frequency is',freq,'Hz','wavelength is',lamb,'m')
-        t.close()
-        t=pt.table(ms, readonly=True, ack=False)
-        newt=pt.taql('select UVW,TIME,'+colname+' from $t where FLAG[0,0]=False')
-        time=newt.getcol('TIME')
-        tuniq=np.unique(time)
-        print('There are',len(tuniq),'unique times')
-        if len(tuniq)<=tstep:
-            print('Too much data flagged, skipping')
-            continue
-        tvals=tuniq[::tstep]
-        print('Using',len(tvals),'times')
-        uv=newt.getcol('UVW')/1000.0
-
-        data=newt.getcol(colname)[:,:,0::3] # XX, YY
-        stokesi=data[:,:,0]+data[:,:,1]
-        adata=np.mean(np.absolute(stokesi),axis=1)
-
-        newt.close()
-        t.close()
-        maxd=0
-        for t in tvals:
-            uvd=np.sqrt(np.sum(uv[time==t]**2.0,axis=1))
-            amp=adata[time==t]
-            bvals=np.digitize(uvd,bins)
-            amps=amp[bvals<len(bins)]
-            fbvals=bvals[bvals<len(bins)]
-            bvl.append(fbvals)
-            avl.append(amps)
-
-    bvl=np.concatenate(bvl)
-    avl=np.concatenate(avl)
+    jobs=[(ms,colname,bins,tstep,chunksize) for ms in mss]
+    njobs=max(1,min(njobs,len(jobs)))
+    if njobs==1:
+        results=[_uv_amplitude_max(j) for j in jobs]
+    else:
+        from multiprocessing import Pool
+        pool=Pool(njobs)
+        try:
+            results=pool.map(_uv_amplitude_max,jobs,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    hmax=np.full(len(bins),-np.inf)
+    counts=np.zeros(len(bins),dtype=np.int64)
+    for r in results:
+        if r is None: continue
+        hmax=np.maximum(hmax,r[0])
+        counts+=r[1]
 
     histv=np.zeros_like(bins)
 
     for i in range(len(bins)-1):
-        if np.sum(bvl==i)==0: continue
-        histv[i]=np.percentile(avl[bvl==i],100.0)
+        if counts[i]==0: continue
+        histv[i]=hmax[i]
         if plot: plt.scatter(0.5*(bins[i]+bins[i+1]),histv[i])
 
     if plot:
@@ -1,13 +1,12 @@
 from __future__ import print_function
 from __future__ import absolute_import
-from builtins import zip
 from astropy.io import fits
 from astropy.wcs import WCS
 from auxcodes import get_rms,get_rms_map3,flatten
+from pipeline_logging import instrument
 import scipy.ndimage as nd
 import numpy as np
 import pyregion
-from scipy.signal import convolve2d
 
 def add_manual_mask(infile,ds9region,outfile):
     hdu=fits.open(infile)
@@ -30,6 +29,7 @@ def merge_mask(in1,in2,outfile):
     hdu1[0].data = (map1 | map2).astype(np.float32)
     hdu1.writeto(outfile,overwrite=True)
 
+@instrument
 def make_extended_mask(infile,fullresfile,rmsthresh=3.0,sizethresh=2500,maxsize=25000,rootname=None,verbose=False,rmsfacet=False,ds9region='image_dirin_SSD_m_c.tessel.reg'):
     ''' infile is the input low-res image, fullresfile is the full-resolution template image, sizethresh the minimum island size in pixels '''
 
@@ -50,24 +50,22 @@ def make_extended_mask(infile,fullresfile,rmsthresh=3.0,sizethresh=2500,maxsize=
     labels, count = nd.label(det)
 
     print('found',count,'islands')
-    #label, counts = np.unique(labels, return_counts=True)
-    label=np.unique(labels)
     counts=np.bincount(labels.flatten())
 
+    # relabel in one pass: keep the labels of the big islands, zero the rest
     big=(counts>sizethresh) & (counts<maxsize)
-    big_regions=label[big]
+    big[0]=False
+    big_regions=np.nonzero(big)[0]
 
     print('Found',len(big_regions),'large islands')
     if verbose: print(counts[big])
 
-    mask=np.zeros_like(det,dtype=int)
-    for l in big_regions:
-        if l: mask+=l*(labels==l)
+    mask=np.where(big[labels],labels,0)
 
     slices=nd.find_objects(mask)
-    big_slices=[slices[i-1] for i in big_regions if i]
+    big_slices=[slices[i-1] for i in big_regions]
     kernel = np.ones((3,3))
-    mask = convolve2d(mask, kernel, mode='same', fillvalue=0)
+    mask = nd.convolve(mask, kernel, mode='constant', cval=0) # same as convolve2d mode='same' for a symmetric kernel
     mask = (mask>1)
     w=WCS(hdu[0].header)
     hdu[0].data[0,0]=mask.astype(np.float32)
@@ -102,21 +100,24 @@ def make_extended_mask(infile,fullresfile,rmsthresh=3.0,sizethresh=2500,maxsize=
             xmaxf=int(pixlim[:,0].max())
             yminf=int(pixlim[:,1].min())
             ymaxf=int(pixlim[:,1].max())
-            xs=np.arange(xminf,xmaxf)
-            ys=np.arange(yminf,ymaxf)
+            # only pixels that are inside both images are used
+            xs=np.arange(max(xminf,0),min(xmaxf,maskf.shape[1]))
+            ys=np.arange(max(yminf,0),min(ymaxf,maskf.shape[0]))
+            if len(xs)==0 or len(ys)==0:
+                continue
             x,y=np.meshgrid(xs,ys)
             x=x.flatten()
             y=y.flatten()
             pix=np.array([x,y,np.zeros_like(x),np.zeros_like(x)]).T
             world=wf.wcs_pix2world(pix,0)
             opix=w.wcs_world2pix(world,0)
-            for xv,yv,op in zip(x,y,opix):
-                try:
-                    if (xv>=0 and yv>=0) and mask[int(op[1]),int(op[0])]>0:
-                        maskf[yv,xv]=1
-                except IndexError:
-                    # catch wcs mismatches or similar
-                    pass
+            good=np.all(np.isfinite(opix[:,:2]),axis=1)
+            ox=np.where(good,opix[:,0],-1).astype(int)
+            oy=np.where(good,opix[:,1],-1).astype(int)
+            good&=(ox>=0) & (ox<mask.shape[1]) & (oy>=0) & (oy<mask.shape[0])
+            hit=np.zeros_like(good)
+            hit[good]=mask[oy[good],ox[good]]>0
+            maskf[y[hit],x[hit]]=1
 
         hduf[0].data[0,0]=maskf.astype(np.float32)
         hduf.writeto(prefix+'mask-high.fits',overwrite=True)
@@ -0,0 +1,109 @@
+from __future__ import print_function
+from __future__ import absolute_import
+# Restart manifest: records, for each pipeline step, a hash of the
+# command line that was run, fingerprints of its input files and
+# checksums of its outputs, so that a restart only skips a step whose
+# products are known to be complete and up to date
+
+import os
+import json
+import hashlib
+import threading
+
+_manifests={}
+_manifests_lock=threading.Lock()
+
+def command_hash(command):
+    return hashlib.sha1(command.encode('utf-8')).hexdigest()
+
+def fingerprint(path):
+    # size and modification time of a file; None if it does not exist
+    try:
+        st=os.stat(path)
+    except OSError:
+        return None
+    if os.path.isdir(path):
+        # e.g. an MS: the size and modification time of the files of
+        # the main table (table.dat and the storage manager files that
+        # hold the data columns), so that rewriting the data is seen.
+        # Subtables are not included
+        fp=[]
+        for name in sorted(os.listdir(path)):
+            if name.startswith('table.'):
+                try:
+                    fst=os.stat(os.path.join(path,name))
+                except OSError:
+                    continue
+                fp.append([name,fst.st_size,fst.st_mtime_ns])
+        return fp
+    return [st.st_size,st.st_mtime]
+
+def checksum(path,blocksize=16*1024*1024):
+    h=hashlib.sha1()
+    with open(path,'rb') as f:
+        while True:
+            block=f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+class RestartManifest(object):
+    """
+    A JSON file of step records. Each record has the command hash,
+    a fingerprint for each input and a fingerprint and checksum for
+    each output. Methods are safe to call from several threads
+    """
+    def __init__(self,filename):
+        self.filename=filename
+        self.lock=threading.Lock()
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.steps=json.load(f)
+        else:
+            self.steps={}
+
+    def check(self,step,command,inputs,outputs):
+        """
+        Return True if step was recorded with the same command line,
+        the inputs are unchanged and the outputs are intact
+        """
+        with self.lock:
+            record=self.steps.get(step)
+        if record is None:
+            return False
+        if record['command']!=command_hash(command):
+            return False
+        if sorted(record['inputs'])!=sorted(inputs) or sorted(record['outputs'])!=sorted(outputs):
+            return False
+        for i in inputs:
+            if fingerprint(i)!=record['inputs'][i]:
+                return False
+        for o in outputs:
+            fp,cs=record['outputs'][o]
+            # cheap test first, then read the file
+            if fingerprint(o)!=fp or checksum(o)!=cs:
+                return False
+        return True
+
+    def record(self,step,command,inputs,outputs):
+        """
+        Record a step that has just completed successfully
+        """
+        record={'command':command_hash(command),
+                'inputs':dict((i,fingerprint(i)) for i in inputs),
+                'outputs':dict((o,[fingerprint(o),checksum(o)]) for o in outputs)}
+        with self.lock:
+            self.steps[step]=record
+            tmpname=self.filename+'.tmp'
+            with open(tmpname,'w') as f:
+                json.dump(self.steps,f,indent=1,sort_keys=True)
+            os.rename(tmpname,self.filename)
+
+def get_manifest(filename):
+    # one RestartManifest object per file for the whole process
+    filename=os.path.abspath(filename)
+    with _manifests_lock:
+        if filename not in _manifests:
+            _manifests[filename]=RestartManifest(filename)
+        return _manifests[filename]
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 from __future__ import division
-from builtins import zip
 from past.utils import old_div
 from astropy.io import fits
 from astropy.table import Table
@@ -22,6 +21,59 @@ def ellipse(x,y,xp,yp,major,minor,angle):
     b=np.power(sina*(xp-x)-cosa*(yp-y),2)
     return (old_div(a,dd))+(old_div(b,DD))
 
+def rasterise_sources(mask,xv,yv,r,radius,ellipse_params=None,budget=2**22):
+    """Set to 1 the pixels of the 2D array mask that are within
+    radius pixels of each position xv,yv, or inside its ellipse for
+    sources flagged in ellipse_params, which is a tuple (do_ellipse,
+    major,minor,pa) of arrays with the axes in pixels. r is the
+    half-size of the box searched around each source.
+
+    Sources are painted in batches: each batch is a stack of
+    equal-sized stamps, tested together, with at most about budget
+    pixels in total. The pixels tested for each source are the same
+    as in the old one-source-at-a-time loop: a grid starting at the
+    (clipped) corner of its box, truncated to integers for indexing
+    """
+    ymax,xmax=mask.shape
+    xv=np.asarray(xv,dtype=float)
+    yv=np.asarray(yv,dtype=float)
+    r=np.broadcast_to(np.asarray(r,dtype=float),xv.shape)
+    cxmin=np.maximum(xv-r-1,0)
+    cxmax=np.minimum(xv+r+1,xmax)
+    cymin=np.maximum(yv-r-1,0)
+    cymax=np.minimum(yv+r+1,ymax)
+    # grid lengths, as np.arange(cmin,cmax,1.0) would give
+    nx=np.maximum(np.ceil(cxmax-cxmin),0).astype(int)
+    ny=np.maximum(np.ceil(cymax-cymin),0).astype(int)
+    side=np.maximum(np.maximum(nx,ny),1)
+    order=np.argsort(side,kind='stable')
+    cap=np.maximum(1,budget//side[order]**2)
+    n=len(order)
+    start=0
+    while start<n:
+        # largest batch whose biggest stamp keeps it within budget
+        ok=cap[start:]>=np.arange(1,n-start+1)
+        end=start+max(1,int(np.argmin(ok)) if not np.all(ok) else n-start)
+        idx=order[start:end]
+        s=side[idx[-1]]
+        k=np.arange(s,dtype=float)
+        X=cxmin[idx,None,None]+k[None,None,:]
+        Y=cymin[idx,None,None]+k[None,:,None]
+        inside=(k[None,None,:]<nx[idx,None,None]) & (k[None,:,None]<ny[idx,None,None])
+        rv=np.sqrt((X+0.5-xv[idx,None,None])**2.0+(Y+0.5-yv[idx,None,None])**2.0)
+        hit=rv<radius
+        if ellipse_params is not None:
+            do_ellipse,major,minor,pa=[np.asarray(v)[idx] for v in ellipse_params]
+            if np.any(do_ellipse):
+                e=np.nonzero(do_ellipse)[0]
+                ellv=ellipse(xv[idx][e,None,None],yv[idx][e,None,None],X[e],Y[e],major[e,None,None],minor[e,None,None],pa[e,None,None])
+                hit[e]=ellv<1.0
+        hit&=inside
+        X=np.broadcast_to(X,hit.shape)[hit].astype(int)
+        Y=np.broadcast_to(Y,hit.shape)[hit].astype(int)
+        mask[Y,X]=1
+        start=end
+
 def modify_mask(infile,outfile,table,radius,fluxlim,save_filtered=None,do_extended=False,cellsize=1.5,pointsize=30.0):
     """Take a pre-existing mask file, in infile: find all entries in FITS
     table table that lie in the map region, and add their positions to
@@ -47,34 +99,17 @@ def modify_mask(infile,outfile,table,radius,fluxlim,save_filtered=None,do_extend
     t=t[filter]
     x=x[filter]
     y=y[filter]
-    for i,(xv,yv) in enumerate(zip(x,y)):
-        do_ellipse=False
-        r=radius
-        if do_extended:
-            # check whether the major axis exceeds a limit
-            major=t[i]['Maj']
-            minor=t[i]['Min']
-            pa=t[i]['PA']
-            if major>pointsize:
-                do_ellipse=True
-                r=major+radius
-                # print 'Doing ellipse with',major,minor,pa
-
-        cxmin=xv-r-1
-        if cxmin<0: cxmin=0
-        cxmax=xv+r+1
-        if cxmax>xmax: cxmax=xmax
-        cymin=yv-r-1
-        if cymin<0: cymin=0
-        cymax=yv+r+1
-        if cymax>ymax: cymax=ymax
-        X, Y = np.meshgrid(np.arange(cxmin,cxmax,1.0), np.arange(cymin,cymax,1.0))
-        if do_ellipse:
-            ellv=ellipse(xv,yv,X,Y,old_div(major,cellsize)+radius*2.0,old_div(minor,cellsize)+radius*2.0,pa)
-            mask[0,0,Y[ellv<1.0].astype(int),X[ellv<1.0].astype(int)]=1
-        else:
-            rv=np.sqrt((X+0.5-xv)**2.0+(Y+0.5-yv)**2.0)
-            mask[0,0,Y[rv<radius].astype(int),X[rv<radius].astype(int)]=1
+    r=np.full(len(t),float(radius))
+    ellipse_params=None
+    if do_extended:
+        # check whether the major axis exceeds a limit
+        major=np.asarray(t['Maj'],dtype=float)
+        minor=np.asarray(t['Min'],dtype=float)
+        pa=np.asarray(t['PA'],dtype=float)
+        do_ellipse=major>pointsize
+        r[do_ellipse]=major[do_ellipse]+radius
+        ellipse_params=(do_ellipse,old_div(major,cellsize)+radius*2.0,old_div(minor,cellsize)+radius*2.0,pa)
+    rasterise_sources(mask[0,0],x,y,r,radius,ellipse_params)
 
     hdu[0].data=(map.astype(int) | mask).astype(np.float32)
     hdu.writeto(outfile,overwrite=True)
@@ -0,0 +1,97 @@
+from __future__ import print_function
+from __future__ import absolute_import
+# Persistent cache of Measurement Set metadata. Each MS's frequencies,
+# channel widths, pointing, target name, time range and column list
+# are read once and stored as JSON in a .ms_metadata directory next
+# to it, keyed on the absolute path of the MS and the modification
+# times of the main table and SPECTRAL_WINDOW, so anything that adds
+# columns or rewrites the frequencies makes the entry stale
+
+import os
+import json
+import numpy as np
+
+CACHE_DIR='.ms_metadata'
+CACHE_VERSION=1
+
+def _table_mtimes(ms):
+    # raises OSError if the MS is missing
+    return [os.stat(os.path.join(ms,'table.dat')).st_mtime,
+            os.stat(os.path.join(ms,'SPECTRAL_WINDOW','table.dat')).st_mtime]
+
+def cache_filename(ms):
+    ms=os.path.abspath(ms.rstrip('/'))
+    return os.path.join(os.path.dirname(ms),CACHE_DIR,os.path.basename(ms)+'.json')
+
+def read_ms_metadata(ms):
+    """
+    Read the metadata of ms from the tables themselves. Raises
+    RuntimeError if the MS cannot be opened
+    """
+    import pyrap.tables as pt
+    meta={}
+    t=pt.table(ms,readonly=True,ack=False)
+    meta['columns']=list(t.colnames())
+    meta['dysco']='Dysco' in t.showstructure()
+    meta['nrows']=t.nrows()
+    t.close()
+    t=pt.table(ms+'/SPECTRAL_WINDOW',readonly=True,ack=False)
+    meta['ref_frequency']=float(t[0]['REF_FREQUENCY'])
+    meta['chan_freq']=np.asarray(t[0]['CHAN_FREQ'],dtype=float).tolist()
+    meta['chan_width']=np.asarray(t[0]['CHAN_WIDTH'],dtype=float).tolist()
+    t.close()
+    t=pt.table(ms+'/FIELD',readonly=True,ack=False)
+    meta['phase_dir']=np.asarray(t[0]['PHASE_DIR'],dtype=float)[0].tolist()
+    t.close()
+    t=pt.table(ms+'/OBSERVATION',readonly=True,ack=False)
+    meta['time_range']=np.asarray(t.getcell('TIME_RANGE',0),dtype=float).tolist()
+    if 'LOFAR_TARGET' in t.colnames():
+        meta['target']=[str(s) for s in t[0]['LOFAR_TARGET']]
+    else:
+        meta['target']=None
+    t.close()
+    return meta
+
+def ms_metadata(ms,refresh=False):
+    """
+    Return a dict of metadata for ms: columns (list of column names),
+    dysco, nrows, ref_frequency, chan_freq and chan_width (Hz),
+    phase_dir (radians), time_range and target (LOFAR_TARGET or
+    None). Uses the on-disk cache if it is up to date, and otherwise
+    reads the tables and updates it. Raises RuntimeError if the MS
+    cannot be opened
+    """
+    ms=ms.rstrip('/')
+    path=os.path.abspath(ms)
+    try:
+        mtimes=_table_mtimes(ms)
+    except OSError:
+        raise RuntimeError('Cannot open measurement set '+ms)
+    cachefile=cache_filename(ms)
+    if not refresh and os.path.isfile(cachefile):
+        try:
+            with open(cachefile) as f:
+                entry=json.load(f)
+            if entry['version']==CACHE_VERSION and entry['path']==path and entry['mtimes']==mtimes:
+                return entry['metadata']
+        except (IOError,OSError,ValueError,KeyError):
+            pass
+    meta=read_ms_metadata(ms)
+    entry={'version':CACHE_VERSION,'path':path,'mtimes':mtimes,'metadata':meta}
+    # written to a unique temporary file and renamed, so that processes
+    # looking at the same MS at once never see a partial entry
+    tmpfile=cachefile+'.%i.tmp' % os.getpid()
+    try:
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            try:
+                os.mkdir(os.path.dirname(cachefile))
+            except OSError:
+                pass # made by someone else
+        with open(tmpfile,'w') as f:
+            json.dump(entry,f)
+        os.rename(tmpfile,cachefile)
+    except (IOError,OSError):
+        # the cache is an optimisation: carry on without it
+        if os.path.isfile(tmpfile):
+            os.unlink(tmpfile)
+    return meta
@@ -0,0 +1,118 @@
+from __future__ import print_function
+from __future__ import absolute_import
+# Row-chunked access to Measurement Set columns, so that operations on
+# whole columns need memory proportional to the chunk size rather than
+# to the size of the MS
+
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+def row_chunks(nrows,chunksize):
+    # (startrow,nrow) pairs covering nrows rows
+    for startrow in range(0,nrows,chunksize):
+        yield startrow,min(chunksize,nrows-startrow)
+
+def stream_columns(t,incols,func,outcol=None,chunksize=1000000,prefetch=True):
+    """
+    Call func with the values of the columns incols for each block
+    of chunksize rows of the open table t. If outcol is given, the
+    return value of func is written to that column for the same rows.
+
+    If prefetch is True the next block is read in a background thread
+    while func runs on the current one, so at most two blocks are in
+    memory at a time. casacore tables are not thread-safe, so table
+    access itself is serialized with a lock and only the computation
+    overlaps with I/O.
+    """
+    lock=threading.Lock()
+    nrows=t.nrows()
+
+    def read(startrow,nrow):
+        with lock:
+            return [t.getcol(c,startrow=startrow,nrow=nrow) for c in incols]
+
+    chunks=list(row_chunks(nrows,chunksize))
+    if not chunks:
+        return
+    pool=ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        if pool is not None:
+            pending=pool.submit(read,*chunks[0])
+        for i,(startrow,nrow) in enumerate(chunks):
+            if pool is not None:
+                data=pending.result()
+                if i+1<len(chunks):
+                    pending=pool.submit(read,*chunks[i+1])
+            else:
+                data=read(startrow,nrow)
+            result=func(*data)
+            del data
+            if outcol is not None:
+                with lock:
+                    t.putcol(outcol,result,startrow=startrow,nrow=nrow)
+            del result
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+def sample_strata(nrows,chunksize,sample=1.0,nstrata=20):
+    # (startrow,nrow) ranges to read. With sample=1 these are just the
+    # chunks of the table. Otherwise the table is split into nstrata
+    # equal strata and a contiguous fraction sample of the rows is read
+    # from the middle of each, so that the whole observation is covered.
+    # A stratum may be longer than chunksize: it is up to the caller to
+    # read it in chunks
+    if sample>=1.0:
+        return list(row_chunks(nrows,chunksize))
+    nstrata=max(1,min(nstrata,nrows))
+    edges=np.linspace(0,nrows,nstrata+1).astype(int)
+    strata=[]
+    for r0,r1 in zip(edges[:-1],edges[1:]):
+        n=max(1,int(np.ceil(sample*(r1-r0))))
+        strata.append((r0+(r1-r0-n)//2,n))
+    return strata
+
+def snr_statistics(t,datacol,chunksize=1000000,sample=1.0,nstrata=20):
+    """
+    Return (M,S,err) for the open MS table t, where M is the mean
+    amplitude of the unflagged first correlation of datacol, S the
+    standard deviation of the unflagged cross-hand correlations and
+    err the standard error of M/S estimated from the scatter between
+    the blocks of rows read (None if only one block is read). sample<1
+    reads only that fraction of the rows, spread over nstrata strata
+    (see sample_strata); in either case the rows are read at most
+    chunksize at a time
+    """
+    blocks=sample_strata(t.nrows(),chunksize,sample,nstrata)
+    n0=np.zeros(len(blocks))
+    s0=np.zeros(len(blocks))
+    n1=np.zeros(len(blocks))
+    s1=np.zeros(len(blocks),dtype=complex)
+    q1=np.zeros(len(blocks))
+    for i,(r0,nr) in enumerate(blocks):
+        for startrow,nrow in row_chunks(nr,chunksize):
+            startrow+=r0
+            d=t.getcol(datacol,startrow=startrow,nrow=nrow)
+            f=t.getcol('FLAG',startrow=startrow,nrow=nrow)
+            a0=np.abs(d[:,:,0][~f[:,:,0]])
+            n0[i]+=a0.size
+            s0[i]+=np.sum(a0,dtype=np.float64)
+            del a0
+            cross=d[:,:,1:3][~f[:,:,1:3]]
+            n1[i]+=cross.size
+            s1[i]+=np.sum(cross,dtype=np.complex128)
+            q1[i]+=np.sum(np.abs(cross)**2.0,dtype=np.float64)
+            del d,f,cross
+    M=np.sum(s0)/np.sum(n0)
+    mean1=np.sum(s1)/np.sum(n1)
+    S=np.sqrt(max(0.0,np.sum(q1)/np.sum(n1)-np.abs(mean1)**2.0))
+    err=None
+    good=(n0>0) & (n1>1)
+    if np.sum(good)>1:
+        bm=s0[good]/n0[good]
+        bs=np.sqrt(np.maximum(0.0,q1[good]/n1[good]-np.abs(s1[good]/n1[good])**2.0))
+        ratio=bm[bs>0]/bs[bs>0]
+        if len(ratio)>1:
+            err=np.std(ratio,ddof=1)/np.sqrt(len(ratio))
+    return M,S,err
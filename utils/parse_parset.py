@@ -0,0 +1,74 @@
+from __future__ import print_function
+from __future__ import absolute_import
+# Reading of the DDFacet and killMS DefaultParset.cfg files, used to
+# find out which options the installed versions support. The parsed
+# option tables are cached for the life of the process, keyed on the
+# file name and modification time, since ddf_image and killms_data
+# may be called hundreds of times in one run
+
+import os
+import threading
+from types import MappingProxyType
+from auxcodes import warn
+
+_cache={}
+_cache_lock=threading.Lock()
+
+def read_parset(parset,use_headings=False):
+    keywords={}
+    with open(parset) as infile:
+        lines=infile.readlines()
+    prefix=''
+    for l in lines:
+        bits=l.split()
+        if use_headings and l[0]=='[':
+            prefix=bits[0][1:-1]+'-'
+        if len(bits)>0 and l[0]!='#' and l[0]!='_' and not(l[0].isspace()) and l[0]!='[':
+            if len(bits)>2:
+                content=bits[2]
+                if content[0]=='#':
+                    content=''
+            else:
+                content=None
+            keywords[prefix+bits[0]]=content
+    return keywords
+
+def parse_parset(parsets,use_headings=False):
+    """
+    Return a read-only mapping of the options in the first file in
+    parsets that exists, or an empty one if none of them do
+    """
+    for parset in parsets:
+        if os.path.isfile(parset):
+            break
+    else:
+        warn('Cannot find parset, some features may not work')
+        return MappingProxyType({})
+
+    key=(os.path.abspath(parset),use_headings)
+    mtime=os.path.getmtime(parset)
+    with _cache_lock:
+        cached=_cache.get(key)
+    if cached is not None and cached[0]==mtime:
+        return cached[1]
+    keywords=MappingProxyType(read_parset(parset,use_headings=use_headings))
+    with _cache_lock:
+        _cache[key]=(mtime,keywords)
+    return keywords
+
+if __name__=='__main__':
+    # micro-benchmark: cost per call with and without the cache. Uses
+    # the installed DDFacet parset, or the file given on the command line
+    import sys
+    import timeit
+    if len(sys.argv)>1:
+        parset=sys.argv[1]
+    else:
+        parset=os.environ['DDF_DIR']+'/DDFacet/DDFacet/Parset/DefaultParset.cfg'
+    n=1000
+    t_read=timeit.timeit(lambda: read_parset(parset,use_headings=True),number=n)/n
+    parse_parset([parset],use_headings=True)
+    t_cached=timeit.timeit(lambda: parse_parset([parset],use_headings=True),number=n)/n
+    print('Options read from %s: %i' % (parset,len(parse_parset([parset],use_headings=True))))
+    print('Uncached: %.1f us per call' % (t_read*1e6))
+    print('Cached:   %.1f us per call (%.0f times faster)' % (t_cached*1e6,t_read/t_cached))
@@ -5,6 +5,14 @@ option_list = ( ( 'machine', 'NCPU_DDF', int, getcpus(),
                   'Number of CPUS to use for DDF'),
                 ( 'machine', 'NCPU_killms', int, getcpus(),
                   'Number of CPUS to use for KillMS' ),
+                ( 'machine', 'killms_jobs', int, 1,
+                  'Number of MSs to calibrate with killMS at once. NCPU_killms is divided between them' ),
+                ( 'machine', 'ms_chunk_rows', int, 1000000,
+                  'Number of MS rows to read at a time when the pipeline itself processes whole MS columns' ),
+                ( 'machine', 'ms_jobs', int, 1,
+                  'Number of MSs to process at once when the pipeline itself processes whole MS columns, e.g. when applying bootstrap corrections. Each uses memory for up to two chunks of ms_chunk_rows rows' ),
+                ( 'machine', 'max_parallel_stages', int, 1,
+                  'Maximum number of independent end-of-run stages (spectral restored images, QU cubes, per-obsid Stokes V images and dynamic spectra) to run at once. NCPU_DDF is divided between them' ),
                 ( 'data', 'mslist', str, None,
                   'Initial measurement set list to use -- must be specified' ),
                 ( 'data', 'full_mslist', str, None,
@@ -18,6 +26,7 @@ option_list = ( ( 'machine', 'NCPU_DDF', int, getcpus(),
                 ( 'solutions', 'sigma_clip', float, 5.0, 'Sigma clip for amplitude outliers'),
                 ( 'solutions', 'dt_very_slow', float, 43.63, 'Time interval for killMS (minutes)' ),
                 ( 'solutions', 'dt_di', float, None, 'Time interval for DI killMS (minutes): auto-selected if None' ),
+                ( 'solutions', 'dt_dnu_sample', float, 1.0, 'Fraction of MS rows read to estimate the SNR used to auto-select DI solution intervals' ),
                 ( 'solutions', 'dt_fast', float, 0.5, 'Time interval for full-bandwidth killMS (minutes)' ),
                 ( 'solutions', 'LambdaKF', float, 0.5, 'Kalman filter lambda for killMS' ),
                 ( 'solutions', 'NIterKF', list, [1, 1, 1, 1, 6, 1, 6], 'Kalman filter iterations for killMS for the 7 killMS steps' ),
@@ -84,13 +93,14 @@ option_list = ( ( 'machine', 'NCPU_DDF', int, getcpus(),
                 ( 'control', 'logging', str, 'logs', 'Name of directory to save logs to, or \'None\' for no logging' ),
                 ( 'control', 'dryrun', bool, False, 'If True, don\'t run anything, just print what would be run' ),
                 ( 'control', 'restart', bool, True, 'If True, skip steps that would re-generate existing files' ),
+                ( 'control', 'restart_manifest', str, None, 'JSON file recording the command line, input file fingerprints and output checksums of each DDF and killMS step. If set, restart only skips a step when all three match' ),
                 ( 'control', 'cache_dir', str, None, 'Directory for ddf cache files -- default is working directory'),
                 ( 'control', 'clearcache', bool, True, 'If True, clear all DDF cache before running' ),
                 ( 'control', 'clearcache_end', bool, True, 'If True, clear all DDF cache at successful end of the pipeline' ),
                 ( 'control', 'skip_di', bool, False, 'If True, skip the DI calibration steps' ),
                 ( 'control', 'bootstrap', bool, False, 'If True, do bootstrap' ),
                 ( 'control', 'catch_signal', bool, True, 'If True, catch SIGUSR1 as graceful exit signal -- stops when control returns to the pipeline.'),
-                ( 'control', 'exitafter', str, None, 'Step to exit after -- cleanup, dirin, dirin_di, bootstrap, phase, ampphase, fulllow'),
+                ( 'control', 'exitafter', str, None, 'Step to exit after -- cleanup, initial, dirin, dirin_di, bootstrap, phase, ampphase, ampphase_di, fullampphase, fulllow, spectral, polcubes, stokesv, dynspec'),
                 ( 'control', 'redofrom', str, None, 'Step to redo from after -- start or dirin'),
                 ( 'control', 'archive_dir', str, 'old', 'Directory to archive to if redofrom is set'),
                 ( 'control', 'msss_mode', bool, False, 'Work in "MSSS mode" where a smooth beam and spectral cube are computed in the ampphase1 step' ),
@@ -114,6 +124,7 @@ option_list = ( ( 'machine', 'NCPU_DDF', int, getcpus(),
                 ( 'offsets', 'method', str, None, 'Offset correction method to use. None -- no correction'),
                 ( 'offsets', 'fit', str, 'mcmc', 'Histogram fit method' ),
                 ( 'offsets', 'mode', str, 'normal', 'Mode of operation: normal or test' ),
+                ( 'offsets', 'seed', int, 0, 'Base random seed for the MCMC offset fits, so that reruns give the same offsets' ),
                 ( 'spectra', 'do_dynspec', bool, False, 'Do dynamic spectra'),
                 ( 'spectra', 'bright_threshold', float, 1.0, 'Threshold for auto-selection of bright sources'),
                 ( 'inputmodel',  'basedicomodel',str,None,'Input dicomodel for calibration'),
@@ -3,13 +3,126 @@
 from __future__ import print_function
 import subprocess
 import sys
+import os
 import select
 import datetime
+import time
+import json
+import resource
+import threading
+from contextlib import contextmanager
+from functools import wraps
+import psutil
+
+# Instrumentation: if an instrumentation file is set, every command run
+# through run_log or run_call, and every block wrapped in
+# instrumented(), appends one JSON line with its wall time, CPU time,
+# peak RSS, bytes read and written, number of child processes and
+# return value (subprocesses) or success flag (Python blocks)
+
+_instrument_file=None
+_instrument_lock=threading.Lock()
+# per-thread stack of the child process counts of the open
+# instrumented() blocks, so that each block counts only the
+# subprocesses started from its own thread
+_blocks=threading.local()
+
+def set_instrument_file(filename):
+    global _instrument_file
+    _instrument_file=filename
+
+def record_stage(record):
+    if _instrument_file is None:
+        return
+    with _instrument_lock:
+        with open(_instrument_file,'a') as f:
+            f.write(json.dumps(record)+'\n')
+
+class ChildSampler(object):
+    """
+    Keep track of the descendants of a process by sampling them in
+    a background thread. Very short-lived children may be missed
+    """
+    def __init__(self,pid,interval=1.0):
+        self.pid=pid
+        self.interval=interval
+        self.seen=set()
+        self.stopped=threading.Event()
+        self.thread=threading.Thread(target=self.sample)
+        self.thread.daemon=True
+        self.thread.start()
+    def sample(self):
+        while True:
+            try:
+                for c in psutil.Process(self.pid).children(recursive=True):
+                    self.seen.add(c.pid)
+            except psutil.Error:
+                pass
+            if self.stopped.wait(self.interval):
+                break
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return len(self.seen)
+
+def _record_rusage(stage,rtype,command,start,wall,ru,children,status):
+    # status is the return value for a subprocess and a success flag
+    # for a Python block
+    record={'stage':stage,
+            'type':rtype,
+            'command':command,
+            'start':'{:%Y-%m-%d %H:%M:%S}'.format(start),
+            'wall':wall,
+            'cpu_user':ru.ru_utime,
+            'cpu_system':ru.ru_stime,
+            'maxrss_kb':ru.ru_maxrss,
+            'read_bytes':ru.ru_inblock*512,
+            'write_bytes':ru.ru_oublock*512,
+            'children':children}
+    if rtype=='python':
+        record['success']=status
+    else:
+        record['retval']=status
+    record_stage(record)
+
+def _add_children(n):
+    for counts in getattr(_blocks,'stack',[]):
+        counts[0]+=n
+
+def _wait(proc,stage,command,start,t0,sampler):
+    # reap the child with wait4 to get the resources used by it and
+    # every descendant it waited for
+    _,status,ru=os.wait4(proc.pid,0)
+    if os.WIFSIGNALED(status):
+        proc.returncode=-os.WTERMSIG(status)
+    else:
+        proc.returncode=os.WEXITSTATUS(status)
+    # the shell itself counts as one of the children
+    children=sampler.stop()+1
+    _add_children(children)
+    _record_rusage(stage,'subprocess',command,start,time.time()-t0,ru,children,proc.returncode)
+    return proc.returncode
+
+def run_call(cmd,stage=None):
+    # like subprocess.call(cmd,shell=True), but instrumented
+    if stage is None:
+        stage=cmd.split()[0] if cmd.strip() else cmd
+    start=datetime.datetime.now()
+    t0=time.time()
+    proc=subprocess.Popen(cmd, shell=True)
+    sampler=ChildSampler(proc.pid)
+    return _wait(proc,stage,cmd,start,t0,sampler)
 
 def run_log(cmd,logfile,quiet=False):
+    stage=os.path.basename(logfile)
+    if stage.endswith('.log'):
+        stage=stage[:-4]
     logfile = open(logfile, 'w')
     logfile.write('Running process with command: '+cmd+'\n')
+    start=datetime.datetime.now()
+    t0=time.time()
     proc=subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,universal_newlines=True)
+    sampler=ChildSampler(proc.pid)
     while True:
         try:
             select.select([proc.stdout],[],[proc.stdout])
@@ -23,10 +136,54 @@ def run_log(cmd,logfile,quiet=False):
         ts='{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
         logfile.write(ts+': '+line)
         logfile.flush()
-    retval=proc.wait()
+    retval=_wait(proc,stage,cmd,start,t0,sampler)
     logfile.write('Process terminated with return value %i\n' % retval)
     return retval
 
+class _RUsageDiff(object):
+    def __init__(self,ru0,ru1):
+        self.ru_utime=ru1.ru_utime-ru0.ru_utime
+        self.ru_stime=ru1.ru_stime-ru0.ru_stime
+        self.ru_maxrss=ru1.ru_maxrss
+        self.ru_inblock=ru1.ru_inblock-ru0.ru_inblock
+        self.ru_oublock=ru1.ru_oublock-ru0.ru_oublock
+
+@contextmanager
+def instrumented(stage):
+    """
+    Record the resources used by a block of Python code. children is
+    the number of processes started through run_log or run_call from
+    this thread during the block, including their descendants. CPU
+    time and I/O are for the whole pipeline process over the block,
+    and peak RSS is the process peak so far, so when stages run
+    concurrently in other threads these include their usage too.
+    success is True if the block finished without an exception
+    """
+    start=datetime.datetime.now()
+    t0=time.time()
+    ru0=resource.getrusage(resource.RUSAGE_SELF)
+    counts=[0]
+    if not hasattr(_blocks,'stack'):
+        _blocks.stack=[]
+    _blocks.stack.append(counts)
+    success=False
+    try:
+        yield
+        success=True
+    finally:
+        _blocks.stack.remove(counts)
+        ru1=resource.getrusage(resource.RUSAGE_SELF)
+        ru=_RUsageDiff(ru0,ru1)
+        _record_rusage(stage,'python',None,start,time.time()-t0,ru,counts[0],success)
+
+def instrument(func):
+    # decorator recording each call of a Python pipeline stage
+    @wraps(func)
+    def wrapper(*args,**kwargs):
+        with instrumented(func.__name__):
+            return func(*args,**kwargs)
+    return wrapper
+
 if __name__=='__main__':
     v=run_log(' '.join(sys.argv[2:]),sys.argv[1],quiet=False)
     print('Return value was',v)
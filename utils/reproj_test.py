@@ -16,156 +16,182 @@ import six
 from astropy.io import fits
 from astropy.wcs import WCS
 import numpy as np
-from multiprocessing import Pool
+import multiprocessing as mp
+import os
 import sys
-
-def reproject_interp_chunk_2d(input_data, output_projection, shape_out=None, hdu_in=0, order='bilinear', blocks=(1000, 1000), parallel=False):
+import tempfile
+from getcpus import getcpus
+
+# Tiled reprojection engine. The output grid is divided into tiles
+# which are reprojected independently, optionally in a pool of worker
+# processes. With more than one worker the output is a memory-mapped
+# array in a temporary file, which the workers write their tiles into
+# directly, so that tiles never go through a pipe. The input image and
+# WCS are module globals set before the pool is forked, so they are not
+# copied for each task either
+
+_tile_job=None
+_tile_out=None
+_tile_out_spec=None
+
+def output_bounds(wcs_in, shape_in, wcs_out, shape_out, nsamp=100, guard=10):
     """
-    For a 2D image, reproject in chunks
+    Return (ymin,ymax,xmin,xmax), the region of the output grid covered
+    by the input image, found by projecting points along the edges of
+    the input, padded by guard pixels and clipped to the output. Returns
+    None if the input falls entirely outside the output
+    """
+    ny,nx=shape_in
+    t=np.linspace(0,1,nsamp)
+    x=np.concatenate((t*nx,np.full(nsamp,nx),(1-t)*nx,np.zeros(nsamp)))-0.5
+    y=np.concatenate((np.zeros(nsamp),t*ny,np.full(nsamp,ny),(1-t)*ny))-0.5
+    ra,dec=wcs_in.wcs_pix2world(x,y,0)
+    xt,yt=wcs_out.wcs_world2pix(ra,dec,0)
+    good=np.isfinite(xt) & np.isfinite(yt)
+    if not np.any(good):
+        return None
+    xmin=int(np.floor(np.min(xt[good])))-guard
+    xmax=int(np.ceil(np.max(xt[good])))+guard
+    ymin=int(np.floor(np.min(yt[good])))-guard
+    ymax=int(np.ceil(np.max(yt[good])))+guard
+    if xmax<0 or ymax<0 or xmin>=shape_out[1] or ymin>=shape_out[0]:
+        return None
+    return max(ymin,0),min(ymax,shape_out[0]),max(xmin,0),min(xmax,shape_out[1])
+
+def make_tiles(bounds, blocks):
+    ymin,ymax,xmin,xmax=bounds
+    tiles=[]
+    for imin in range(ymin, ymax, blocks[0]):
+        imax = min(imin + blocks[0], ymax)
+        for jmin in range(xmin, xmax, blocks[1]):
+            jmax = min(jmin + blocks[1], xmax)
+            tiles.append((imin,imax,jmin,jmax))
+    return tiles
+
+def reproject_tile(tile):
+    imin,imax,jmin,jmax=tile
+    mode,array_in,wcs_in,wcs_out,order,parallel=_tile_job
+    shape_out_sub = (imax - imin, jmax - jmin)
+    wcs_out_sub = wcs_out.deepcopy()
+    wcs_out_sub.wcs.crpix[0] -= jmin
+    wcs_out_sub.wcs.crpix[1] -= imin
+    if mode=='exact':
+        return reproj_exact(array_in, wcs_in, wcs_out_sub,
+                            shape_out=shape_out_sub, parallel=parallel)
+    else:
+        return reproj_interp(array_in, wcs_in, wcs_out_sub,
+                             shape_out=shape_out_sub, order=order)
+
+def reproject_tile_worker(tile):
+    # runs in a pool process: write the tile straight into the shared output files
+    global _tile_out
+    if _tile_out is None:
+        arrayfile,footprintfile,shape,dtype=_tile_out_spec
+        _tile_out=(np.memmap(arrayfile,mode='r+',shape=shape,dtype=dtype),
+                   np.memmap(footprintfile,mode='r+',shape=shape,dtype=dtype))
+    array,footprint=_tile_out
+    imin,imax,jmin,jmax=tile
+    array_sub, footprint_sub = reproject_tile(tile)
+    array[imin:imax, jmin:jmax] = array_sub
+    footprint[imin:imax, jmin:jmax] = footprint_sub
+    array.flush()
+    footprint.flush()
+    return tile
+
+def reproject_tiled(input_data, output_projection, shape_out=None, hdu_in=0, mode='interp',
+                    order='bilinear', blocks=(1000, 1000), parallel=False, workers=1, tmpdir=None):
     """
+    Reproject a 2D image tile by tile. mode is 'interp' or 'exact'.
+    Only tiles overlapping the input image are computed; the rest of
+    the output is NaN with zero footprint. workers is the number of
+    processes to use (None means all available cores). With more than
+    one worker the arrays returned are memory maps of unlinked files in
+    tmpdir (default: the system temporary directory)
+    """
+    global _tile_job, _tile_out, _tile_out_spec
 
     array_in, wcs_in = parse_input_data(input_data, hdu_in=hdu_in)
     wcs_out, shape_out = parse_output_projection(output_projection, shape_out=shape_out)
 
     if isinstance(order, six.string_types):
         order = ORDER[order]
+    dtype=np.float32 if mode=='interp' else np.float64
+    if workers is None:
+        workers=getcpus()
 
-    # Create output arrays
-    array = np.nan*np.ones(shape_out, dtype='float32')
-    footprint = np.zeros(shape_out, dtype='float32')
-
-    # find corners
-    xs=[]
-    ys=[]
-    ymax,xmax=input_data.data.shape
-    for x,y in ((0,0),(xmax,0),(xmax,ymax),(0,ymax)):
-        sky=wcs_in.wcs_pix2world(x,y,0)
-        xt,yt=wcs_out.wcs_world2pix(sky[0],sky[1],0)
-        xs.append(xt)
-        ys.append(yt)
-
-    xtmin=int(np.min(xs)/1.1)
-    xtmax=int(np.max(xs)*1.1)
-    ytmin=int(np.min(ys)/1.1)
-    ytmax=int(np.max(ys)*1.1)
-    if ((xtmin<0 and xtmax<0) or 
-        (xtmin>shape_out[1] and xtmax>shape_out[1]) or
-        (ytmin<0 and ytmax<0) or
-        (ytmin>shape_out[0] and ytmax>shape_out[0])):
+    bounds=output_bounds(wcs_in, array_in.shape, wcs_out, shape_out)
+    if bounds is None:
         print('All of region is outside bounds')
-
+        tiles=[]
     else:
-        # cut to bounds
-        if xtmin<0: xtmin=0
-        if xtmax>shape_out[1]: xtmax=shape_out[1]
-        if ytmin<0: ytmin=0
-        if ytmax>shape_out[0]: ytmax=shape_out[0]
-
-        print('New bounding box is',xtmin,xtmax,ytmin,ytmax)
-
-        bx=1+round((ytmax-ytmin)/blocks[0])
-        by=1+round((xtmax-xtmin)/blocks[1])
-                 
-        print('There will be',int(bx*by),'chunks')
-    
-        # iterate over chunks
-        for imin in range(ytmin, ytmax, blocks[0]):
-            imax = min(imin + blocks[0], array.shape[0])
-            for jmin in range(xtmin, xtmax, blocks[1]):
+        print('New bounding box is',bounds[2],bounds[3],bounds[0],bounds[1])
+        tiles=make_tiles(bounds, blocks)
+        print('There will be',len(tiles),'chunks')
+    workers=max(1,min(workers,len(tiles)))
+
+    _tile_job=(mode,array_in,wcs_in,wcs_out,order,parallel)
+    try:
+        if workers==1:
+            array = np.full(shape_out, np.nan, dtype=dtype)
+            footprint = np.zeros(shape_out, dtype=dtype)
+            for tile in tiles:
                 print('.', end=' ')
                 sys.stdout.flush()
-                jmax = min(jmin + blocks[1], array.shape[1])
-                shape_out_sub = (imax - imin, jmax - jmin)
-                wcs_out_sub = wcs_out.deepcopy()
-                wcs_out_sub.wcs.crpix[0] -= jmin
-                wcs_out_sub.wcs.crpix[1] -= imin
-                array_sub, footprint_sub = reproj_interp(array_in, wcs_in, wcs_out_sub,
-                                                                shape_out=shape_out_sub,
-                                                                order=order)
-                array[imin:imax, jmin:jmax] = array_sub
-                footprint[imin:imax, jmin:jmax] = footprint_sub
-
-        print() 
+                imin,imax,jmin,jmax=tile
+                array[imin:imax, jmin:jmax], footprint[imin:imax, jmin:jmax] = reproject_tile(tile)
+        else:
+            files=[]
+            try:
+                for name in ('array','footprint'):
+                    fd,filename=tempfile.mkstemp(prefix='reproject-%s-' % name, suffix='.dat', dir=tmpdir)
+                    os.close(fd)
+                    files.append(filename)
+                array = np.memmap(files[0], mode='w+', shape=shape_out, dtype=dtype)
+                footprint = np.memmap(files[1], mode='w+', shape=shape_out, dtype=dtype)
+                array[:] = np.nan
+                array.flush()
+                _tile_out_spec=(files[0],files[1],shape_out,dtype)
+                _tile_out=None
+                print('Using',workers,'processes')
+                pool=mp.get_context('fork').Pool(workers)
+                try:
+                    for tile in pool.imap_unordered(reproject_tile_worker, tiles):
+                        print('.', end=' ')
+                        sys.stdout.flush()
+                finally:
+                    pool.terminate()
+                    pool.join()
+            finally:
+                # our maps stay valid after the files are unlinked
+                for filename in files:
+                    os.unlink(filename)
+    finally:
+        _tile_job=None
+    print()
     return array, footprint
 
-def reproject_exact_chunk_2d(input_data, output_projection, shape_out=None, hdu_in=0,
-                              order='bilinear', blocks=(1000, 1000), parallel=False):
+def reproject_interp_chunk_2d(input_data, output_projection, shape_out=None, hdu_in=0, order='bilinear', blocks=(1000, 1000), parallel=False, workers=1, tmpdir=None):
     """
     For a 2D image, reproject in chunks
     """
+    return reproject_tiled(input_data, output_projection, shape_out=shape_out, hdu_in=hdu_in, mode='interp',
+                           order=order, blocks=blocks, parallel=parallel, workers=workers, tmpdir=tmpdir)
 
-    array_in, wcs_in = parse_input_data(input_data, hdu_in=hdu_in)
-    wcs_out, shape_out = parse_output_projection(output_projection, shape_out=shape_out)
-
-    if isinstance(order, six.string_types):
-        order = ORDER[order]
-
-    # Create output arrays
-    array = np.zeros(shape_out, dtype=float)
-    footprint = np.zeros(shape_out, dtype=float)
-
-    for imin in range(0, array.shape[0], blocks[0]):
-        imax = min(imin + blocks[0], array.shape[0])
-        for jmin in range(0, array.shape[1], blocks[1]):
-            print('.', end=' ')
-            jmax = min(jmin + blocks[1], array.shape[1])
-            shape_out_sub = (imax - imin, jmax - jmin)
-            wcs_out_sub = wcs_out.deepcopy()
-            wcs_out_sub.wcs.crpix[0] -= jmin
-            wcs_out_sub.wcs.crpix[1] -= imin
-            array_sub, footprint_sub = reproj_exact(array_in, wcs_in, wcs_out_sub,
-                                                            shape_out=shape_out_sub,
-                                                            parallel=parallel)
-            array[imin:imax, jmin:jmax] = array_sub
-            footprint[imin:imax, jmin:jmax] = footprint_sub
-    print()
-    return array, footprint
-
-
-def reproject_worker(a):
-    imin,imax,jmin,jmax,array_in,wcs_in,wcs_out_sub,shape_out_sub,order=a
-    print('worker:',imin,jmin)
-    array_sub, footprint_sub = _reproject_celestial(array_in, wcs_in, wcs_out_sub,
-                                                    shape_out=shape_out_sub, order=order)
-    return imin,imax,jmin,jmax,array_sub,footprint_sub
-
-def reproject_interp_chunk_2d_multi(input_data, output_projection, shape_out=None, hdu_in=0,
-                                    order='bilinear', blocks=(1000, 1000), parallel=True):
+def reproject_exact_chunk_2d(input_data, output_projection, shape_out=None, hdu_in=0,
+                              order='bilinear', blocks=(1000, 1000), parallel=False, workers=1, tmpdir=None):
     """
     For a 2D image, reproject in chunks
     """
-    
-    array_in, wcs_in = parse_input_data(input_data, hdu_in=hdu_in)
-    wcs_out, shape_out = parse_output_projection(output_projection, shape_out=shape_out)
+    return reproject_tiled(input_data, output_projection, shape_out=shape_out, hdu_in=hdu_in, mode='exact',
+                           order=order, blocks=blocks, parallel=parallel, workers=workers, tmpdir=tmpdir)
 
-    if isinstance(order, six.string_types):
-        order = ORDER[order]
-
-    # Create output arrays
-    array = np.zeros(shape_out, dtype=float)
-    footprint = np.zeros(shape_out, dtype=float)
-    # Arguments for pool
-    args=[] 
-    print('chunking for pool')
-    for imin in range(0, array.shape[0], blocks[0]):
-        imax = min(imin + blocks[0], array.shape[0])
-        for jmin in range(0, array.shape[1], blocks[1]):
-            jmax = min(jmin + blocks[1], array.shape[1])
-            shape_out_sub = (imax - imin, jmax - jmin)
-            wcs_out_sub = wcs_out.deepcopy()
-            wcs_out_sub.wcs.crpix[0] -= jmin
-            wcs_out_sub.wcs.crpix[1] -= imin
-            args.append((imin,imax,jmin,jmax,array_in,wcs_in,wcs_out_sub,shape_out_sub,order))
-
-    print('pooling')
-    p=Pool(16)
-    results=p.map(reproject_worker,args)
-    for r in results:
-        imin,imax,jmin,jmax,array_sub,footprint_sub=r
-        array[imin:imax, jmin:jmax] = array_sub
-        footprint[imin:imax, jmin:jmax] = footprint_sub
-
-    return array, footprint
+def reproject_interp_chunk_2d_multi(input_data, output_projection, shape_out=None, hdu_in=0,
+                                    order='bilinear', blocks=(1000, 1000), parallel=True, workers=None, tmpdir=None):
+    """
+    For a 2D image, reproject in chunks using all available cores by default
+    """
+    return reproject_tiled(input_data, output_projection, shape_out=shape_out, hdu_in=hdu_in, mode='interp',
+                           order=order, blocks=blocks, parallel=parallel, workers=workers, tmpdir=tmpdir)
 
 if __name__=='__main__':
 
@@ -199,5 +225,5 @@ if __name__=='__main__':
     data=np.random.rand(ysize,xsize)
 
     hdu=fits.PrimaryHDU(header=header,data=data)
-    r,footprint=reproj(hdu, rheader, hdu_in=0, parallel=True)
+    r,footprint=reproj(hdu, rheader, hdu_in=0, parallel=True, workers=None)
     fits.PrimaryHDU(header=rheader,data=r).writeto('output.fits',overwrite=True)
@@ -8,13 +8,14 @@ import optparse
 import pickle
 import numpy as np
 import os
-from itertools import product as ItP
+import glob
+from multiprocessing import Pool
 #from DDFacet.Other import MyLogger
 #log=MyLogger.getLogger("ClassSmooth")
 
 SaveName="last_Smooth.obj"
 
-def savitzky_golay(y, window_size, order, deriv=0, rate=1):
+def savitzky_golay(y, window_size, order, deriv=0, rate=1, axis=0):
     r"""Smooth (and optionally differentiate) data with a Savitzky-Golay filter.
     The Savitzky-Golay filter removes high frequency noise from data.
     It has the advantage of preserving the original shape and
@@ -22,7 +23,7 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     approaches, such as moving averages techniques.
     Parameters
     ----------
-    y : array_like, shape (N,)
+    y : array_like, shape (N,) or N-dimensional
         the values of the time history of the signal.
     window_size : int
         the length of the window. Must be an odd integer number.
@@ -31,9 +32,12 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
         Must be less then `window_size` - 1.
     deriv: int
         the order of the derivative to compute (default = 0 means only smoothing)
+    axis: int
+        for N-dimensional y, the axis to filter along; every other axis
+        is treated as a separate signal and filtered in the same call
     Returns
     -------
-    ys : ndarray, shape (N)
+    ys : ndarray, same shape as y
         the smoothed signal (or it's n-th derivative).
     Notes
     -----
@@ -66,8 +70,8 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     from math import factorial
     
     try:
-        window_size = np.abs(np.int(window_size))
-        order = np.abs(np.int(order))
+        window_size = np.abs(int(window_size))
+        order = np.abs(int(order))
     except ValueError as msg:
         raise ValueError("window_size and order have to be of type int")
     if window_size % 2 != 1 or window_size < 1:
@@ -79,12 +83,20 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     # precompute coefficients
     b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
     m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
+    # work with the filter axis first
+    y = np.moveaxis(np.asarray(y), axis, 0)
     # pad the signal at the extremes with
     # values taken from the signal itself
     firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
     lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
     y = np.concatenate((firstvals, y, lastvals))
-    return np.convolve( m[::-1], y, mode='valid')
+    # 'valid' convolution with m[::-1], as a sum of shifted copies so
+    # that all the signals are filtered at once
+    n = len(y) - len(m) + 1
+    ys = np.zeros((n,)+y.shape[1:], dtype=np.result_type(y, m))
+    for j in range(len(m)):
+        ys += m[j]*y[j:j+n]
+    return np.moveaxis(ys, 0, axis)
 
     
 def read_options():
@@ -102,6 +114,7 @@ def read_options():
     opt.add_option_group(group)
     group = optparse.OptionGroup(opt, "* Misc options", "Defaults may be sensible")
     group.add_option('--Plot',help='Enable plotting',default=False)
+    group.add_option('--NCPU',help='Number of MSs to smooth in parallel',default=1)
     opt.add_option_group(group)
 
 
@@ -111,22 +124,19 @@ def read_options():
 
 
 def NormMatrices(G):
-    nt,nch,na,_,_=G.shape
-
-    for iChan,it in ItP(list(range(nch)),list(range(nt))):
-        Gt=G[it,iChan,:,:]
-        u,s,v=np.linalg.svd(Gt[0])
-        # #J0/=np.linalg.det(J0)
-        # J0=Gt[0]
-        # JJ=np.dot(J0.T.conj(),J0)
-        # sqJJ=ModLinAlg.sqrtSVD(JJ)
-        # sqJJinv=ModLinAlg.invSVD(JJ)
-        # U=np.dot(J0,sqJJinv)
-        U=np.dot(u,v)
-        for iAnt in range(0,na):
-            Gt[iAnt,:,:]=np.dot(U.T.conj(),Gt[iAnt,:,:])
-            #Gt[iAnt,:,:]=np.dot(np.dot(u,Gt[iAnt,:,:]),v.T.conj())
-            #Gt[iAnt,:,:]=np.dot(Gt[iAnt,:,:],J0)
+    # G has shape (nt,nch,na,...,2,2): rotate the Jones matrices of every
+    # antenna by the unitary part of those of the first antenna, for all
+    # times, channels and any further axes at once
+    u,s,v=np.linalg.svd(G[:,:,0])
+    # #J0/=np.linalg.det(J0)
+    # J0=Gt[0]
+    # JJ=np.dot(J0.T.conj(),J0)
+    # sqJJ=ModLinAlg.sqrtSVD(JJ)
+    # sqJJinv=ModLinAlg.invSVD(JJ)
+    # U=np.dot(J0,sqJJinv)
+    U=np.matmul(u,v)
+    UH=np.conj(np.swapaxes(U,-1,-2))
+    G[:]=np.matmul(UH[:,:,np.newaxis],G)
     return G
 
 
@@ -148,10 +158,7 @@ class ClassSmooth(object):
 
     def NormAllDirs(self):
         print("  Normalising Jones matrices ....")
-        nt,nch,na,nd,_,_=self.Sols.G.shape
-        for iDir in range(nd):
-            G=self.Sols.G[:,:,:,iDir,:,:]
-            self.Sols.G[:,:,:,iDir,:,:]=NormMatrices(G)
+        self.Sols.G[:]=NormMatrices(np.array(self.Sols.G))
 
     def Smooth(self):
         Sols0=self.Sols
@@ -171,18 +178,13 @@ class ClassSmooth(object):
 #        Sols1.tm=Sols0.tm
 
         print("  Smoothing")
-        for iDir in range(nd):
-            for iAnt in range(na):
-                for ipol in Pols:
-                    # Amplitude
-                    yp=np.abs(G0[:,0,iAnt,iDir,ipol])
-                    # Do some smoothing on the amps
-                    yp = np.copy(savitzky_golay(yp, self.WSize, self.Order))
-                    G1[:,iAnt,iDir,ipol]=yp[:]
-                    # Phase
-                    yp=np.angle(G0[:,0,iAnt,iDir,ipol])
-                    G1[:,iAnt,iDir,ipol]*=np.exp(1j*yp[:])
-                if self.doplot:
+        # Smooth the amplitudes of all antennas, directions and pols
+        # along the time axis in one go, and keep the phases
+        G=G0[:,0][...,Pols]
+        G1[...,Pols]=savitzky_golay(np.abs(G), self.WSize, self.Order, axis=0)*np.exp(1j*np.angle(G))
+        if self.doplot:
+            for iDir in range(nd):
+                for iAnt in range(na):
                     import matplotlib.pyplot as plt
                     xp=(Sols0.t0+Sols0.t1)/2.
                     op0=np.abs
@@ -257,10 +259,28 @@ def main(options=None):
 
 
 
-    for MSName in lMS:
-        CI=ClassSmooth(MSName,SolsFile,WSize=options.WSize,Order=options.Order,doplot=options.Plot)
-        CI.Smooth()
-        CI.Save()
+    ncpu=getattr(options,'NCPU',None)
+    ncpu=1 if ncpu is None else int(ncpu)
+    if options.Plot:
+        ncpu=1
+    args=[(MSName,SolsFile,options.WSize,options.Order,options.Plot) for MSName in lMS]
+    if ncpu<=1 or len(lMS)<=1:
+        for a in args:
+            smooth_ms(a)
+    else:
+        pool=Pool(min(ncpu,len(lMS)))
+        try:
+            pool.map(smooth_ms,args)
+        finally:
+            pool.close()
+            pool.join()
+
+def smooth_ms(args):
+    # smooth and save the solutions for one MS
+    MSName,SolsFile,WSize,Order,doplot=args
+    CI=ClassSmooth(MSName,SolsFile,WSize=WSize,Order=Order,doplot=doplot)
+    CI.Smooth()
+    CI.Save()
 
 
 if __name__=="__main__":
@@ -0,0 +1,153 @@
+from __future__ import print_function
+from __future__ import absolute_import
+# Simple dependency-graph scheduler for pipeline stages that do not
+# depend on each other, e.g. the imaging steps at the end of a run
+
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from auxcodes import report,warn
+from pipeline_logging import instrumented
+
+class Stage(object):
+    """
+    A unit of pipeline work. func is called with no arguments. inputs
+    and outputs are file names: a stage runs only after every stage
+    that produces one of its inputs has finished. after is an optional
+    list of stage names that must also finish first. ncpu is the
+    number of cores the stage expects to use. tag is the name the
+    stage answers to for exitafter (defaults to the stage name)
+    """
+    def __init__(self,name,func,inputs=None,outputs=None,after=None,ncpu=1,tag=None):
+        self.name=name
+        self.func=func
+        self.inputs=list(inputs) if inputs is not None else []
+        self.outputs=list(outputs) if outputs is not None else []
+        self.after=list(after) if after is not None else []
+        self.ncpu=ncpu
+        self.tag=tag if tag is not None else name
+        self.result=None
+        self.done=False
+
+def stage_dependencies(stages):
+    """
+    Return a dict mapping each stage name to the set of names of the
+    stages it has to wait for
+    """
+    names=[s.name for s in stages]
+    if len(set(names))!=len(names):
+        raise RuntimeError('Stage names must be unique')
+    producers={}
+    for s in stages:
+        for f in s.outputs:
+            if f in producers:
+                raise RuntimeError('File %s is an output of both %s and %s' % (f,producers[f],s.name))
+            producers[f]=s.name
+    deps={}
+    for s in stages:
+        d=set(s.after)
+        for f in s.inputs:
+            if f in producers:
+                d.add(producers[f])
+        d.discard(s.name)
+        for n in d:
+            if n not in names:
+                raise RuntimeError('Stage %s depends on unknown stage %s' % (s.name,n))
+        deps[s.name]=d
+
+    # check for cycles by repeatedly removing stages with no pending dependencies
+    pending=dict((k,set(v)) for k,v in deps.items())
+    while pending:
+        free=[k for k,v in pending.items() if not v]
+        if not free:
+            raise RuntimeError('Stage graph has a cycle involving %s' % ', '.join(sorted(pending)))
+        for k in free:
+            del(pending[k])
+        for v in pending.values():
+            v.difference_update(free)
+    return deps
+
+def run_stages(stages,ncpu,maxjobs=1,exitafter=None,catcher=None):
+    """
+    Run a list of Stage objects, starting each one as soon as its
+    dependencies are satisfied and there are free slots. At most
+    maxjobs stages run at once and the ncpu of the running stages is
+    kept within ncpu (a stage asking for more than that runs on its
+    own). Stages are started in list order where there is a choice,
+    so maxjobs=1 reproduces a plain sequential run.
+
+    If exitafter matches the tag of any stage, no new stages are
+    started once all such stages have finished, and True is
+    returned. Otherwise False is returned when everything has run.
+
+    An exception in any stage stops new stages from starting; running
+    stages are allowed to finish and the first exception is re-raised.
+    """
+    deps=stage_dependencies(stages)
+    byname=dict((s.name,s) for s in stages)
+    exitstages=set(s.name for s in stages if exitafter is not None and s.tag==exitafter)
+    waiting=[s.name for s in stages]
+    running={}
+    finished=set()
+    errors=[]
+    events=queue.Queue()
+    stopping=False
+    exited=False
+
+    def worker(stage):
+        try:
+            with instrumented('stage-'+stage.name):
+                stage.result=stage.func()
+        except BaseException as e:
+            events.put((stage.name,e))
+        else:
+            events.put((stage.name,None))
+
+    while True:
+        if not stopping and catcher:
+            try:
+                catcher.check()
+            except RuntimeError as e:
+                errors.append(e)
+                stopping=True
+        if not stopping:
+            inuse=sum(byname[n].ncpu for n in running)
+            for name in list(waiting):
+                if len(running)>=maxjobs:
+                    break
+                if not deps[name]<=finished:
+                    continue
+                s=byname[name]
+                if running and inuse+s.ncpu>ncpu:
+                    continue
+                report('Starting stage %s' % name)
+                waiting.remove(name)
+                t=threading.Thread(target=worker,args=(s,))
+                running[name]=t
+                inuse+=s.ncpu
+                t.start()
+        if not running:
+            break
+        name,error=events.get()
+        running.pop(name).join()
+        if error is not None:
+            warn('Stage %s failed' % name)
+            errors.append(error)
+            stopping=True
+            continue
+        report('Stage %s finished' % name)
+        byname[name].done=True
+        finished.add(name)
+        if exitstages and exitstages<=finished and not stopping:
+            warn('User specified exit after '+exitafter+', waiting for running stages')
+            stopping=True
+            exited=True
+
+    if errors:
+        raise errors[0]
+    if waiting and not stopping:
+        # only reachable if a dependency can never be satisfied
+        raise RuntimeError('Stages %s could not be run' % ', '.join(waiting))
+    return exited